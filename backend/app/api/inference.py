@@ -1,16 +1,112 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator, List, Optional
+
+from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect, Depends
+from fastapi.responses import FileResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from app.db.database import get_db
+from app.services.admission import AdmissionRejected, admission
+from app.services.batch_jobs import BATCH_MAX_BYTES, BatchInputError, BatchJob, batch_jobs
 from app.models.preset import Preset as DBPreset
 from app.models.model import Model as DBModel
-from app.services.model_runtime import runtime
-from app.services.model_storage import download_model_from_huggingface
+from app.services.framing import (
+    END_SENTINEL,
+    StreamFramer,
+    flush_settings,
+    framed,
+    negotiate_protocol,
+    send_frame,
+)
+from app.services.mmap_loader import memory_report
+from app.services.model_pool import LoadJob, pool
+from app.services.model_runtime import preset_to_dict
+from app.services.model_storage import DownloadError, cache, downloads, get_catalog, get_model_path
+from app.services.response_cache import cacheable, normalize_message, response_cache
+from app.services.sessions import sessions
+from app.services.stopping import generation_stats
+from app.services.workers import INFERENCE_WORKERS, get_worker_pool
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+
+async def _get_draft_model(db: AsyncSession, preset: DBPreset) -> Optional[DBModel]:
+    draft_model_id = getattr(preset, "draft_model_id", None)
+    if draft_model_id is None or draft_model_id == preset.model_id:
+        return None
+    result = await db.execute(select(DBModel).where(DBModel.id == draft_model_id))
+    return result.scalar_one_or_none()
+
+
+def _start_downloads(model: DBModel, draft: DBModel = None) -> list:
+    """Background download jobs for the weights that are needed but not on disk yet."""
+    needed = [draft] if draft else []
+    if model.id not in pool:
+        needed.append(model)
+    return [
+        downloads.submit(m.huggin_face_refference, m.model_name)
+        for m in needed if not cache.lookup(m.model_name)
+    ]
+
+
+async def _load_into_pool(
+    model: DBModel, preset: DBPreset, draft: DBModel = None, job: LoadJob = None, make_default: bool = True
+):
+    # Downloads and loading run off the event loop so other requests keep being served.
+    download_jobs = _start_downloads(model, draft)
+    if job is not None:
+        job.downloads = download_jobs
+        if any(download_job.active for download_job in download_jobs):
+            job.status = "downloading"
+    for download_job in download_jobs:
+        await asyncio.to_thread(download_job.wait)
+        if download_job.status != "completed":
+            raise DownloadError(download_job.error or f"Download of {download_job.model_name} {download_job.status}")
+
+    if job is not None:
+        job.status = "loading"
+    draft_path = str(get_model_path(draft.model_name)) if draft else None
+    model_path = str(get_model_path(model.model_name)) if model.id not in pool else None
+    return await asyncio.to_thread(pool.load, model, preset, model_path, draft_path, make_default)
+
+
+# Background load tasks, referenced so they are not garbage collected while running.
+_load_tasks = set()
+
+
+async def _wake_default(db: AsyncSession):
+    """The default model, reloaded if it was unloaded for being idle."""
+    runtime = await asyncio.to_thread(pool.wake)
+    if runtime is not None:
+        return runtime
+    asleep = pool.asleep()
+    if asleep is None:
+        return None
+    # Its weights were evicted from disk while it slept; download them again.
+    model, preset = asleep
+    await _load_into_pool(model, preset, await _get_draft_model(db, preset))
+    return pool.default()
+
+
+async def _run_load_job(job: LoadJob, model: DBModel, preset: DBPreset, draft: DBModel = None):
+    try:
+        result = await _load_into_pool(model, preset, draft, job)
+    except DownloadError as e:
+        job.fail(str(e))
+    except Exception as e:
+        logger.exception(f"Loading model {model.model_name} failed")
+        job.fail(str(e))
+    else:
+        job.finish(result)
+
+
 @router.post("/load/{preset_id}")
-async def load_model(preset_id: int, db: AsyncSession = Depends(get_db)):
+async def load_model(preset_id: int, wait: bool = False, db: AsyncSession = Depends(get_db)):
     preset_result = await db.execute(select(DBPreset).where(DBPreset.id == preset_id))
     preset = preset_result.scalar_one_or_none()
     if not preset:
@@ -21,45 +117,363 @@ async def load_model(preset_id: int, db: AsyncSession = Depends(get_db)):
     if not model:
         return {"error": "Model not found"}
 
-    if runtime.active_model and runtime.active_model.get("id") == model.id:
-        runtime.update_preset(preset)
-        return {
-            "status": "preset updated",
-            "model": runtime.active_model,
-            "preset": runtime.preset
-        }
+    draft = await _get_draft_model(db, preset)
+    # Loaded models keep serving while this one downloads and loads in the background.
+    job, created = pool.load_job(model.id, preset.id)
+    if created:
+        task = asyncio.create_task(_run_load_job(job, model, preset, draft))
+        _load_tasks.add(task)
+        task.add_done_callback(_load_tasks.discard)
+
+    if not wait:
+        # Poll /inference/load_jobs/{id} until the job is completed.
+        return {"status": job.status, "job": job.progress()}
+
+    await asyncio.to_thread(job.wait)
+    if job.status != "completed":
+        return {"error": job.error}
+    return job.result
+
+
+@router.get("/load_jobs")
+async def list_load_jobs():
+    return [job.progress() for job in pool.jobs()]
+
+
+@router.get("/load_jobs/{job_id}")
+async def get_load_job(job_id: str):
+    job = pool.get_job(job_id)
+    if not job:
+        return {"error": "Load job not found"}
+    return job.progress()
+
+
+
+async def _run_batch_job(job: BatchJob, model: DBModel, preset: DBPreset, draft: DBModel = None):
+    if model.id not in pool:
+        job.status = "loading"
+        try:
+            # Connections without a preset keep talking to the current default model.
+            await _load_into_pool(model, preset, draft, make_default=False)
+        except Exception as e:
+            logger.exception(f"Loading model {model.model_name} for batch job {job.id} failed")
+            job.fail(str(e))
+            return
+    if job.active:
+        batch_jobs.start(job, lambda: pool.get(model.id))
+
+
+async def _receive_batch_input(job: BatchJob, request: Request):
+    """Streams the request body into the job's input file, writing off the event loop."""
+    f = await asyncio.to_thread(open, job.input_path, "wb")
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > BATCH_MAX_BYTES:
+                raise BatchInputError(f"Input larger than {BATCH_MAX_BYTES} bytes")
+            await asyncio.to_thread(f.write, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+@router.post("/batch/{preset_id}")
+async def create_batch_job(preset_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    """Body: JSONL, one {"id": ..., "prompt": ...} per line. Poll /inference/batch/{id} for progress."""
+    preset_result = await db.execute(select(DBPreset).where(DBPreset.id == preset_id))
+    preset = preset_result.scalar_one_or_none()
+    if not preset:
+        return {"error": "Preset not found"}
+
+    model_result = await db.execute(select(DBModel).where(DBModel.id == preset.model_id))
+    model = model_result.scalar_one_or_none()
+    if not model:
+        return {"error": "Model not found"}
+
+    if int(request.headers.get("content-length") or 0) > BATCH_MAX_BYTES:
+        return {"error": f"Input larger than {BATCH_MAX_BYTES} bytes"}
+
+    job = batch_jobs.create(model.id, preset_to_dict(preset))
+    try:
+        await _receive_batch_input(job, request)
+    except BatchInputError as e:
+        await asyncio.to_thread(batch_jobs.reject, job, str(e))
+        return {"error": str(e)}
+    try:
+        # Parsing up to BATCH_MAX_ITEMS lines must not hold up the event loop.
+        await asyncio.to_thread(batch_jobs.check_input, job)
+    except BatchInputError as e:
+        return {"error": str(e)}
+
+    draft = await _get_draft_model(db, preset)
+    task = asyncio.create_task(_run_batch_job(job, model, preset, draft))
+    _load_tasks.add(task)
+    task.add_done_callback(_load_tasks.discard)
+    return job.progress()
+
+
+@router.get("/batch")
+async def list_batch_jobs():
+    return [job.progress() for job in batch_jobs.jobs()]
+
+
+@router.get("/batch/{job_id}")
+async def get_batch_job(job_id: str):
+    job = batch_jobs.get(job_id)
+    if not job:
+        return {"error": "Batch job not found"}
+    return job.progress()
 
-    model_path = download_model_from_huggingface(
-        hf_reference=model.huggin_face_refference,
-        model_name=model.model_name
-    )
 
-    return runtime.load_model(model, preset, str(model_path))
+@router.get("/batch/{job_id}/results")
+async def get_batch_results(job_id: str):
+    # Results are appended as buckets finish, so this can be fetched while the job runs.
+    job = batch_jobs.get(job_id)
+    if not job:
+        return {"error": "Batch job not found"}
+    if not job.output_path.exists():
+        return {"error": "No results yet", "status": job.status}
+    return FileResponse(job.output_path, media_type="application/x-ndjson", filename=f"{job.id}.jsonl")
 
 
+@router.post("/batch/{job_id}/cancel")
+async def cancel_batch_job(job_id: str):
+    job = batch_jobs.get(job_id)
+    if not job:
+        return {"error": "Batch job not found"}
+    job.cancel()
+    return job.progress()
+
 
 @router.get("/current_model")
 async def get_current_model():
-    model_info = runtime.get_current_model_info()
+    runtime = pool.default()
+    model_info = runtime.get_current_model_info() if runtime else None
     if not model_info:
         return {"error": "No model is currently loaded"}
     return model_info
 
 
+@router.get("/pool")
+async def get_pool():
+    return pool.info()
+
+
+@router.get("/admission")
+async def get_admission():
+    return admission.stats()
+
+
+@router.get("/generation_stats")
+async def get_generation_stats():
+    return generation_stats.stats()
+
+
+@router.get("/response_cache")
+async def get_response_cache():
+    return response_cache.stats()
+
+
+@router.delete("/response_cache")
+async def clear_response_cache():
+    await asyncio.to_thread(response_cache.clear)
+    return {"ok": True}
+
+
+@router.get("/memory")
+async def get_memory():
+    # Resident vs shared kB per process; mmap-loaded weights show up as shared.
+    report = {"api": {"pid": os.getpid(), **memory_report()}, "workers": []}
+    if INFERENCE_WORKERS > 0:
+        report["workers"] = await asyncio.to_thread(get_worker_pool().broadcast, "memory_report")
+    return report
+
+
 @router.post("/stop")
-async def stop_model():
-    return runtime.stop_model()
+async def stop_model(model_id: Optional[int] = None):
+    # Stopping joins the scheduler and frees memory (in every worker in worker mode).
+    return await asyncio.to_thread(pool.stop, model_id)
 
 
-@router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
+STOP_MESSAGE = "__STOP__"
+
+
+async def _receive_messages(websocket: WebSocket, inbox: asyncio.Queue, active: dict):
     try:
         while True:
             message = await websocket.receive_text()
+            if message == STOP_MESSAGE:
+                if active.get("stream"):
+                    active["stream"].cancel()
+                elif active.get("ticket"):
+                    admission.withdraw(active["ticket"])
+                continue
+            await inbox.put(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if active.get("stream"):
+            active["stream"].cancel()
+        elif active.get("ticket"):
+            admission.withdraw(active["ticket"])
+        await inbox.put(None)
 
-            for token in runtime.generate_stream(message):
-                await websocket.send_text(token)
 
-    except WebSocketDisconnect:
-        await websocket.close()
+def _model_key(runtime) -> str:
+    # Same weights, same replies: the Hub revision and load profile pin them down.
+    name = runtime.active_model["model_name"]
+    entry = get_catalog().get(name) or {}
+    return f"{name}@{entry.get('revision')}/{runtime.active_model.get('load_profile')}"
+
+
+async def _replay(chunks: List[str]) -> AsyncIterator[str]:
+    for chunk in chunks:
+        yield chunk
+    yield END_SENTINEL
+
+
+async def _recording(stream, chunks: List[str]) -> AsyncIterator[str]:
+    async for token in stream:
+        if token != END_SENTINEL:
+            chunks.append(token)
+        yield token
+
+
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, preset_id: Optional[int] = None, db: AsyncSession = Depends(get_db)):
+    protocol, subprotocol = negotiate_protocol(websocket)
+    await websocket.accept(subprotocol=subprotocol)
+    flush_ms, flush_tokens = flush_settings(websocket)
+    framer = StreamFramer(protocol, flush_ms=flush_ms, flush_tokens=flush_tokens)
+
+    preset = model = draft = None
+    if preset_id is not None:
+        preset_result = await db.execute(select(DBPreset).where(DBPreset.id == preset_id))
+        preset = preset_result.scalar_one_or_none()
+        if preset:
+            model_result = await db.execute(select(DBModel).where(DBModel.id == preset.model_id))
+            model = model_result.scalar_one_or_none()
+            draft = await _get_draft_model(db, preset)
+        if not preset or not model:
+            await send_frame(websocket, framer.error("Preset not found."))
+            await websocket.close()
+            return
+
+    # The connection's own persona and sampling settings; the loaded model is shared.
+    bound_preset = preset_to_dict(preset) if preset else None
+    # Fairness and queue limits are per peer address. ?client_id= is self-reported,
+    # so it only labels the connection in logs; keying on it would let a client
+    # skip the per-client limits by sending a fresh id each time.
+    client_id = websocket.client.host if websocket.client else "unknown"
+    client_label = websocket.query_params.get("client_id")
+    session = sessions.create()
+    # Messages and replies so far; part of the response cache key.
+    history: List[str] = []
+    inbox: asyncio.Queue = asyncio.Queue()
+    active = {}
+    receiver = asyncio.create_task(_receive_messages(websocket, inbox, active))
+    request_id = 0
+    try:
+        while True:
+            message = await inbox.get()
+            if message is None:
+                break
+            request_id += 1
+            framer.start(request_id)
+
+            if model is None:
+                runtime = pool.default()
+                if runtime is None:
+                    # The default model may have been unloaded for being idle.
+                    try:
+                        runtime = await _wake_default(db)
+                    except DownloadError as e:
+                        await send_frame(websocket, framer.error(str(e)))
+                        continue
+            else:
+                runtime = pool.get(model.id)
+                # Any loaded copy of the model serves this connection's preset; only a missing
+                # model, or a draft this preset wants but nobody loaded, needs a load.
+                if runtime is None or (draft is not None and not runtime.active_model.get("draft_model")):
+                    try:
+                        # The connection keeps its preset to itself: neither the default
+                        # model nor the model's default preset changes for other clients.
+                        await _load_into_pool(model, preset, draft, make_default=False)
+                    except DownloadError as e:
+                        await send_frame(websocket, framer.error(str(e)))
+                        continue
+                    runtime = pool.get(model.id)
+
+            if runtime is None:
+                await send_frame(websocket, framer.error("Model not loaded."))
+                continue
+
+            cache_key = None
+            if response_cache.enabled and cacheable(bound_preset or runtime.preset):
+                message = normalize_message(message)
+                cache_key = response_cache.key(_model_key(runtime), bound_preset or runtime.preset, history, message)
+                entry = response_cache.get(cache_key)
+                if entry is not None:
+                    started = time.monotonic()
+                    async for frame in framed(_replay(entry["chunks"]), framer):
+                        await send_frame(websocket, frame)
+                    await send_frame(websocket, framer.end({
+                        **entry["metadata"],
+                        "ttft_ms": 0.0,
+                        "total_ms": round((time.monotonic() - started) * 1000, 1),
+                        "cached": True,
+                    }))
+                    reply = "".join(entry["chunks"])
+                    # Later turns must see this exchange as if it had been generated.
+                    await asyncio.to_thread(runtime.record_turn, session, message, reply, bound_preset)
+                    history += [message, reply]
+                    continue
+
+            async def send_position(position: int):
+                frame = framer.queued(position)
+                if frame is not None:
+                    await send_frame(websocket, frame)
+
+            try:
+                ticket = active["ticket"] = admission.enqueue(client_id, message)
+            except AdmissionRejected as e:
+                logger.info(f"Rejected request from {client_id}" + (f" ({client_label})" if client_label else "") + f": {e}")
+                await send_frame(websocket, framer.error(str(e), busy=True))
+                continue
+            if not await admission.wait(ticket, send_position):
+                # Stopped (or disconnected) while waiting for a slot.
+                active["ticket"] = None
+                await send_frame(websocket, framer.end({"finish_reason": "cancelled"}))
+                continue
+
+            try:
+                try:
+                    # A connection's own preset may not be prefilled yet (or was evicted
+                    # from the prefix cache); that forward pass must not block the loop.
+                    await asyncio.to_thread(runtime.warm_prefix, bound_preset)
+                    active["stream"] = runtime.open_stream(message, session=session, preset=bound_preset)
+                except RuntimeError as e:
+                    await send_frame(websocket, framer.error(str(e)))
+                    continue
+
+                chunks: List[str] = []
+                async for frame in framed(_recording(active["stream"], chunks), framer):
+                    await send_frame(websocket, frame)
+                metadata = active["stream"].metadata()
+                await send_frame(websocket, framer.end(metadata))
+                active["stream"] = None
+                generation_stats.record(metadata)
+                if cache_key is not None and metadata.get("finish_reason") in ("stop", "length"):
+                    response_cache.put(cache_key, chunks, metadata)
+                    history += [message, "".join(chunks)]
+            finally:
+                admission.release(ticket)
+                active["ticket"] = None
+
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        if active.get("stream"):
+            active["stream"].cancel()
+        receiver.cancel()
+        sessions.close(session)
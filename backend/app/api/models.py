@@ -1,30 +1,38 @@
+import asyncio
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from typing import List
-import requests
 
 
 from app.schemas import model as model_schema
 from app.models.model import Model
 from app.db.database import get_db
-from app.services.hf_utils import get_model_size_from_huggingface, HuggingFaceModelNotFound
+from app.services.hf_utils import get_model_size_from_huggingface, HuggingFaceAPIError, HuggingFaceModelNotFound
+from app.services.model_pool import pool
+from app.services.model_storage import PREFETCH_ON_CREATE, cache, delete_model as delete_local_model, downloads, get_catalog
 
 
 router = APIRouter()
 
 
 @router.post("/", response_model=model_schema.ModelInDB)
-async def create_model(model: model_schema.ModelCreate, db: AsyncSession = Depends(get_db)):
+async def create_model(model: model_schema.ModelCreate, prefetch: bool = PREFETCH_ON_CREATE, db: AsyncSession = Depends(get_db)):
     try:
-        size = get_model_size_from_huggingface(model.huggin_face_refference)
+        size = await get_model_size_from_huggingface(model.huggin_face_refference, model.model_name)
     except HuggingFaceModelNotFound as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except HuggingFaceAPIError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=str(e))
 
     db_model = Model(**model.dict(), size=size)
     db.add(db_model)
     await db.commit()
     await db.refresh(db_model)
+    if prefetch:
+        # Download the weights in the background so the first load reads them from disk.
+        downloads.submit(db_model.huggin_face_refference, db_model.model_name, prefetch=True)
     return db_model
 
 
@@ -34,6 +42,48 @@ async def list_models(db: AsyncSession = Depends(get_db)):
     return result.scalars().all()
 
 
+@router.get("/catalog")
+async def get_local_catalog():
+    catalog = get_catalog()
+    return {**catalog.stats(), "entries": catalog.entries()}
+
+
+@router.get("/cache")
+async def get_cache():
+    return await asyncio.to_thread(cache.stats)
+
+
+@router.get("/downloads")
+async def list_downloads():
+    return [job.progress() for job in downloads.jobs()]
+
+
+@router.get("/downloads/{job_id}")
+async def get_download(job_id: str):
+    job = downloads.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Download job not found")
+    return job.progress()
+
+
+@router.delete("/downloads/{job_id}")
+async def cancel_download(job_id: str):
+    job = downloads.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Download job not found")
+    job.cancel()
+    return job.progress()
+
+
+@router.post("/{model_id}/download")
+async def download_model(model_id: int, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(Model).where(Model.id == model_id))
+    model = result.scalar_one_or_none()
+    if not model:
+        raise HTTPException(status_code=404, detail="Model not found")
+    return downloads.submit(model.huggin_face_refference, model.model_name).progress()
+
+
 @router.get("/{model_id}", response_model=model_schema.ModelInDB)
 async def get_model(model_id: int, db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(Model).where(Model.id == model_id))
@@ -50,13 +100,17 @@ async def update_model(model_id: int, model_data: model_schema.ModelUpdate, db:
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model not found")
 
+    reference_changed = model_data.huggin_face_refference != model.huggin_face_refference
     for key, value in model_data.dict().items():
         setattr(model, key, value)
 
-    try:
-        model.size = get_model_size_from_huggingface(model.huggin_face_refference)
-    except HuggingFaceModelNotFound as e:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if reference_changed or not model.size:
+        try:
+            model.size = await get_model_size_from_huggingface(model.huggin_face_refference, model.model_name)
+        except HuggingFaceModelNotFound as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        except HuggingFaceAPIError as e:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=str(e))
 
     await db.commit()
     await db.refresh(model)
@@ -71,22 +125,16 @@ async def delete_model(model_id: int, db: AsyncSession = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Model not found")
     await db.delete(model)
     await db.commit()
-    return {"ok": True}
-
-
-class HuggingFaceModelNotFound(Exception):
-    pass
-
-def get_model_size_from_huggingface(hf_reference: str) -> str:
-    response = requests.get(f"https://huggingface.co/api/models/{hf_reference}")
-    if response.status_code == 404:
-        raise HuggingFaceModelNotFound(f"Model '{hf_reference}' not found on Hugging Face")
-    if response.status_code != 200:
-        raise Exception("Unexpected error accessing Hugging Face API")
-    
-    data = response.json()
-    size_bytes = data.get("modelSize", {}).get("size", None)
-    if size_bytes:
-        size_gb = round(size_bytes / (1024**3), 2)
-        return f"{size_gb} GB"
-    return "unknown"
+
+    # Free the weights too, unless another row or a loaded preset (as draft) still uses them.
+    await asyncio.to_thread(pool.stop, model.id)
+    result = await db.execute(select(Model).where(Model.model_name == model.model_name))
+    if result.scalars().first() or model.model_name in pool.model_names():
+        return {"ok": True, "files_deleted": False}
+    job = downloads.find(model.model_name)
+    if job:
+        job.cancel()
+        await asyncio.to_thread(job.wait)
+    files_deleted = await asyncio.to_thread(delete_local_model, model.model_name)
+    return {"ok": True, "files_deleted": files_deleted}
+
@@ -7,19 +7,31 @@ from app.schemas import preset as preset_schema
 from app.models.preset import Preset
 from app.db.database import get_db
 from app.models.model import Model
+from app.services.model_storage import PREFETCH_ON_CREATE, downloads
 
 router = APIRouter()
 
 @router.post("/", response_model=preset_schema.PresetInDB)
-async def create_preset(preset: preset_schema.PresetCreate, db: AsyncSession = Depends(get_db)):
+async def create_preset(preset: preset_schema.PresetCreate, prefetch: bool = PREFETCH_ON_CREATE, db: AsyncSession = Depends(get_db)):
     model_result = await db.execute(select(Model).where(Model.id == preset.model_id))
-    if not model_result.scalar_one_or_none():
+    model = model_result.scalar_one_or_none()
+    if not model:
         raise HTTPException(status_code=404, detail="Model with given ID not found")
 
+    draft = None
+    if preset.draft_model_id is not None:
+        draft_result = await db.execute(select(Model).where(Model.id == preset.draft_model_id))
+        draft = draft_result.scalar_one_or_none()
+        if not draft:
+            raise HTTPException(status_code=404, detail="Draft model with given ID not found")
+
     db_preset = Preset(**preset.dict())
     db.add(db_preset)
     await db.commit()
     await db.refresh(db_preset)
+    if prefetch:
+        for m in filter(None, [model, draft]):
+            downloads.submit(m.huggin_face_refference, m.model_name, prefetch=True)
     return db_preset
 
 
@@ -49,6 +61,11 @@ async def update_preset(preset_id: int, preset_data: preset_schema.PresetUpdate,
     if not model_result.scalar_one_or_none():
         raise HTTPException(status_code=404, detail="Model with given ID not found")
 
+    if preset_data.draft_model_id is not None:
+        draft_result = await db.execute(select(Model).where(Model.id == preset_data.draft_model_id))
+        if not draft_result.scalar_one_or_none():
+            raise HTTPException(status_code=404, detail="Draft model with given ID not found")
+
     for key, value in preset_data.dict().items():
         setattr(preset, key, value)
     await db.commit()
@@ -3,7 +3,11 @@ from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from app.api import presets, models, inference
-from app.db.database import Base, engine
+from app.db.database import Base, add_missing_columns, engine
+from app.services.hf_utils import hf_client
+from app.services.model_pool import pool
+from app.services.response_cache import response_cache
+from app.services.workers import shutdown_worker_pool
 
 
 app = FastAPI()
@@ -18,6 +22,15 @@ origins = [
 async def on_startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    pool.stop()
+    shutdown_worker_pool()
+    response_cache.save()
+    await hf_client.close()
 
 
 app.add_middleware(
@@ -8,3 +8,6 @@ class Model(Base):
     model_name = Column(String, nullable=False)
     huggin_face_refference = Column(String, nullable=False)
     size = Column(String, nullable=True)
+    load_profile = Column(String, default="fp32", nullable=False, server_default="fp32")
+    # Seconds without requests before the model is unloaded; NULL uses MODEL_IDLE_TIMEOUT, 0 never.
+    idle_timeout = Column(Integer, nullable=True)
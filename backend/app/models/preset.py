@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float
+from sqlalchemy import JSON, Column, Integer, String, ForeignKey, Float
 from sqlalchemy.orm import relationship
 
 from app.db.database import Base
@@ -13,10 +13,19 @@ class Preset(Base):
     task = Column(String(32000), default="", nullable=True)
     costraints = Column(String(32000), default="", nullable=True)
     model_id = Column(Integer, ForeignKey("models.id"))
+    # Optional small model sharing the tokenizer, used for speculative decoding.
+    draft_model_id = Column(Integer, ForeignKey("models.id"), nullable=True)
 
     temperature = Column(Float, default=1.2)
     repetition_penalty = Column(Float, default=1.0)
     top_p = Column(Float, default=0.9)
     top_k = Column(Float, default=20.0)
+    # "sample", or "greedy"/"seeded" for reproducible replies that can be served from the response cache.
+    decoding = Column(String, default="sample", nullable=False, server_default="sample")
+    seed = Column(Integer, nullable=True)
+    # Reply length limit (None: the server default) and extra ways for a reply to end.
+    max_new_tokens = Column(Integer, nullable=True)
+    stop_strings = Column(JSON, nullable=True)
+    stop_token_ids = Column(JSON, nullable=True)
 
-    model = relationship("Model")
+    model = relationship("Model", foreign_keys=[model_id])
@@ -1,18 +1,25 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Annotated, Literal, Optional
+
+
+# Also the name of the model's directory under local_models/: a single path
+# component, not hidden (staging and bookkeeping live in dot-directories).
+ModelName = Annotated[str, Field(pattern=r"^[^./\\\x00][^/\\\x00]*$")]
 
 
 class ModelBase(BaseModel):
     model_name: str
     huggin_face_refference: str
+    load_profile: Literal["fp32", "bf16", "int8"] = "fp32"
+    idle_timeout: Optional[int] = None
 
 
 class ModelCreate(ModelBase):
-    pass
+    model_name: ModelName
 
 
 class ModelUpdate(ModelBase):
-    pass
+    model_name: ModelName
 
 
 class ModelInDB(ModelBase):
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 
 class PresetBase(BaseModel):
     public_name: str
@@ -7,11 +7,17 @@ class PresetBase(BaseModel):
     task: Optional[str] = ""
     costraints: Optional[str] = ""
     model_id: int
+    draft_model_id: Optional[int] = None
 
     temperature: Optional[float] = 1.2
     repetition_penalty: Optional[float] = 1.0
     top_p: Optional[float] = 0.9
     top_k: Optional[float] = 20.0
+    decoding: Literal["sample", "greedy", "seeded"] = "sample"
+    seed: Optional[int] = None
+    max_new_tokens: Optional[int] = Field(None, ge=1)
+    stop_strings: Optional[List[str]] = None
+    stop_token_ids: Optional[List[int]] = None
 
 class PresetCreate(PresetBase):
     pass
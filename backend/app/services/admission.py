@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Generations that may run at once across all connections; the rest wait in line.
+MAX_ACTIVE_GENERATIONS = int(os.getenv("MAX_ACTIVE_GENERATIONS", 8))
+# Requests that may wait; beyond this new ones are rejected as busy.
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", 64))
+MAX_QUEUED_PER_CLIENT = int(os.getenv("MAX_QUEUED_PER_CLIENT", 4))
+# Prompts up to this many characters go to the short lane, which is served first...
+SHORT_PROMPT_CHARS = int(os.getenv("SHORT_PROMPT_CHARS", 500))
+# ...except that every Nth admission while long prompts wait is a long one.
+LONG_LANE_EVERY = int(os.getenv("LONG_LANE_EVERY", 4))
+QUEUE_UPDATE_INTERVAL = 0.5
+WAIT_SAMPLES = 1000
+
+SHORT_LANE = "short"
+LONG_LANE = "long"
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, client_id: str, lane: str):
+        self.client_id = client_id
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.holds_slot = False
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @property
+    def admitted(self) -> bool:
+        return self.granted.done() and not self.granted.cancelled() and self.granted.result()
+
+
+class _Lane:
+    """Waiting tickets per client, served round-robin across clients."""
+
+    def __init__(self):
+        self.clients: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(tickets) for tickets in self.clients.values())
+
+    def push(self, ticket: Ticket):
+        self.clients.setdefault(ticket.client_id, deque()).append(ticket)
+
+    def pop(self) -> Ticket:
+        client_id, tickets = next(iter(self.clients.items()))
+        ticket = tickets.popleft()
+        del self.clients[client_id]
+        if tickets:
+            self.clients[client_id] = tickets  # to the back of the round
+        return ticket
+
+    def remove(self, ticket: Ticket) -> bool:
+        tickets = self.clients.get(ticket.client_id)
+        if not tickets or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del self.clients[ticket.client_id]
+        return True
+
+    def ahead(self, ticket: Ticket) -> int:
+        """Tickets this lane serves before `ticket` in round-robin order."""
+        order = list(self.clients)
+        index = self.clients[ticket.client_id].index(ticket)
+        position = order.index(ticket.client_id)
+        count = 0
+        for i, client_id in enumerate(order):
+            queued = len(self.clients[client_id])
+            count += min(queued, index)
+            if i < position and queued > index:
+                count += 1
+        return count
+
+
+class AdmissionController:
+    """
+    Bounded concurrency for generation requests. Waiting requests are kept in
+    two lanes (short and long prompts) and served round-robin per client, so
+    one client cannot monopolise the slots and long prompts cannot starve
+    short ones, nor the other way round. When the queue is full new requests
+    are rejected instead of waiting without bound.
+    """
+
+    def __init__(
+        self,
+        max_active: int = MAX_ACTIVE_GENERATIONS,
+        max_queued: int = MAX_QUEUED_REQUESTS,
+        max_queued_per_client: int = MAX_QUEUED_PER_CLIENT,
+        short_prompt_chars: int = SHORT_PROMPT_CHARS,
+    ):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_queued_per_client = max_queued_per_client
+        self.short_prompt_chars = short_prompt_chars
+        self.active = 0
+        self.lanes: Dict[str, _Lane] = {SHORT_LANE: _Lane(), LONG_LANE: _Lane()}
+        self.admitted = 0
+        self.rejected = 0
+        self._short_streak = 0
+        self._waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def lane_for(self, prompt: str) -> str:
+        return SHORT_LANE if len(prompt) <= self.short_prompt_chars else LONG_LANE
+
+    def position(self, ticket: Ticket) -> int:
+        """1-based place in line; long-lane tickets also count every short one."""
+        ahead = self.lanes[ticket.lane].ahead(ticket)
+        if ticket.lane == LONG_LANE:
+            ahead += len(self.lanes[SHORT_LANE])
+        return ahead + 1
+
+    def enqueue(self, client_id: str, prompt: str) -> Ticket:
+        """Admits the request at once if a slot is free, else puts it in line; raises AdmissionRejected when full."""
+        ticket = Ticket(client_id, self.lane_for(prompt))
+        if self.active < self.max_active and not self.queued:
+            self._admit(ticket)
+            return ticket
+
+        client_queued = sum(len(lane.clients.get(client_id, ())) for lane in self.lanes.values())
+        if self.queued >= self.max_queued or client_queued >= self.max_queued_per_client:
+            self.rejected += 1
+            raise AdmissionRejected("Server busy, try again later.")
+        self.lanes[ticket.lane].push(ticket)
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket: Ticket, on_position: Callable[[int], Awaitable[None]] = None) -> bool:
+        """
+        Waits until the ticket is admitted (True) or withdrawn (False),
+        awaiting on_position whenever its place in line changes. An admitted
+        ticket must be released.
+        """
+        try:
+            last_position = None
+            while not ticket.granted.done():
+                position = self.position(ticket)
+                if on_position is not None and position != last_position:
+                    await on_position(position)
+                    last_position = position
+                await asyncio.wait({ticket.granted}, timeout=QUEUE_UPDATE_INTERVAL)
+        except BaseException:
+            self.release(ticket)
+            self.withdraw(ticket)
+            raise
+        return ticket.admitted
+
+    async def acquire(self, client_id: str, prompt: str, on_position: Callable[[int], Awaitable[None]] = None) -> Ticket:
+        ticket = self.enqueue(client_id, prompt)
+        await self.wait(ticket, on_position)
+        return ticket
+
+    def _admit(self, ticket: Ticket):
+        self.active += 1
+        self.admitted += 1
+        ticket.holds_slot = True
+        ticket.admitted_at = time.monotonic()
+        self._waits.append(ticket.admitted_at - ticket.enqueued_at)
+        ticket.granted.set_result(True)
+
+    def _dispatch(self):
+        while self.active < self.max_active and self.queued:
+            short, long = self.lanes[SHORT_LANE], self.lanes[LONG_LANE]
+            if len(short) and (not len(long) or self._short_streak < LONG_LANE_EVERY - 1):
+                self._short_streak += 1
+                self._admit(short.pop())
+            else:
+                self._short_streak = 0
+                self._admit(long.pop())
+
+    def release(self, ticket: Ticket):
+        if not ticket.holds_slot:
+            return
+        ticket.holds_slot = False
+        self.active -= 1
+        self._dispatch()
+
+    def withdraw(self, ticket: Ticket):
+        """Takes a waiting ticket out of line (client went away or stopped the request)."""
+        if self.lanes[ticket.lane].remove(ticket) and not ticket.granted.done():
+            ticket.granted.set_result(False)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1) if waits else None
+
+        return {
+            "max_active": self.max_active,
+            "max_queued": self.max_queued,
+            "active": self.active,
+            "queued": {name: len(lane) for name, lane in self.lanes.items()},
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_wait_ms": {"p50": percentile(0.5), "p99": percentile(0.99)},
+        }
+
+
+# Singleton instance
+admission = AdmissionController()
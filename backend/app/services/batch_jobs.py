@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from app.services.stopping import generation_stats
+
+logger = logging.getLogger(__name__)
+
+
+BATCH_JOBS_DIR = Path(os.getenv("BATCH_JOBS_DIR", "./batch_jobs"))
+# Prompts prefilled and decoded together; kept below the scheduler's batch size
+# so interactive requests still find room in the running batch.
+BATCH_BUCKET_SIZE = int(os.getenv("BATCH_BUCKET_SIZE", 8))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100000))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 64 * 1024 ** 2))
+MAX_FINISHED_BATCH_JOBS = 100
+
+
+class BatchInputError(Exception):
+    pass
+
+
+def read_items(path: Path) -> List[dict]:
+    """
+    Items of a JSONL input: one {"prompt": ..., "id": ...} object (id optional)
+    or bare JSON string per line. Blank lines are skipped.
+    """
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise BatchInputError(f"Line {number}: invalid JSON ({e})")
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not isinstance(item, dict) or not isinstance(item.get("prompt"), str) or not item["prompt"].strip():
+                raise BatchInputError(f"Line {number}: expected a non-empty \"prompt\" string")
+            items.append({"id": item.get("id", len(items)), "prompt": item["prompt"]})
+            if len(items) > BATCH_MAX_ITEMS:
+                raise BatchInputError(f"More than {BATCH_MAX_ITEMS} prompts")
+    if not items:
+        raise BatchInputError("No prompts in input")
+    return items
+
+
+def make_buckets(items: List[dict], bucket_size: int) -> List[List[dict]]:
+    # Neighbours by length pad each other the least. Character length stands in
+    # for token length since the tokenizer may live in a worker process.
+    ordered = sorted(items, key=lambda item: len(item["prompt"]))
+    return [ordered[i:i + bucket_size] for i in range(0, len(ordered), bucket_size)]
+
+
+class BatchJob:
+    def __init__(self, model_id: int, preset: dict, root: Path):
+        self.id = uuid.uuid4().hex[:12]
+        self.model_id = model_id
+        self.preset = preset
+        self.input_path = root / f"{self.id}.input.jsonl"
+        self.output_path = root / f"{self.id}.output.jsonl"
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        # Parsed by check_input and kept for the run, so the input is read once.
+        self.items: Optional[List[dict]] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done = threading.Event()
+        self._cancelled = threading.Event()
+
+    @property
+    def active(self) -> bool:
+        return not self.done.is_set()
+
+    def cancel(self):
+        """Stops the job after the bucket being generated."""
+        self._cancelled.set()
+        if self.status == "loading":
+            self._complete("cancelled")
+
+    def fail(self, error: str):
+        self._complete("failed", error)
+
+    def _complete(self, status: str, error: str = None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.time()
+        self.done.set()
+
+    def progress(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        return {
+            "id": self.id,
+            "model_id": self.model_id,
+            "preset_id": self.preset.get("id"),
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "elapsed_s": round(elapsed, 3),
+            "items_per_s": round(self.completed / elapsed, 2) if elapsed else None,
+        }
+
+
+class BatchJobManager:
+    """
+    Offline generation over JSONL files. Jobs run one at a time on a
+    background thread: prompts are sorted by length, cut into buckets that
+    are prefilled as one padded batch each, and every finished item is
+    appended to the job's output JSONL with its timings.
+    """
+
+    def __init__(self, root: Path = BATCH_JOBS_DIR, bucket_size: int = BATCH_BUCKET_SIZE):
+        self.root = root
+        self.bucket_size = bucket_size
+        self._jobs: Dict[str, BatchJob] = {}
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def create(self, model_id: int, preset: dict) -> BatchJob:
+        """A new job with an empty input file for the caller to fill before start()."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        job = BatchJob(model_id, preset, self.root)
+        with self._lock:
+            finished = [j for j in self._jobs.values() if not j.active]
+            for old in finished[:max(0, len(finished) - MAX_FINISHED_BATCH_JOBS)]:
+                self._jobs.pop(old.id, None)
+            self._jobs[job.id] = job
+        return job
+
+    def check_input(self, job: BatchJob):
+        """Parses the job's prompts; a bad input fails the job and raises BatchInputError."""
+        try:
+            job.items = read_items(job.input_path)
+        except BatchInputError as e:
+            self.reject(job, str(e))
+            raise
+        job.total = len(job.items)
+
+    def reject(self, job: BatchJob, error: str):
+        """Fails a job whose input was not accepted and drops the input file."""
+        job.fail(error)
+        job.input_path.unlink(missing_ok=True)
+
+    def start(self, job: BatchJob, get_runtime: Callable):
+        """Queues the job; get_runtime() returns the model's runtime, or None once it is unloaded."""
+        with self._lock:
+            self._queue.put((job, get_runtime))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name="batch-jobs", daemon=True)
+                self._thread.start()
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> List[BatchJob]:
+        return list(self._jobs.values())
+
+    def _work(self):
+        while True:
+            job, get_runtime = self._queue.get()
+            try:
+                self._run(job, get_runtime)
+            except Exception as e:
+                logger.exception(f"Batch job {job.id} failed")
+                job.fail(str(e))
+
+    def _run(self, job: BatchJob, get_runtime: Callable):
+        if job._cancelled.is_set():
+            if job.active:
+                job._complete("cancelled")
+            return
+        job.status = "running"
+        job.started_at = time.time()
+        items = job.items if job.items is not None else read_items(job.input_path)
+        job.items = None
+        started = time.monotonic()
+        with open(job.output_path, "w", encoding="utf-8") as output:
+            for bucket in make_buckets(items, self.bucket_size):
+                if job._cancelled.is_set():
+                    job._complete("cancelled")
+                    return
+                runtime = get_runtime()
+                if runtime is None:
+                    job.fail("Model was unloaded")
+                    return
+                # Time the bucket waited behind earlier ones since the job started.
+                queue_ms = round((time.monotonic() - started) * 1000, 1)
+                try:
+                    results = runtime.generate_batch([item["prompt"] for item in bucket], job.preset)
+                except RuntimeError as e:
+                    results = [{"finish_reason": "error", "error": str(e)}] * len(bucket)
+
+                for item, result in zip(bucket, results):
+                    generation_stats.record(result)
+                    output.write(json.dumps({"id": item["id"], "queue_ms": queue_ms, **result}) + "\n")
+                    if result.get("finish_reason") in ("stop", "length"):
+                        job.completed += 1
+                    else:
+                        job.failed += 1
+                output.flush()
+        logger.info(f"Batch job {job.id}: {job.completed} completed, {job.failed} failed")
+        job._complete("completed")
+
+
+# Singleton instance
+batch_jobs = BatchJobManager()
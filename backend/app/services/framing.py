@@ -0,0 +1,195 @@
+import asyncio
+import json
+import math
+import struct
+import time
+from typing import AsyncIterator, Optional, Union
+
+from fastapi import WebSocket
+
+
+TEXT_PROTOCOL = "text"
+JSON_PROTOCOL = "json"
+BINARY_PROTOCOL = "binary"
+
+# Sec-WebSocket-Protocol names a client may offer instead of ?protocol=
+SUBPROTOCOLS = {
+    "llm.json": JSON_PROTOCOL,
+    "llm.binary": BINARY_PROTOCOL,
+}
+
+DEFAULT_FLUSH_MS = 30
+DEFAULT_FLUSH_TOKENS = 16
+MAX_FLUSH_MS = 10_000
+# The binary header stores a frame's token count in 16 bits.
+MAX_FLUSH_TOKENS = 0xFFFF
+
+END_SENTINEL = "__END__"
+
+# Binary frames: version, kind, request id, number of coalesced pieces, then a UTF-8 payload
+# (token text for data frames, JSON metadata for end/queued frames, the message for error frames).
+BINARY_HEADER = struct.Struct("!BBIH")
+BINARY_VERSION = 1
+FRAME_DATA = 1
+FRAME_END = 2
+FRAME_ERROR = 3
+FRAME_QUEUED = 4
+
+Frame = Union[str, bytes]
+
+
+def negotiate_protocol(websocket: WebSocket) -> tuple:
+    """Returns (protocol, subprotocol to accept with)."""
+    for offered in websocket.scope.get("subprotocols", []):
+        if offered in SUBPROTOCOLS:
+            return SUBPROTOCOLS[offered], offered
+    protocol = websocket.query_params.get("protocol", TEXT_PROTOCOL)
+    if protocol not in (TEXT_PROTOCOL, JSON_PROTOCOL, BINARY_PROTOCOL):
+        protocol = TEXT_PROTOCOL
+    return protocol, None
+
+
+def flush_settings(websocket: WebSocket) -> tuple:
+    """Returns (flush_ms, flush_tokens) from the query string, clamped; unusable values fall back to the defaults."""
+    try:
+        flush_ms = float(websocket.query_params.get("flush_ms", DEFAULT_FLUSH_MS))
+    except ValueError:
+        flush_ms = DEFAULT_FLUSH_MS
+    if not math.isfinite(flush_ms):
+        flush_ms = DEFAULT_FLUSH_MS
+    try:
+        flush_tokens = int(websocket.query_params.get("flush_tokens", DEFAULT_FLUSH_TOKENS))
+    except ValueError:
+        flush_tokens = DEFAULT_FLUSH_TOKENS
+    return min(max(flush_ms, 0.0), MAX_FLUSH_MS), min(max(flush_tokens, 1), MAX_FLUSH_TOKENS)
+
+
+class StreamFramer:
+    """
+    Turns a token stream into WebSocket frames.
+
+    The text protocol is the original one (a frame per token plus "__END__");
+    the json and binary protocols coalesce tokens into one frame every
+    flush_ms milliseconds or flush_tokens tokens, whichever comes first,
+    and finish with a frame carrying the request metadata.
+    """
+
+    def __init__(
+        self,
+        protocol: str = TEXT_PROTOCOL,
+        flush_ms: float = DEFAULT_FLUSH_MS,
+        flush_tokens: int = DEFAULT_FLUSH_TOKENS,
+    ):
+        self.protocol = protocol
+        self.flush_ms = flush_ms
+        self.flush_tokens = min(flush_tokens, MAX_FLUSH_TOKENS)
+        self.request_id = 0
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    @property
+    def coalescing(self) -> bool:
+        return self.protocol != TEXT_PROTOCOL
+
+    def start(self, request_id: int):
+        self.request_id = request_id
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def time_to_flush(self) -> Optional[float]:
+        if not self.coalescing or not self._buffer:
+            return None
+        elapsed = time.monotonic() - self._last_flush
+        return max(0.0, self.flush_ms / 1000 - elapsed)
+
+    def add(self, token: str) -> Optional[Frame]:
+        if not self.coalescing:
+            return token
+        self._buffer.append(token)
+        if len(self._buffer) >= self.flush_tokens or self.time_to_flush() == 0:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[Frame]:
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return None
+        text, count = "".join(self._buffer), len(self._buffer)
+        self._buffer = []
+        if self.protocol == BINARY_PROTOCOL:
+            return BINARY_HEADER.pack(BINARY_VERSION, FRAME_DATA, self.request_id, count) + text.encode("utf-8")
+        return json.dumps({"id": self.request_id, "t": text, "n": count}, separators=(",", ":"))
+
+    def end(self, metadata: dict) -> Frame:
+        if self.protocol == BINARY_PROTOCOL:
+            payload = json.dumps(metadata, separators=(",", ":")).encode("utf-8")
+            return BINARY_HEADER.pack(BINARY_VERSION, FRAME_END, self.request_id, 0) + payload
+        if self.protocol == JSON_PROTOCOL:
+            return json.dumps({"id": self.request_id, "done": True, **metadata}, separators=(",", ":"))
+        return END_SENTINEL
+
+    def error(self, message: str, busy: bool = False) -> Frame:
+        if self.protocol == BINARY_PROTOCOL:
+            return BINARY_HEADER.pack(BINARY_VERSION, FRAME_ERROR, self.request_id, 0) + message.encode("utf-8")
+        if self.protocol == JSON_PROTOCOL:
+            frame = {"id": self.request_id, "error": message}
+            if busy:
+                frame["busy"] = True
+            return json.dumps(frame, separators=(",", ":"))
+        return message
+
+    def queued(self, position: int) -> Optional[Frame]:
+        """Place in line while waiting for a generation slot; the text protocol has no such frame."""
+        if self.protocol == BINARY_PROTOCOL:
+            payload = json.dumps({"position": position}, separators=(",", ":")).encode("utf-8")
+            return BINARY_HEADER.pack(BINARY_VERSION, FRAME_QUEUED, self.request_id, 0) + payload
+        if self.protocol == JSON_PROTOCOL:
+            return json.dumps({"id": self.request_id, "queued": position}, separators=(",", ":"))
+        return None
+
+
+async def framed(tokens: AsyncIterator[str], framer: StreamFramer) -> AsyncIterator[Frame]:
+    """
+    Yields the frames for one token stream, flushing on the framer's timer
+    even while no new token arrives. The end sentinel of the stream is
+    swallowed; callers send framer.end() themselves.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        async for token in tokens:
+            if token != END_SENTINEL:
+                await queue.put(token)
+        await queue.put(None)
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                token = await asyncio.wait_for(queue.get(), framer.time_to_flush())
+            except asyncio.TimeoutError:
+                frame = framer.flush()
+                if frame is not None:
+                    yield frame
+                continue
+
+            if token is None:
+                break
+            frame = framer.add(token)
+            if frame is not None:
+                yield frame
+
+        frame = framer.flush()
+        if frame is not None:
+            yield frame
+        await task
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def send_frame(websocket: WebSocket, frame: Frame):
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
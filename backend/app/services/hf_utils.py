@@ -1,19 +1,156 @@
-import requests
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import httpx
+
+from app.services import model_storage
+
+logger = logging.getLogger(__name__)
+
+
+HF_API_TIMEOUT = float(os.getenv("HF_API_TIMEOUT", 10))
+# Seconds a cached repo metadata entry is served without asking the Hub again.
+HF_METADATA_TTL = int(os.getenv("HF_METADATA_TTL", 24 * 3600))
+HF_METADATA_CACHE = Path(os.getenv("HF_METADATA_CACHE", "./hf_metadata_cache.json"))
+
+# Only these fields of /api/models/{repo} are kept in the cache.
+CACHED_FIELDS = ("id", "sha", "usedStorage", "lastModified", "safetensors")
+
 
 class HuggingFaceModelNotFound(Exception):
     pass
 
-def get_model_size_from_huggingface(hf_reference: str) -> str:
-    response = requests.get(f"https://huggingface.co/api/models/{hf_reference}")
-    if response.status_code == 404:
-        raise HuggingFaceModelNotFound(f"Model '{hf_reference}' not found on Hugging Face")
-    if response.status_code != 200:
-        raise Exception("Unexpected error accessing Hugging Face API")
-    
-    data = response.json()
-    size_bytes = data.get("usedStorage", {})
-    if size_bytes:
-        size_gb = round(size_bytes / (1024**3), 2)
-        return f"{size_gb} GB"
-    return "unknown"
 
+class HuggingFaceAPIError(Exception):
+    pass
+
+
+def format_size(size_bytes: int) -> str:
+    size_gb = round(size_bytes / (1024**3), 2)
+    return f"{size_gb} GB"
+
+
+def local_model_size(model_name: str) -> Optional[int]:
+    path = model_storage.MODEL_DIR / model_name
+    if not path.is_dir():
+        return None
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+class HuggingFaceClient:
+    """
+    Async client for Hub repo metadata with a pooled connection, timeouts and
+    a TTL cache persisted to disk. Stale entries are still served when the
+    Hub cannot be reached.
+    """
+
+    def __init__(self, endpoint: str = None, ttl: int = HF_METADATA_TTL, cache_path: Path = HF_METADATA_CACHE):
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.requests = 0
+        self._cache: Optional[Dict[str, dict]] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _http(self) -> httpx.AsyncClient:
+        # The pool belongs to the event loop it was created on.
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            headers = {"Authorization": f"Bearer {model_storage.HF_TOKEN}"} if model_storage.HF_TOKEN else {}
+            self._client = httpx.AsyncClient(
+                base_url=self.endpoint or model_storage.HF_ENDPOINT,
+                headers=headers,
+                timeout=HF_API_TIMEOUT,
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            )
+            self._client_loop = loop
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _load_cache(self) -> Dict[str, dict]:
+        if self._cache is None:
+            try:
+                self._cache = json.loads(self.cache_path.read_text())
+            except (OSError, ValueError):
+                self._cache = {}
+        return self._cache
+
+    def _save_cache(self):
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self._cache))
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Could not persist Hugging Face metadata cache: {e}")
+
+    async def model_info(self, hf_reference: str) -> dict:
+        entry = self._load_cache().get(hf_reference)
+        if entry and time.time() - entry["fetched_at"] < self.ttl:
+            return entry["data"]
+
+        # Concurrent lookups of the same repo share one request.
+        task = self._inflight.get(hf_reference)
+        if task is None or task.done():
+            task = self._inflight[hf_reference] = asyncio.ensure_future(self._fetch(hf_reference))
+        try:
+            return await asyncio.shield(task)
+        except HuggingFaceAPIError:
+            if entry:
+                logger.warning(f"Hugging Face API unavailable, using cached metadata for {hf_reference}")
+                return entry["data"]
+            raise
+        finally:
+            if task.done() and self._inflight.get(hf_reference) is task:
+                self._inflight.pop(hf_reference)
+
+    async def _fetch(self, hf_reference: str) -> dict:
+        self.requests += 1
+        try:
+            response = await self._http().get(f"/api/models/{hf_reference}")
+        except httpx.HTTPError as e:
+            raise HuggingFaceAPIError(f"Hugging Face API request failed: {e}") from e
+        if response.status_code == 404:
+            raise HuggingFaceModelNotFound(f"Model '{hf_reference}' not found on Hugging Face")
+        if response.status_code != 200:
+            raise HuggingFaceAPIError(f"Unexpected error accessing Hugging Face API ({response.status_code})")
+
+        data = response.json()
+        data = {key: data[key] for key in CACHED_FIELDS if key in data}
+        self._load_cache()[hf_reference] = {"fetched_at": time.time(), "data": data}
+        self._save_cache()
+        return data
+
+    async def get_model_size(self, hf_reference: str, model_name: str = None) -> str:
+        try:
+            data = await self.model_info(hf_reference)
+        except HuggingFaceAPIError:
+            local_size = local_model_size(model_name) if model_name else None
+            if local_size is None:
+                raise
+            logger.warning(f"Hugging Face API unavailable, sizing {model_name} from local files")
+            return format_size(local_size)
+
+        size_bytes = data.get("usedStorage")
+        if size_bytes:
+            return format_size(size_bytes)
+        return "unknown"
+
+
+# Singleton instance
+hf_client = HuggingFaceClient()
+
+
+async def get_model_size_from_huggingface(hf_reference: str, model_name: str = None) -> str:
+    return await hf_client.get_model_size(hf_reference, model_name)
@@ -0,0 +1,60 @@
+from typing import List, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+
+# Past key/values are kept in "legacy" form between steps: one (key, value)
+# pair per layer, each shaped [batch, heads, seq_len, head_dim].
+LegacyCache = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def to_legacy(cache) -> LegacyCache:
+    if cache is None:
+        return []
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "to_legacy_cache"):
+        return list(cache.to_legacy_cache())
+    return [(k, v) for k, v in cache]
+
+
+def from_legacy(legacy: LegacyCache) -> DynamicCache:
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(legacy))
+    return DynamicCache(legacy)
+
+
+def seq_length(legacy: LegacyCache) -> int:
+    if not legacy:
+        return 0
+    return legacy[0][0].shape[2]
+
+
+def nbytes(legacy: LegacyCache) -> int:
+    return sum(k.nelement() * k.element_size() + v.nelement() * v.element_size() for k, v in legacy)
+
+
+def left_pad(legacy: LegacyCache, length: int) -> LegacyCache:
+    pad = length - seq_length(legacy)
+    if pad <= 0:
+        return legacy
+    return [(F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))) for k, v in legacy]
+
+
+def concat_batch(first: LegacyCache, second: LegacyCache) -> LegacyCache:
+    length = max(seq_length(first), seq_length(second))
+    first, second = left_pad(first, length), left_pad(second, length)
+    return [
+        (torch.cat([k1, k2], dim=0), torch.cat([v1, v2], dim=0))
+        for (k1, v1), (k2, v2) in zip(first, second)
+    ]
+
+
+def select_batch(legacy: LegacyCache, indices: torch.Tensor) -> LegacyCache:
+    return [(k.index_select(0, indices), v.index_select(0, indices)) for k, v in legacy]
+
+
+def slice_positions(legacy: LegacyCache, start: int, end: int = None) -> LegacyCache:
+    return [(k[:, :, start:end], v[:, :, start:end]) for k, v in legacy]
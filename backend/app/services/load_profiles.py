@@ -0,0 +1,123 @@
+import hashlib
+import importlib.util
+import logging
+import os
+from pathlib import Path
+
+import torch
+import transformers
+from transformers import AutoModelForCausalLM
+
+logger = logging.getLogger(__name__)
+
+
+# fp32 weights are always float32 in memory. They are memory-mapped when the
+# checkpoint stores float32; half precision checkpoints are read and converted.
+FP32 = "fp32"
+BF16 = "bf16"
+INT8 = "int8"
+LOAD_PROFILES = (FP32, BF16, INT8)
+DEFAULT_LOAD_PROFILE = FP32
+
+# Where int8 models are kept once quantized, so later loads skip the fp32 read and quantization.
+QUANTIZED_CACHE_DIR = Path(os.getenv("QUANTIZED_CACHE_DIR", "./quantized_cache"))
+
+WEIGHT_SUFFIXES = {".safetensors", ".bin", ".pt", ".pth"}
+
+# With accelerate installed, from_pretrained builds the modules on the meta
+# device and streams checkpoint tensors into them (optionally straight onto
+# the GPU) instead of allocating random weights first and copying over them.
+LOW_CPU_MEM_USAGE = importlib.util.find_spec("accelerate") is not None
+
+
+class LoadProfileError(Exception):
+    pass
+
+
+def artifact_key(model_path: str, profile: str) -> str:
+    """Changes whenever the source weights or the libraries that pickled the artifact change."""
+    digest = hashlib.sha256(f"{profile}|{torch.__version__}|{transformers.__version__}".encode())
+    for file in sorted(Path(model_path).iterdir()):
+        if file.is_file() and file.suffix in WEIGHT_SUFFIXES:
+            stat = file.stat()
+            digest.update(f"|{file.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+def artifact_path(model_path: str, profile: str) -> Path:
+    return QUANTIZED_CACHE_DIR / Path(model_path).name / f"{profile}-{artifact_key(model_path, profile)}.pt"
+
+
+def quantize_int8(model):
+    # Dynamic quantization of every nn.Linear except the output head, which is
+    # usually tied to the embeddings and is where quantization drifts the most.
+    head = model.get_output_embeddings()
+    targets = {
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and module is not head
+    }
+    if not targets:
+        logger.warning("Model has no nn.Linear layers to quantize; int8 profile keeps fp32 weights")
+        return model
+    return torch.ao.quantization.quantize_dynamic(model, targets, dtype=torch.qint8)
+
+
+def load_int8(model_path: str):
+    path = artifact_path(model_path, INT8)
+    if path.exists():
+        try:
+            logger.info(f"Loading cached int8 model from {path}")
+            return torch.load(path, weights_only=False)
+        except Exception as e:
+            logger.warning(f"Cached int8 model {path} is unusable, quantizing again: {e}")
+
+    model = quantize_int8(from_pretrained(model_path, torch.float32))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for stale in path.parent.glob(f"{INT8}-*.pt"):
+        stale.unlink()
+    tmp = path.with_suffix(".tmp")
+    torch.save(model, tmp)
+    os.replace(tmp, path)
+    return model
+
+
+def from_pretrained(model_path: str, dtype: torch.dtype, device: torch.device = None):
+    kwargs = {"torch_dtype": dtype}
+    if LOW_CPU_MEM_USAGE:
+        kwargs["low_cpu_mem_usage"] = True
+        if device is not None and device.type != "cpu":
+            kwargs["device_map"] = {"": device}
+    model = AutoModelForCausalLM.from_pretrained(model_path, **kwargs)
+    model.requires_grad_(False)
+    model.eval()
+    return model
+
+
+def load_with_profile(model_path: str, profile: str = DEFAULT_LOAD_PROFILE, device: torch.device = None):
+    """Loads the model in the given profile; weights land on `device` directly when possible."""
+    if profile not in LOAD_PROFILES:
+        raise LoadProfileError(f"Unknown load profile '{profile}', expected one of {LOAD_PROFILES}")
+    if profile == INT8:
+        return load_int8(model_path)
+    dtype = torch.bfloat16 if profile == BF16 else torch.float32
+    return from_pretrained(model_path, dtype, device)
+
+
+def model_nbytes(model) -> int:
+    """Bytes held by the model's weights, including quantized packed weights that are not parameters."""
+    seen = set()
+    total = 0
+
+    def add(value):
+        nonlocal total
+        if isinstance(value, (tuple, list)):
+            for item in value:
+                add(item)
+        elif isinstance(value, torch.Tensor) and (value.data_ptr(), value.nbytes) not in seen:
+            seen.add((value.data_ptr(), value.nbytes))
+            total += value.nbytes
+
+    for value in model.state_dict().values():
+        add(value)
+    return total
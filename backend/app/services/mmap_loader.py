@@ -0,0 +1,156 @@
+import json
+import logging
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+logger = logging.getLogger(__name__)
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class MmapLoadError(Exception):
+    pass
+
+
+def safetensors_files(model_path: str) -> List[Path]:
+    path = Path(model_path)
+    index = path / "model.safetensors.index.json"
+    if index.exists():
+        weight_map = json.loads(index.read_text())["weight_map"]
+        return [path / name for name in sorted(set(weight_map.values()))]
+    single = path / "model.safetensors"
+    return [single] if single.exists() else []
+
+
+def mmap_safetensors(file: Path) -> Dict[str, torch.Tensor]:
+    """
+    Maps a safetensors file copy-on-write and returns tensors that are views
+    into the mapping. Pages stay shared through the page cache between every
+    process that maps the same file, as long as nobody writes to them.
+    """
+    with open(file, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+
+    size = file.stat().st_size
+    storage = torch.UntypedStorage.from_file(str(file), shared=False, nbytes=size)
+    raw = torch.empty(0, dtype=torch.uint8).set_(storage)
+    data_start = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None:
+            raise MmapLoadError(f"Unsupported dtype {info['dtype']} for {name}")
+        begin, end = info["data_offsets"]
+        chunk = raw[data_start + begin:data_start + end]
+        try:
+            tensor = chunk.view(dtype)
+        except RuntimeError:
+            # Misaligned for this dtype; this one tensor has to be copied.
+            tensor = chunk.clone().view(dtype)
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors
+
+
+# Threads currently building a model whose parameters go on the meta device.
+_meta_construction = threading.local()
+_patch_lock = threading.Lock()
+_register_parameter = torch.nn.Module.register_parameter
+
+
+def _register_parameter_maybe_on_meta(module, name, param):
+    _register_parameter(module, name, param)
+    if param is not None and getattr(_meta_construction, "depth", 0):
+        module._parameters[name] = type(param)(param.to("meta"), requires_grad=False)
+
+
+@contextmanager
+def parameters_on_meta():
+    # Buffers are still created for real: non-persistent ones (e.g. rotary
+    # frequencies) are not in the checkpoint. The hook is installed once and
+    # only acts on the threads inside this block, so concurrent loads (and
+    # modules built elsewhere meanwhile) are unaffected.
+    with _patch_lock:
+        if torch.nn.Module.register_parameter is not _register_parameter_maybe_on_meta:
+            torch.nn.Module.register_parameter = _register_parameter_maybe_on_meta
+    _meta_construction.depth = getattr(_meta_construction, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _meta_construction.depth -= 1
+
+
+def load_mmap_model(model_path: str, dtype: torch.dtype = torch.float32):
+    """
+    Builds the model around tensors mapped from its safetensors files. Mapped
+    weights cannot be converted without copying them, so a checkpoint whose
+    floating point tensors are not stored in `dtype` is refused.
+    """
+    files = safetensors_files(model_path)
+    if not files:
+        raise MmapLoadError(f"No safetensors weights in {model_path}")
+
+    config = AutoConfig.from_pretrained(model_path)
+    with parameters_on_meta():
+        model = AutoModelForCausalLM.from_config(config)
+
+    expected = set(model.state_dict().keys())
+    prefix = f"{model.base_model_prefix}."
+    state_dict = {}
+    for file in files:
+        for name, tensor in mmap_safetensors(file).items():
+            if name not in expected:
+                if prefix + name in expected:
+                    name = prefix + name
+                elif name.startswith(prefix) and name[len(prefix):] in expected:
+                    name = name[len(prefix):]
+            if tensor.is_floating_point() and tensor.dtype != dtype:
+                raise MmapLoadError(f"{name} is stored as {tensor.dtype}, not {dtype}")
+            state_dict[name] = tensor
+
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise MmapLoadError(f"Weights missing from checkpoint: {missing[:5]}")
+
+    model.requires_grad_(False)
+    model.eval()
+    return model
+
+
+def memory_report() -> dict:
+    """Resident vs shared memory of the current process, from /proc/self/smaps_rollup (kB)."""
+    report = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty"):
+                    report[key.lower() + "_kb"] = int(value.split()[0])
+    except OSError:
+        return {}
+    report["shared_kb"] = report.get("shared_clean_kb", 0) + report.get("shared_dirty_kb", 0)
+    report["private_kb"] = report.get("private_clean_kb", 0) + report.get("private_dirty_kb", 0)
+    return report
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+CATALOG_FILE = "catalog.json"
+# Every downloaded file is also hard-linked here under its sha256, so identical
+# shards of different models share one copy on disk.
+BLOBS_DIR_NAME = ".blobs"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link(source: Path, destination: Path):
+    # Link next to the destination first so an existing file is swapped atomically.
+    tmp = destination.with_name(destination.name + ".link")
+    tmp.unlink(missing_ok=True)
+    os.link(source, tmp)
+    os.replace(tmp, destination)
+
+
+class ModelCatalog:
+    """
+    Index of the models under a storage root: for each model its Hub
+    reference, revision, files (size and sha256), total size and when it was
+    downloaded and last used. Reads are served from memory; every change is
+    written back to <root>/catalog.json.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._entries: Optional[Dict[str, dict]] = None
+        self._lock = threading.RLock()
+
+    @property
+    def path(self) -> Path:
+        return self.root / CATALOG_FILE
+
+    @property
+    def blobs_dir(self) -> Path:
+        return self.root / BLOBS_DIR_NAME
+
+    def _models(self) -> Dict[str, dict]:
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self.path.read_text())["models"]
+            except (OSError, ValueError, KeyError):
+                self._entries = {}
+                self._rebuild()
+        return self._entries
+
+    def _rebuild(self):
+        # Models downloaded before the catalog existed are indexed by size only.
+        if self.root.is_dir():
+            for directory in self.root.iterdir():
+                if directory.is_dir() and not directory.name.startswith("."):
+                    self._entries[directory.name] = self._scan(directory)
+        self._save()
+
+    def _save(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"models": self._entries}, indent=1))
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _scan(directory: Path) -> dict:
+        files = {
+            str(f.relative_to(directory)): {"size": f.stat().st_size, "sha256": None}
+            for f in directory.rglob("*") if f.is_file()
+        }
+        now = time.time()
+        return {
+            "hf_reference": None,
+            "revision": None,
+            "files": files,
+            "size_bytes": sum(f["size"] for f in files.values()),
+            "added_at": now,
+            "last_used": now,
+        }
+
+    def __contains__(self, model_name: str) -> bool:
+        with self._lock:
+            return model_name in self._models()
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return list(self._models())
+
+    def get(self, model_name: str) -> Optional[dict]:
+        with self._lock:
+            return self._models().get(model_name)
+
+    def entries(self) -> Dict[str, dict]:
+        with self._lock:
+            return dict(self._models())
+
+    def add(self, model_name: str, hf_reference: str, revision: str, files: Dict[str, dict]):
+        now = time.time()
+        with self._lock:
+            self._models()[model_name] = {
+                "hf_reference": hf_reference,
+                "revision": revision,
+                "files": files,
+                "size_bytes": sum(f["size"] or 0 for f in files.values()),
+                "added_at": now,
+                "last_used": now,
+            }
+            self._save()
+
+    def adopt(self, model_name: str):
+        """Indexes a model directory that was put under the root by other means."""
+        with self._lock:
+            self._models()[model_name] = self._scan(self.root / model_name)
+            self._save()
+
+    def remove(self, model_name: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._models().pop(model_name, None)
+            if entry is not None:
+                self._save()
+            return entry
+
+    def touch(self, model_name: str):
+        with self._lock:
+            entry = self._models().get(model_name)
+            if entry is not None:
+                entry["last_used"] = time.time()
+                self._save()
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.blobs_dir / sha256
+
+    def link_blob(self, sha256: str, destination: Path, size: Optional[int] = None) -> bool:
+        """Hard-links a stored blob to destination; False if there is no such blob."""
+        blob = self.blob_path(sha256)
+        try:
+            if size is not None and blob.stat().st_size != size:
+                return False
+            _link(blob, destination)
+        except OSError:
+            return False
+        return True
+
+    def store_blob(self, path: Path, sha256: str):
+        """Makes path share its inode with the blob for sha256, creating the blob if needed."""
+        blob = self.blob_path(sha256)
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            if blob.exists():
+                if not os.path.samefile(blob, path):
+                    _link(blob, path)
+            else:
+                os.link(path, blob)
+        except FileExistsError:
+            _link(blob, path)
+        except OSError as e:
+            # e.g. a filesystem without hard links: keep the private copy.
+            logger.warning(f"Could not deduplicate {path}: {e}")
+
+    def collect_garbage(self) -> int:
+        """Deletes blobs no model links to any more; returns the bytes freed."""
+        freed = 0
+        if not self.blobs_dir.is_dir():
+            return freed
+        for blob in self.blobs_dir.iterdir():
+            stat = blob.stat()
+            if stat.st_nlink <= 1:
+                freed += stat.st_size
+                blob.unlink()
+        return freed
+
+    def disk_bytes(self) -> int:
+        """Bytes actually used by the indexed models, counting shared inodes once."""
+        seen = set()
+        total = 0
+        for model_name, entry in self.entries().items():
+            for name in entry["files"]:
+                try:
+                    stat = (self.root / model_name / name).stat()
+                except OSError:
+                    continue
+                if (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_size
+        return total
+
+    def verify(self, model_name: str) -> List[str]:
+        """Files of a model that are missing or whose content no longer matches the index."""
+        entry = self.get(model_name)
+        if entry is None:
+            return []
+        bad = []
+        for name, info in entry["files"].items():
+            path = self.root / model_name / name
+            if not path.is_file() or path.stat().st_size != info["size"]:
+                bad.append(name)
+            elif info["sha256"] and sha256_file(path) != info["sha256"]:
+                bad.append(name)
+        return bad
+
+    def stats(self) -> dict:
+        entries = self.entries()
+        logical = sum(entry["size_bytes"] for entry in entries.values())
+        disk = self.disk_bytes()
+        return {
+            "models": len(entries),
+            "logical_bytes": logical,
+            "disk_bytes": disk,
+            "deduplicated_bytes": logical - disk,
+        }
@@ -0,0 +1,414 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from app.models.model import Model as DBModel
+from app.models.preset import Preset as DBPreset
+from app.services.model_runtime import ModelRuntime
+from app.services.model_storage import cache
+from app.services.workers import INFERENCE_WORKERS, RemoteRuntime, get_worker_pool
+
+logger = logging.getLogger(__name__)
+
+
+# RAM that resident models may use together before the least recently used is unloaded.
+MODEL_POOL_BUDGET = int(os.getenv("MODEL_POOL_BUDGET", 16 * 1024 ** 3))
+
+# How long a replaced or evicted model may keep finishing its in-flight
+# requests before it is stopped anyway.
+SWAP_DRAIN_TIMEOUT = float(os.getenv("SWAP_DRAIN_TIMEOUT", 300))
+DRAIN_POLL_INTERVAL = 0.2
+
+# Seconds without requests after which a model is unloaded (0 = never); a
+# model's own idle_timeout overrides it. The next request reloads it from disk.
+MODEL_IDLE_TIMEOUT = float(os.getenv("MODEL_IDLE_TIMEOUT", 0))
+IDLE_CHECK_INTERVAL = float(os.getenv("IDLE_CHECK_INTERVAL", 5))
+MAX_FINISHED_LOAD_JOBS = 100
+
+
+def create_runtime():
+    if INFERENCE_WORKERS > 0:
+        return RemoteRuntime(get_worker_pool())
+    return ModelRuntime()
+
+
+def _weight_names(model: DBModel, draft_path: str = None) -> List[str]:
+    names = [model.model_name]
+    if draft_path:
+        names.append(Path(draft_path).name)
+    return names
+
+
+class LoadJob:
+    """Handle for a model load running in the background (downloads included)."""
+
+    def __init__(self, model_id: int, preset_id: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.model_id = model_id
+        self.preset_id = preset_id
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.result: Optional[dict] = None
+        self.downloads = []
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.done = threading.Event()
+
+    @property
+    def active(self) -> bool:
+        return not self.done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.done.wait(timeout)
+
+    def finish(self, result: dict):
+        self.result = result
+        self._complete("completed")
+
+    def fail(self, error: str):
+        self.error = error
+        self._complete("failed")
+
+    def _complete(self, status: str):
+        self.status = status
+        self.finished_at = time.time()
+        self.done.set()
+
+    def progress(self) -> dict:
+        return {
+            "id": self.id,
+            "model_id": self.model_id,
+            "preset_id": self.preset_id,
+            "status": self.status,
+            "error": self.error,
+            "downloads": [job.progress() for job in self.downloads if job.active],
+            "elapsed_s": round((self.finished_at or time.time()) - self.created_at, 3),
+        }
+
+
+class ModelPool:
+    """
+    Loaded models by id. Loads are blue/green: the new runtime is built while
+    every loaded model keeps serving, then becomes the default in one step.
+    Models that are replaced or evicted finish their in-flight requests
+    before they are stopped.
+    """
+
+    def __init__(self, budget_bytes: int = MODEL_POOL_BUDGET):
+        self.budget_bytes = budget_bytes
+        self._runtimes: "OrderedDict[int, ModelRuntime]" = OrderedDict()
+        self._last_used = {}
+        self._lock = threading.RLock()
+        self.default_model_id: Optional[int] = None
+        self.evictions = 0
+        self._loading: Dict[int, threading.Event] = {}
+        self._retiring: List[ModelRuntime] = []
+        self._jobs: Dict[str, LoadJob] = {}
+        # Arguments each runtime was loaded with, kept for models unloaded while idle.
+        self._load_args: Dict[int, tuple] = {}
+        self._asleep: Dict[int, tuple] = {}
+        self._idle_timeouts: Dict[int, float] = {}
+        self._updating: Dict[int, threading.Lock] = {}
+        # Weights being read by a load or preset update in progress, by model id.
+        self._reading: Dict[int, List[str]] = {}
+        self._reaper: Optional[threading.Thread] = None
+
+    def load_job(self, model_id: int, preset_id: int) -> Tuple[LoadJob, bool]:
+        """The active job loading this model and preset, or a new one (second value True)."""
+        with self._lock:
+            for job in self._jobs.values():
+                if job.active and (job.model_id, job.preset_id) == (model_id, preset_id):
+                    return job, False
+            finished = [job for job in self._jobs.values() if not job.active]
+            for job in finished[:max(0, len(finished) - MAX_FINISHED_LOAD_JOBS)]:
+                self._jobs.pop(job.id, None)
+            job = LoadJob(model_id, preset_id)
+            self._jobs[job.id] = job
+            return job, True
+
+    def get_job(self, job_id: str) -> Optional[LoadJob]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> List[LoadJob]:
+        return list(self._jobs.values())
+
+    def __contains__(self, model_id: int) -> bool:
+        with self._lock:
+            return model_id in self._runtimes
+
+    def get(self, model_id: int) -> Optional[ModelRuntime]:
+        with self._lock:
+            runtime = self._runtimes.get(model_id)
+            if runtime is not None:
+                self._touch(model_id)
+            return runtime
+
+    def default(self) -> Optional[ModelRuntime]:
+        if self.default_model_id is None:
+            return None
+        return self.get(self.default_model_id)
+
+    def wake(self, model_id: int = None) -> Optional[ModelRuntime]:
+        """
+        Reloads a model unloaded for being idle (the default one if no id is
+        given). Returns None if its weights were evicted from disk meanwhile;
+        the model stays asleep so the caller can download them again.
+        """
+        model_id = self.default_model_id if model_id is None else model_id
+        with self._lock:
+            args = self._asleep.get(model_id)
+        if args is None:
+            return self.get(model_id)
+        missing = [path for path in args[2:] if path and not Path(path).exists()]
+        if missing:
+            logger.warning(f"Cannot reload idle model {model_id} from disk: {missing[0]} is gone")
+            return None
+        logger.info(f"Reloading idle model {model_id}")
+        self.load(*args, make_default=model_id == self.default_model_id)
+        return self.get(model_id)
+
+    def asleep(self, model_id: int = None) -> Optional[Tuple[DBModel, DBPreset]]:
+        """The model and preset a sleeping model (the default one if no id is given) was loaded with."""
+        model_id = self.default_model_id if model_id is None else model_id
+        with self._lock:
+            args = self._asleep.get(model_id)
+        return args[:2] if args else None
+
+    def load(
+        self, model: DBModel, preset: DBPreset, model_path: str = None, draft_path: str = None, make_default: bool = True
+    ) -> dict:
+        """Loads the model, or updates its preset if it is resident; make_default=False leaves the default model alone."""
+        while True:
+            with self._lock:
+                runtime = self._runtimes.get(model.id)
+                loading = self._loading.get(model.id)
+                if runtime is None and loading is None:
+                    self._loading[model.id] = threading.Event()
+                    self._reading[model.id] = _weight_names(model, draft_path)
+                    break
+            if runtime is not None:
+                return self._update_preset(model, runtime, preset, draft_path, make_default)
+            # Someone else is loading this model; use theirs.
+            loading.wait()
+
+        # Built outside the lock so every loaded model keeps serving meanwhile; the
+        # budget is enforced once it is in, so the pool briefly holds both models.
+        try:
+            runtime = create_runtime()
+            result = runtime.load_model(model, preset, model_path, draft_path)
+        except BaseException:
+            with self._lock:
+                self._loading.pop(model.id).set()
+                self._reading.pop(model.id, None)
+            raise
+
+        with self._lock:
+            self._loading.pop(model.id).set()
+            self._reading.pop(model.id, None)
+            self._runtimes[model.id] = runtime
+            self._touch(model.id)
+            if make_default:
+                self.default_model_id = model.id
+            self._load_args[model.id] = (model, preset, model_path, draft_path)
+            self._asleep.pop(model.id, None)
+            idle_timeout = getattr(model, "idle_timeout", None)
+            self._idle_timeouts[model.id] = MODEL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+            if self._idle_timeouts[model.id] > 0:
+                self._start_reaper()
+            self._make_room(0, keep=model.id)
+        return result
+
+    def _update_preset(
+        self, model: DBModel, runtime: ModelRuntime, preset: DBPreset, draft_path: str = None, make_default: bool = True
+    ) -> dict:
+        # May load a draft model and prefill the new prefix (a broadcast to
+        # every worker in worker mode), so it runs outside the pool lock;
+        # updates of the same model are applied one at a time. A load that
+        # does not make the model the default keeps its default preset and
+        # only attaches a draft, so other clients' replies do not change.
+        if not make_default and not draft_path:
+            return self._updated(model, runtime, make_default)
+        with self._lock:
+            updating = self._updating.setdefault(model.id, threading.Lock())
+        with updating:
+            with self._lock:
+                self._reading[model.id] = _weight_names(model, draft_path)
+            try:
+                runtime.update_preset(preset if make_default else None, draft_path)
+            finally:
+                with self._lock:
+                    self._reading.pop(model.id, None)
+        with self._lock:
+            if self._runtimes.get(model.id) is runtime:
+                args = self._load_args[model.id]
+                self._load_args[model.id] = (model, preset if make_default else args[1], args[2], draft_path)
+        return self._updated(model, runtime, make_default)
+
+    def _updated(self, model: DBModel, runtime: ModelRuntime, make_default: bool) -> dict:
+        with self._lock:
+            if self._runtimes.get(model.id) is runtime:
+                self._touch(model.id)
+                if make_default:
+                    self.default_model_id = model.id
+        return {
+            "status": "preset updated",
+            "model": runtime.active_model,
+            "preset": runtime.preset
+        }
+
+    def unload_idle(self) -> List[int]:
+        """Unloads the models that have had no requests for their idle timeout."""
+        unloaded = []
+        stopping = []
+        with self._lock:
+            now = time.time()
+            for model_id, runtime in list(self._runtimes.items()):
+                timeout = self._idle_timeouts.get(model_id)
+                if not timeout:
+                    continue
+                if runtime.in_flight():
+                    # A long generation is activity too; idle time starts when it ends.
+                    self._last_used[model_id] = now
+                    continue
+                if now - self._last_used.get(model_id, now) >= timeout:
+                    logger.info(f"Model {model_id} idle for {timeout}s, unloading it")
+                    stopping.append(self._unload(model_id, sleep=True))
+                    unloaded.append(model_id)
+        self._stop_runtimes(stopping)
+        return unloaded
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, name="model-idle-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(IDLE_CHECK_INTERVAL)
+            try:
+                self.unload_idle()
+            except Exception:
+                logger.exception("Unloading idle models failed")
+
+    def stop(self, model_id: int = None) -> dict:
+        with self._lock:
+            model_ids = list(self._runtimes) if model_id is None else [model_id]
+            stopping = [self._unload(key) for key in model_ids]
+            if model_id is None:
+                self._asleep.clear()
+            else:
+                self._asleep.pop(model_id, None)
+        self._stop_runtimes(stopping)
+        return {"status": "stopped"}
+
+    def model_names(self) -> set:
+        """
+        Names of the models whose weights are loaded, being loaded, or will be
+        reloaded when an idle model wakes up, drafts included.
+        """
+        with self._lock:
+            names = set()
+            for runtime in list(self._runtimes.values()) + self._retiring:
+                if not runtime.active_model:
+                    continue
+                names.add(runtime.active_model["model_name"])
+                if runtime.active_model.get("draft_model"):
+                    names.add(Path(runtime.active_model["draft_model"]).name)
+            for reading in self._reading.values():
+                names.update(reading)
+            for model, _, _, draft_path in self._asleep.values():
+                names.update(_weight_names(model, draft_path))
+            return names
+
+    def used_bytes(self) -> int:
+        with self._lock:
+            return sum(runtime.memory_footprint() for runtime in self._runtimes.values())
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self.used_bytes(),
+                "evictions": self.evictions,
+                "default_model_id": self.default_model_id,
+                "loading": list(self._loading),
+                "asleep": list(self._asleep),
+                "retiring": len(self._retiring),
+                "models": [
+                    {
+                        "id": model_id,
+                        "model_name": runtime.active_model["model_name"],
+                        "preset_id": runtime.preset.get("id"),
+                        "footprint_bytes": runtime.memory_footprint(),
+                        "load_timings": runtime.active_model.get("load_timings"),
+                        "idle_timeout": self._idle_timeouts.get(model_id),
+                        "last_used": self._last_used.get(model_id),
+                    }
+                    for model_id, runtime in self._runtimes.items()
+                ],
+            }
+
+    def _touch(self, model_id: int):
+        self._runtimes.move_to_end(model_id)
+        self._last_used[model_id] = time.time()
+
+    def _make_room(self, incoming_bytes: int, keep: int = None):
+        while self.used_bytes() + incoming_bytes > self.budget_bytes:
+            candidates = [model_id for model_id in self._runtimes if model_id != keep]
+            if not candidates:
+                break
+            logger.info(f"Model pool over budget, unloading model {candidates[0]}")
+            self._unload(candidates[0], drain=True)
+            self.evictions += 1
+
+    def _unload(self, model_id: int, drain: bool = False, sleep: bool = False) -> Optional[ModelRuntime]:
+        """
+        Takes a model out of the pool. A draining runtime is stopped once its
+        requests finish; otherwise it is returned for the caller to stop after
+        releasing the lock (stopping joins the scheduler and frees memory).
+        """
+        runtime = self._runtimes.pop(model_id, None)
+        self._last_used.pop(model_id, None)
+        self._updating.pop(model_id, None)
+        load_args = self._load_args.pop(model_id, None)
+        if sleep and load_args is not None:
+            # An idle default stays the default; wake() brings it back.
+            self._asleep[model_id] = load_args
+        elif self.default_model_id == model_id:
+            self.default_model_id = next(reversed(self._runtimes), None)
+        if runtime is None or not drain:
+            return runtime
+        self._retiring.append(runtime)
+        threading.Thread(target=self._retire, args=(runtime,), name=f"retire-model-{model_id}", daemon=True).start()
+        return None
+
+    @staticmethod
+    def _stop_runtimes(runtimes: List[Optional[ModelRuntime]]):
+        for runtime in runtimes:
+            if runtime is not None:
+                runtime.stop_model()
+
+    def _retire(self, runtime: ModelRuntime):
+        # No new requests reach the runtime; let the ones it has finish, then free it.
+        deadline = time.monotonic() + SWAP_DRAIN_TIMEOUT
+        while True:
+            # Sleep first: a caller may have looked the runtime up just before it was removed.
+            time.sleep(DRAIN_POLL_INTERVAL)
+            if runtime.in_flight() == 0 or time.monotonic() > deadline:
+                break
+        if runtime.in_flight():
+            logger.warning(f"Stopping model {runtime.active_model['model_name']} with requests still running")
+        runtime.stop_model()
+        with self._lock:
+            self._retiring.remove(runtime)
+
+
+# Singleton instance
+pool = ModelPool()
+# Weights the pool has loaded are never evicted from disk.
+cache.register_in_use(pool.model_names)
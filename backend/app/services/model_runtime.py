@@ -1,43 +1,133 @@
+import ctypes
+import gc
 import logging
+import os
+import time
+from typing import List, Optional
 from app.models.model import Model as DBModel
 from app.models.preset import Preset as DBPreset
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+from app.services.load_profiles import DEFAULT_LOAD_PROFILE, FP32, INT8, load_with_profile, model_nbytes
+from app.services.mmap_loader import MmapLoadError, load_mmap_model
+from app.services.prefix_cache import CachedPrefix, PrefixCache
+from app.services.prompt_template import PromptTemplate
+from app.services.scheduler import DEFAULT_MAX_NEW_TOKENS, BatchScheduler, GenerationRequest
+from app.services.sessions import ChatSession, sessions
+from app.services.speculative import SpeculativeState
+from transformers import AsyncTextIteratorStreamer, AutoTokenizer, TextIteratorStreamer
 import torch
-import threading
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# "mmap" maps safetensors weights copy-on-write so every process loading the
+# same model shares its pages; "copy" reads them into private memory.
+WEIGHT_LOAD_MODE = os.getenv("WEIGHT_LOAD_MODE", "copy")
+
+# Greedy tokens generated right after loading so the first real request does
+# not pay for lazy initialisation (allocator, kernels, caches); 0 disables it.
+LOAD_WARMUP_TOKENS = int(os.getenv("LOAD_WARMUP_TOKENS", 4))
+WARMUP_MESSAGE = "Hello"
+
+
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    # glibc keeps freed heap pages mapped in the process; hand them back to the OS.
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class _NullStreamer:
+    def put(self, value):
+        pass
+
+    def end(self):
+        pass
+
+
+def preset_to_dict(preset: DBPreset) -> dict:
+    return {
+        "id": getattr(preset, "id", None),
+        "bot_name": preset.bot_name,
+        "task": preset.task,
+        "costraints": preset.costraints,
+        "temperature": preset.temperature,
+        "repetition_penalty": preset.repetition_penalty,
+        "top_p": preset.top_p,
+        "top_k": preset.top_k,
+        "draft_model_id": getattr(preset, "draft_model_id", None),
+        "decoding": getattr(preset, "decoding", None) or "sample",
+        "seed": getattr(preset, "seed", None),
+        "max_new_tokens": getattr(preset, "max_new_tokens", None),
+        "stop_strings": list(getattr(preset, "stop_strings", None) or []),
+        "stop_token_ids": list(getattr(preset, "stop_token_ids", None) or []),
+    }
+
+
 class ModelRuntime:
     def __init__(self):
         self.active_model = None
         self.preset = None
         self.tokenizer = None
         self.model = None
+        self.scheduler = None
+        self.prefix_cache = None
+        self.prompts = None
+        self.draft_model = None
+        self.draft_path = None
+        self.draft_vocab_size = None
 
-    def load_model(self, model: DBModel, preset: DBPreset, model_path: str):
+    def load_model(self, model: DBModel, preset: DBPreset, model_path: str, draft_path: str = None):
         logger.debug(f"Loading model from path: {model_path}")
         self.active_model = {
             "id": model.id,
             "model_name": model.model_name,
             "reference": model.huggin_face_refference,
             "size": model.size,
-            "path": model_path
-        }
-        self.preset = {
-            "bot_name": preset.bot_name,
-            "task": preset.task,
-            "costraints": preset.costraints,
-            "temperature": preset.temperature,
-            "repetition_penalty": preset.repetition_penalty,
-            "top_p": preset.top_p,
-            "top_k": preset.top_k,
+            "path": model_path,
+            "load_profile": getattr(model, "load_profile", None) or DEFAULT_LOAD_PROFILE,
         }
+        self.preset = preset_to_dict(preset)
 
 
+        if self.scheduler:
+            self.scheduler.shutdown()
+
+        # Phases: read (tokenizer and weights), materialize (device placement,
+        # scheduler, preset prefix, draft) and warmup (a short generation).
+        started = time.monotonic()
+        timings = {}
+        # Dynamically quantized layers only run on CPU.
+        use_cuda = torch.cuda.is_available() and self.active_model["load_profile"] != INT8
+        device = torch.device("cuda" if use_cuda else "cpu")
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        self.model = AutoModelForCausalLM.from_pretrained(model_path)
+        self.model = self._load_weights(model_path, device)
+        timings["read_s"] = time.monotonic() - started
+
+        phase = time.monotonic()
+        # Placed once here; everything later follows self.model.device.
+        # Cached prefixes live on the model's device, so place it before warming them.
+        self.model.to(device)
+        self.scheduler = BatchScheduler(self.model, self.tokenizer)
+        self.prefix_cache = PrefixCache(self.model, self.tokenizer)
+        self.prompts = PromptTemplate(self.tokenizer, self.scheduler.max_positions)
+        self._prefix()
+        self.draft_model = self.draft_path = self.draft_vocab_size = None
+        self._set_draft(draft_path)
+        timings["materialize_s"] = time.monotonic() - phase
+
+        phase = time.monotonic()
+        first_token_at = self._warmup()
+        timings["warmup_s"] = time.monotonic() - phase
+        # Cold start: from the start of the load until the first token could be streamed.
+        timings["first_token_s"] = (first_token_at or time.monotonic()) - started
+        timings["total_s"] = time.monotonic() - started
+        self.active_model["load_timings"] = {key: round(value, 3) for key, value in timings.items()}
+        logger.info(f"Loaded {self.active_model['model_name']}: {self.active_model['load_timings']}")
 
         return {
             "status": "loaded",
@@ -45,75 +135,296 @@ class ModelRuntime:
             "preset": self.preset
         }
     
-    def update_preset(self, preset: DBPreset):
-        self.preset = {
-            "bot_name": preset.bot_name,
-            "task": preset.task,
-            "costraints": preset.costraints,
-            "temperature": preset.temperature,
-            "repetition_penalty": preset.repetition_penalty,
-            "top_p": preset.top_p,
-            "top_k": preset.top_k,
-        }
+    def _warmup(self):
+        """Runs a short greedy generation; returns when its first token was produced."""
+        if LOAD_WARMUP_TOKENS <= 0:
+            return None
+        prefix = self._prefix()
+        input_ids = self.prompts.message_ids(WARMUP_MESSAGE, self.prompts.prompt_budget(LOAD_WARMUP_TOKENS) - len(prefix.input_ids))
+        speculation = SpeculativeState(self.draft_model, self.draft_vocab_size) if self.draft_model is not None else None
+        request = self.scheduler.submit(GenerationRequest(
+            input_ids,
+            {"max_new_tokens": LOAD_WARMUP_TOKENS, "do_sample": False},
+            _NullStreamer(),
+            prefix=prefix,
+            speculation=speculation,
+        ))
+        request.done.wait()
+        return request.first_token_at
+
+    def _load_weights(self, model_path: str, device: torch.device):
+        profile = self.active_model["load_profile"]
+        # Mapped pages only help on CPU; moving to a GPU copies them anyway.
+        # Converted profiles own their weights, so they cannot be mapped either.
+        if WEIGHT_LOAD_MODE == "mmap" and profile == FP32 and not torch.cuda.is_available():
+            try:
+                model = load_mmap_model(model_path, torch.float32)
+                self.active_model["load_mode"] = "mmap"
+                return model
+            except MmapLoadError as e:
+                logger.warning(f"Memory-mapped load failed, reading weights instead: {e}")
+        self.active_model["load_mode"] = "copy"
+        return load_with_profile(model_path, profile, device)
+
+    def update_preset(self, preset: Optional[DBPreset], draft_path: str = None):
+        """Replaces the default preset (None keeps it) and the draft model."""
+        if preset is not None:
+            self.preset = preset_to_dict(preset)
+            if self.prefix_cache:
+                self._prefix()
+        self._set_draft(draft_path)
+
+    def _set_draft(self, draft_path: str = None):
+        if draft_path == self.draft_path:
+            return
+        # Requests already decoding keep a reference to the draft they started with.
+        self.draft_model = self.draft_path = self.draft_vocab_size = None
+        self.active_model["draft_model"] = None
+        if not draft_path:
+            return
+
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_path)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            logger.warning(f"Draft model {draft_path} has a different tokenizer, decoding without it")
+            return
+        draft_model = load_with_profile(draft_path, FP32, self.model.device)
+        draft_model.to(self.model.device)
+
+        self.draft_model = draft_model
+        self.draft_path = draft_path
+        self.draft_vocab_size = min(
+            self.model.get_output_embeddings().out_features,
+            draft_model.get_output_embeddings().out_features,
+        )
+        self.active_model["draft_model"] = draft_path
+
+    def build_prompt_prefix(self, preset: dict = None) -> str:
+        # Everything up to the user message; its KV cache is reused across requests.
+        preset = preset or self.preset
+        return self.prompts.prefix(preset, self._sampling_params(preset)["max_new_tokens"])
+
+    def _prefix(self, preset: dict = None) -> CachedPrefix:
+        return self.prefix_cache.warm(self.build_prompt_prefix(preset), self.prompts.prefix_special_tokens)
+
+    def warm_prefix(self, preset: dict = None):
+        """Prefills the preset's prompt prefix so that submitting with it is cheap."""
+        if self.prefix_cache:
+            self._prefix(preset)
 
     def get_current_model_info(self):
         if not self.active_model:
             return None
         return {
             "id": self.active_model.get("id"),
-            "model_name": self.active_model.get("model_name")
+            "model_name": self.active_model.get("model_name"),
+            "load_timings": self.active_model.get("load_timings"),
         }
 
 
+    def in_flight(self) -> int:
+        return self.scheduler.in_flight() if self.scheduler else 0
+
+    def memory_footprint(self) -> int:
+        if not self.model:
+            return 0
+        footprint = model_nbytes(self.model)
+        if self.draft_model is not None:
+            footprint += model_nbytes(self.draft_model)
+        if self.prefix_cache:
+            footprint += self.prefix_cache.nbytes()
+        return footprint
+
     def stop_model(self):
+        if self.scheduler:
+            self.scheduler.shutdown()
+        if self.prefix_cache:
+            self.prefix_cache.clear()
+        self.scheduler = None
+        self.prefix_cache = None
+        self.prompts = None
         self.active_model = None
         self.preset = None
         self.tokenizer = None
         self.model = None
+        self.draft_model = self.draft_path = self.draft_vocab_size = None
+
+        release_memory()
         return {"status": "stopped"}
 
-    def generate_stream(self, message: str):
+    def _session_turn(self, session: ChatSession, prefix: CachedPrefix, message: str, max_new_tokens: int):
+        context = (self.active_model["id"], prefix.key)
+        if session.context != context:
+            session.reset(context)
+
+        budget = self.prompts.prompt_budget(max_new_tokens)
+        message_ids = self.prompts.message_ids(message, budget - len(prefix.input_ids))
+        if session.tokens:
+            # The oldest turns give way when the conversation outgrows the window.
+            length = len(session.tokens) + len(session.pending) + len(self.prompts.between_ids) + len(message_ids)
+            if length > budget and not sessions.drop_turns(session, length - budget, len(prefix.input_ids)):
+                session.reset(context)
+        if not session.tokens:
+            session.turn_start = len(prefix.input_ids)
+            return prefix, message_ids
+
+        turn_ids = session.pending + self.prompts.between_ids + message_ids
+        session.turn_start = len(session.tokens) + len(turn_ids) - len(message_ids)
+        past = session.past()
+        if past is not None:
+            return past, turn_ids
+
+        # The session cache was evicted: re-prefill the history on top of the preset prefix.
+        history = session.tokens
+        if history[:len(prefix.input_ids)] == prefix.input_ids:
+            return prefix, history[len(prefix.input_ids):] + turn_ids
+        return None, history + turn_ids
+
+    def submit(self, message: str, streamer, session: ChatSession = None, preset: dict = None) -> GenerationRequest:
+        """
+        Queues a generation. `preset` (as from preset_to_dict) is the caller's
+        own persona and sampling settings; without it the runtime's default
+        preset is used. Requests with different presets share one batch.
+        """
         if not self.active_model or not self.preset:
-            yield "Model not loaded."
-            return
+            raise RuntimeError("Model not loaded.")
 
-        if not self.tokenizer or not self.model:
-            yield "Model/tokenizer not initialized."
-            return
+        if not self.tokenizer or not self.model or not self.scheduler:
+            raise RuntimeError("Model/tokenizer not initialized.")
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(device)
+        preset = preset or self.preset
+        params = self._sampling_params(preset)
+        prefix = self._prefix(preset)
+        if session is None:
+            budget = self.prompts.prompt_budget(params["max_new_tokens"]) - len(prefix.input_ids)
+            input_ids = self.prompts.message_ids(message, budget)
+        else:
+            prefix, input_ids = self._session_turn(session, prefix, message, params["max_new_tokens"])
 
-        prompt = f"###You are {self.preset['bot_name']}\
-        Your task is to: {self.preset['task']}\n\
-        Constraints for you to follow: {self.preset['costraints']}!!!###\n\
-        User Message: {message}"
+        speculation = None
+        # Speculative acceptance draws its own random numbers, which a fixed seed does not cover.
+        if self.draft_model is not None and preset.get("draft_model_id") is not None and "seed" not in params:
+            speculation = SpeculativeState(self.draft_model, self.draft_vocab_size)
 
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(device)
+        return self.scheduler.submit(
+            GenerationRequest(
+                input_ids, params, streamer,
+                prefix=prefix, keep_cache=session is not None, speculation=speculation,
+            )
+        )
 
-        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
-        generation_kwargs = {
-            "inputs": inputs["input_ids"],
-            "attention_mask": inputs["attention_mask"],
-            "max_new_tokens": 512,
+    def _sampling_params(self, preset: dict) -> dict:
+        params = {
+            "max_new_tokens": preset.get("max_new_tokens") or DEFAULT_MAX_NEW_TOKENS,
+            # The template's own turn markers end a reply before it invents the next user turn.
+            "stop_strings": self.prompts.stop_strings + list(preset.get("stop_strings") or []),
+            "stop_token_ids": self.prompts.stop_token_ids + list(preset.get("stop_token_ids") or []),
             "do_sample": True,
-            "temperature": self.preset.get("temperature", 1.2),
-            "top_k": int(self.preset.get("top_k", 20)),
-            "top_p": self.preset.get("top_p", 0.9),
-            "repetition_penalty": self.preset.get("repetition_penalty", 1.0),
-            "pad_token_id": self.tokenizer.eos_token_id,
-            "streamer": streamer
+            "temperature": preset.get("temperature", 1.2),
+            "top_k": int(preset.get("top_k", 20)),
+            "top_p": preset.get("top_p", 0.9),
+            "repetition_penalty": preset.get("repetition_penalty", 1.0),
         }
+        decoding = preset.get("decoding")
+        if decoding == "greedy":
+            params["do_sample"] = False
+        elif decoding == "seeded":
+            params["seed"] = int(preset.get("seed") or 0)
+        return params
+
+    def submit_batch(self, messages: List[str], preset: dict = None) -> List[GenerationRequest]:
+        """Queues one-off generations for the messages, prefilled together as one padded group."""
+        if not self.active_model or not self.scheduler:
+            raise RuntimeError("Model not loaded.")
+
+        preset = preset or self.preset
+        prefix = self._prefix(preset)
+        params = self._sampling_params(preset)
+        budget = self.prompts.prompt_budget(params["max_new_tokens"]) - len(prefix.input_ids)
+        requests = [
+            GenerationRequest(self.prompts.message_ids(message, budget), params, _NullStreamer(), prefix=prefix)
+            for message in messages
+        ]
+        return self.scheduler.submit_group(requests)
+
+    def batch_result(self, request: GenerationRequest) -> dict:
+        return {"text": self.tokenizer.decode(request.generated, skip_special_tokens=True), **request.metadata()}
 
+    def generate_batch(self, messages: List[str], preset: dict = None) -> List[dict]:
+        """Blocking: text and metadata for each message, in order."""
+        requests = self.submit_batch(messages, preset)
+        for request in requests:
+            request.done.wait()
+        return [self.batch_result(request) for request in requests]
 
-        thread = threading.Thread(target=self.model.generate, kwargs=generation_kwargs)
-        thread.start()
+    def record_turn(self, session: ChatSession, message: str, reply: str, preset: dict = None):
+        """Adds a turn that was answered without generating (e.g. from the response cache) to the session."""
+        preset = preset or self.preset
+        prefix = self._prefix(preset)
+        context = (self.active_model["id"], prefix.key)
+        if session.context != context:
+            session.reset(context)
+        budget = self.prompts.prompt_budget(self._sampling_params(preset)["max_new_tokens"]) - len(prefix.input_ids)
+        message_ids = self.prompts.message_ids(message, budget)
+        reply_ids = self.tokenizer(reply, add_special_tokens=False)["input_ids"]
+        if not session.tokens:
+            sessions.record_turn(session, prefix.input_ids + message_ids + reply_ids, len(prefix.input_ids))
+        else:
+            turn_start = len(session.tokens) + len(session.pending) + len(self.prompts.between_ids)
+            sessions.record_turn(session, self.prompts.between_ids + message_ids + reply_ids, turn_start)
+
+    def generate_stream(self, message: str, session: ChatSession = None, preset: dict = None):
+        streamer = TextIteratorStreamer(self.tokenizer, skip_special_tokens=True)
+        try:
+            request = self.submit(message, streamer, session, preset)
+        except RuntimeError as e:
+            yield str(e)
+            return
+
+        try:
+            for token in streamer:
+                yield token
+        finally:
+            request.cancel()
+
+        if session is not None:
+            sessions.save_turn(session, request)
 
-        for token in streamer:
-            yield token
-        
         yield "__END__"
 
+    def open_stream(self, message: str, session: ChatSession = None, preset: dict = None) -> "TokenStream":
+        streamer = AsyncTextIteratorStreamer(self.tokenizer, skip_special_tokens=True)
+        request = self.submit(message, streamer, session, preset)
+        return TokenStream(request, streamer, session)
+
+
+class TokenStream:
+    """
+    Async iterator over the text of one generation request.
+
+    Tokens are handed from the scheduler thread to the event loop through an
+    asyncio queue, so consuming them never blocks the loop. cancel() stops the
+    sequence at the scheduler's next step.
+    """
 
-# Singleton instance
-runtime = ModelRuntime()
+    def __init__(self, request: GenerationRequest, streamer, session: ChatSession = None):
+        self.request = request
+        self.streamer = streamer
+        self.session = session
+
+    def cancel(self):
+        self.request.cancel()
+
+    def metadata(self) -> dict:
+        return self.request.metadata()
+
+    async def __aiter__(self):
+        try:
+            async for token in self.streamer:
+                yield token
+        finally:
+            self.request.cancel()
+
+        if self.session is not None:
+            sessions.save_turn(self.session, self.request)
+
+        yield "__END__"
@@ -1,11 +1,55 @@
-from pathlib import Path
-from typing import List
+import logging
+import os
+import queue
+import re
 import shutil
-from huggingface_hub import snapshot_download
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import requests
+
+from app.services.model_catalog import ModelCatalog, sha256_file
+
+logger = logging.getLogger(__name__)
 
 
 # Directory where all models are stored locally
 MODEL_DIR = Path("./local_models")
+# Downloads land here first and are moved into MODEL_DIR only once complete.
+STAGING_DIR_NAME = ".staging"
+
+HF_ENDPOINT = os.getenv("HF_ENDPOINT", "https://huggingface.co")
+HF_TOKEN = os.getenv("HF_TOKEN")
+
+DOWNLOAD_JOB_WORKERS = int(os.getenv("DOWNLOAD_JOB_WORKERS", 2))
+DOWNLOAD_FILE_WORKERS = int(os.getenv("DOWNLOAD_FILE_WORKERS", 4))
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)
+MAX_FINISHED_JOBS = 100
+
+# Prefetches (weights downloaded ahead of the first load) run on their own
+# worker(s) and share this bandwidth cap, in bytes/s (0 = no cap), so they do
+# not starve downloads someone is waiting for.
+PREFETCH_ON_CREATE = os.getenv("PREFETCH_ON_CREATE", "0") == "1"
+PREFETCH_JOB_WORKERS = int(os.getenv("PREFETCH_JOB_WORKERS", 1))
+PREFETCH_BANDWIDTH = int(os.getenv("PREFETCH_BANDWIDTH", 20 * 1024 * 1024))
+
+# Disk space the models in MODEL_DIR may use together; 0 means no limit.
+MODEL_CACHE_MAX_BYTES = int(os.getenv("MODEL_CACHE_MAX_BYTES", 0))
+
+# Only fetch the files the runtime reads: configs, tokenizer and one weight format.
+SELECTIVE_DOWNLOAD = os.getenv("SELECTIVE_DOWNLOAD", "1") != "0"
+METADATA_SUFFIXES = {".json", ".txt", ".model", ".tiktoken", ".jinja", ".py"}
+# Weight formats in order of preference: suffix, standard single/sharded file name, shard index.
+WEIGHT_FORMATS = [
+    (".safetensors", re.compile(r"^model(-\d+-of-\d+)?\.safetensors$"), "model.safetensors.index.json"),
+    (".bin", re.compile(r"^pytorch_model(-\d+-of-\d+)?\.bin$"), "pytorch_model.bin.index.json"),
+]
 
 
 def ensure_model_dir():
@@ -13,34 +57,540 @@ def ensure_model_dir():
         MODEL_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def list_local_models() -> List[str]:
+_catalogs: Dict[Path, ModelCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog() -> ModelCatalog:
     ensure_model_dir()
-    return [d.name for d in MODEL_DIR.iterdir() if d.is_dir()]
+    with _catalogs_lock:
+        if MODEL_DIR not in _catalogs:
+            _catalogs[MODEL_DIR] = ModelCatalog(MODEL_DIR)
+        return _catalogs[MODEL_DIR]
+
+
+def list_local_models() -> List[str]:
+    return get_catalog().names()
 
 
 def model_exists_locally(model_name: str) -> bool:
-    return (MODEL_DIR / model_name).exists()
+    catalog = get_catalog()
+    if model_name in catalog:
+        return True
+    # Downloads are promoted into MODEL_DIR atomically, so a directory there is complete;
+    # one that is not indexed yet was copied in by hand.
+    if not model_name.startswith(".") and (MODEL_DIR / model_name).is_dir():
+        catalog.adopt(model_name)
+        return True
+    return False
 
 
 def get_model_path(model_name: str) -> Path:
     path = MODEL_DIR / model_name
     if not path.exists():
+        get_catalog().remove(model_name)
         raise FileNotFoundError(f"Model '{model_name}' not found in local storage.")
+    get_catalog().touch(model_name)
     return path
 
 
+def staging_path(model_name: str) -> Path:
+    return MODEL_DIR / STAGING_DIR_NAME / model_name
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadCancelled(DownloadError):
+    pass
+
+
+def _auth_headers() -> dict:
+    return {"Authorization": f"Bearer {HF_TOKEN}"} if HF_TOKEN else {}
+
+
+def list_repo_files(hf_reference: str, revision: str = "main") -> tuple:
+    """
+    Returns (commit sha, {filename: size or None}, {filename: sha256}) for a
+    Hugging Face model repo; the hashes are known for LFS files only.
+    """
+    response = requests.get(
+        f"{HF_ENDPOINT}/api/models/{hf_reference}/revision/{revision}",
+        params={"blobs": "true"},
+        headers=_auth_headers(),
+        timeout=DOWNLOAD_TIMEOUT,
+    )
+    if response.status_code == 404:
+        raise DownloadError(f"Model '{hf_reference}' not found on Hugging Face")
+    response.raise_for_status()
+    data = response.json()
+    siblings = data.get("siblings", [])
+    files = {sibling["rfilename"]: sibling.get("size") for sibling in siblings}
+    hashes = {sibling["rfilename"]: sibling["lfs"]["sha256"] for sibling in siblings if sibling.get("lfs")}
+    return data.get("sha") or revision, files, hashes
+
+
+def select_files(files: Dict[str, Optional[int]]) -> Dict[str, Optional[int]]:
+    """
+    Picks the files from a repo listing that loading the model needs: top-level
+    metadata (configs, tokenizer, chat template) plus a single weight format,
+    safetensors first. Other formats (Flax, TF, ONNX, GGUF, original/ checkpoints)
+    are skipped. Repos with no recognised weight layout are downloaded whole.
+    """
+    top_level = {name: size for name, size in files.items() if "/" not in name}
+    indexes = {index for _, _, index in WEIGHT_FORMATS}
+    for suffix, standard, index in WEIGHT_FORMATS:
+        weights = {name: size for name, size in top_level.items() if name.endswith(suffix)}
+        if not weights:
+            continue
+        # Prefer model.safetensors / model-0000x-of-0000y.safetensors over extra copies
+        # such as consolidated.safetensors when both are present.
+        preferred = {name: size for name, size in weights.items() if standard.match(name)}
+        selected = preferred or weights
+        metadata = {
+            name: size for name, size in top_level.items()
+            if Path(name).suffix in METADATA_SUFFIXES and (name == index or name not in indexes)
+        }
+        return {**metadata, **selected}
+    return dict(files)
+
+
+class BandwidthLimit:
+    """Token bucket shared by all the threads it throttles."""
+
+    def __init__(self, bytes_per_s: int):
+        self.bytes_per_s = bytes_per_s
+        self._allowance = float(bytes_per_s)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count: int):
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.bytes_per_s, self._allowance + (now - self._last) * self.bytes_per_s)
+            self._last = now
+            self._allowance -= count
+            delay = -self._allowance / self.bytes_per_s if self._allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class DownloadJob:
+    def __init__(self, hf_reference: str, model_name: str, revision: str = "main", prefetch: bool = False):
+        self.id = uuid.uuid4().hex[:12]
+        self.hf_reference = hf_reference
+        self.model_name = model_name
+        self.revision = revision
+        self.prefetch = prefetch
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.files: Dict[str, Optional[int]] = {}
+        self.hashes: Dict[str, str] = {}
+        self.files_done = 0
+        self.deduplicated_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.total_bytes = 0
+        self.downloaded_bytes = 0
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        return MODEL_DIR / self.model_name
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.done.wait(timeout)
+
+    def add_bytes(self, count: int):
+        with self._lock:
+            self.downloaded_bytes += count
+
+    def file_done(self):
+        with self._lock:
+            self.files_done += 1
+
+    def add_deduplicated(self, count: int):
+        with self._lock:
+            self.downloaded_bytes += count
+            self.deduplicated_bytes += count
+
+    def progress(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        return {
+            "id": self.id,
+            "model_name": self.model_name,
+            "hf_reference": self.hf_reference,
+            "status": self.status,
+            "prefetch": self.prefetch,
+            "error": self.error,
+            "files_done": self.files_done,
+            "files_total": len(self.files),
+            "downloaded_bytes": self.downloaded_bytes,
+            "total_bytes": self.total_bytes,
+            "skipped_files": self.skipped_files,
+            "skipped_bytes": self.skipped_bytes,
+            "deduplicated_bytes": self.deduplicated_bytes,
+            "fraction": round(self.downloaded_bytes / self.total_bytes, 4) if self.total_bytes else None,
+            "bytes_per_s": round(self.downloaded_bytes / elapsed) if elapsed else None,
+        }
+
+
+class DownloadManager:
+    """
+    Runs model downloads in background threads.
+
+    Each job lists the repo files, fetches them in parallel into a staging
+    directory (resuming any partial file with a Range request) and moves the
+    directory into MODEL_DIR once every file is complete.
+    """
+
+    def __init__(
+        self,
+        job_workers: int = DOWNLOAD_JOB_WORKERS,
+        file_workers: int = DOWNLOAD_FILE_WORKERS,
+        prefetch_workers: int = PREFETCH_JOB_WORKERS,
+        prefetch_bandwidth: int = PREFETCH_BANDWIDTH,
+    ):
+        self.job_workers = job_workers
+        self.file_workers = file_workers
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_limit = BandwidthLimit(prefetch_bandwidth) if prefetch_bandwidth else None
+        self._jobs: Dict[str, DownloadJob] = {}
+        self._queue: "queue.Queue[DownloadJob]" = queue.Queue()
+        self._prefetch_queue: "queue.Queue[DownloadJob]" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, hf_reference: str, model_name: str, revision: str = "main", prefetch: bool = False) -> DownloadJob:
+        """
+        Queues a download, or returns the active job for the same model. A
+        prefetch job that someone now waits for is promoted: it leaves the
+        bandwidth cap and, if it has not started, jumps to the main queue.
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if job.model_name == model_name and job.active:
+                    if job.prefetch and not prefetch:
+                        self._promote(job)
+                    return job
+
+            job = DownloadJob(hf_reference, model_name, revision, prefetch)
+            self._jobs[job.id] = job
+            if model_exists_locally(model_name):
+                self._complete(job, "completed")
+                return job
+
+            self._start_threads()
+            self._prune()
+            (self._prefetch_queue if prefetch else self._queue).put(job)
+            return job
+
+    def _promote(self, job: DownloadJob):
+        logger.info(f"Prefetch of {job.model_name} is now awaited, lifting its bandwidth cap")
+        job.prefetch = False
+        if job.status == "queued":
+            # Whichever queue reaches it first runs it; see _claim().
+            self._queue.put(job)
+
+    def get(self, job_id: str) -> Optional[DownloadJob]:
+        return self._jobs.get(job_id)
+
+    def find(self, model_name: str) -> Optional[DownloadJob]:
+        """The active job for a model, if any."""
+        with self._lock:
+            for job in self._jobs.values():
+                if job.model_name == model_name and job.active:
+                    return job
+        return None
+
+    def jobs(self) -> List[DownloadJob]:
+        return list(self._jobs.values())
+
+    def _start_threads(self):
+        if self._threads:
+            return
+        workers = [(self._queue, "model-download")] * self.job_workers
+        workers += [(self._prefetch_queue, "model-prefetch")] * self.prefetch_workers
+        for i, (jobs, name) in enumerate(workers):
+            thread = threading.Thread(target=self._work, args=(jobs,), name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _claim(self, job: DownloadJob) -> bool:
+        # A promoted job sits in both queues; only the first worker to get it runs it.
+        with self._lock:
+            if job.status != "queued":
+                return False
+            job.status = "running"
+            return True
+
+    def _prune(self):
+        finished = [job for job in self._jobs.values() if not job.active]
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            self._jobs.pop(job.id, None)
+
+    def _work(self, jobs: "queue.Queue[DownloadJob]"):
+        while True:
+            job = jobs.get()
+            if not self._claim(job):
+                continue
+            if job.cancelled.is_set():
+                self._complete(job, "cancelled")
+                continue
+            job.started_at = time.time()
+            try:
+                self._run(job)
+            except DownloadCancelled:
+                self._complete(job, "cancelled")
+            except Exception as e:
+                logger.exception(f"Download of {job.hf_reference} failed")
+                job.error = str(e)
+                self._complete(job, "failed")
+            else:
+                self._complete(job, "completed")
+
+    @staticmethod
+    def _complete(job: DownloadJob, status: str):
+        job.status = status
+        job.finished_at = time.time()
+        job.done.set()
+
+    def _run(self, job: DownloadJob):
+        revision, listed, job.hashes = list_repo_files(job.hf_reference, job.revision)
+        job.files = select_files(listed) if SELECTIVE_DOWNLOAD else listed
+        job.total_bytes = sum(size or 0 for size in job.files.values())
+        job.skipped_files = len(listed) - len(job.files)
+        job.skipped_bytes = sum(size or 0 for size in listed.values()) - job.total_bytes
+        if job.skipped_files:
+            logger.info(f"Skipping {job.skipped_files} files ({job.skipped_bytes} bytes) of {job.hf_reference} the runtime does not read")
+        cache.make_room(job.total_bytes)
+        staging = staging_path(job.model_name)
+        staging.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Downloading {len(job.files)} files of {job.hf_reference} into {staging}")
+
+        with ThreadPoolExecutor(max_workers=self.file_workers) as executor:
+            futures = [
+                executor.submit(self._fetch_file, job, revision, filename, size, staging)
+                for filename, size in job.files.items()
+            ]
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    job.cancel()  # stop the other files early
+                    errors.append(e)
+            if errors:
+                raise next((e for e in errors if not isinstance(e, DownloadCancelled)), errors[0])
+
+        target = job.path
+        if target.exists():
+            shutil.rmtree(staging)
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staging, target)
+        get_catalog().add(job.model_name, job.hf_reference, revision, {
+            name: {"size": (target / name).stat().st_size, "sha256": job.hashes.get(name)}
+            for name in job.files
+        })
+        logger.info(f"Model {job.model_name} downloaded to {target}")
+
+    def _fetch_file(self, job: DownloadJob, revision: str, filename: str, size: Optional[int], staging: Path):
+        destination = (staging / filename).resolve()
+        if staging.resolve() not in destination.parents:
+            raise DownloadError(f"Refusing to write {filename} outside the model directory")
+        if destination.exists() and (size is None or destination.stat().st_size == size):
+            job.add_bytes(destination.stat().st_size)
+            self._deduplicate(job, filename, destination)
+            job.file_done()
+            return
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        expected_hash = job.hashes.get(filename)
+        if expected_hash and get_catalog().link_blob(expected_hash, destination, size):
+            # Another model already has this exact shard; no download needed.
+            job.add_deduplicated(destination.stat().st_size)
+            job.file_done()
+            return
+
+        partial = destination.with_name(destination.name + ".part")
+        if partial.exists():
+            job.add_bytes(partial.stat().st_size)
+
+        url = f"{HF_ENDPOINT}/{job.hf_reference}/resolve/{revision}/{filename}"
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            try:
+                self._fetch_range(job, url, partial)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise DownloadError(f"Downloading {filename} failed: {e}") from e
+                logger.warning(f"Downloading {filename} interrupted ({e}), resuming")
+
+        if size is not None and partial.stat().st_size != size:
+            raise DownloadError(f"{filename}: expected {size} bytes, got {partial.stat().st_size}")
+        os.replace(partial, destination)
+        self._deduplicate(job, filename, destination)
+        job.file_done()
+
+    @staticmethod
+    def _deduplicate(job: DownloadJob, filename: str, path: Path):
+        digest = sha256_file(path)
+        expected = job.hashes.get(filename)
+        if expected and digest != expected:
+            path.unlink()
+            raise DownloadError(f"{filename}: sha256 mismatch, expected {expected}, got {digest}")
+        job.hashes[filename] = digest
+        get_catalog().store_blob(path, digest)
+
+    def _fetch_range(self, job: DownloadJob, url: str, partial: Path):
+        offset = partial.stat().st_size if partial.exists() else 0
+        headers = _auth_headers()
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 416:
+                return  # the partial file is already complete
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                # The server ignored the range; start the file over.
+                job.add_bytes(-offset)
+                offset = 0
+            with open(partial, "ab" if offset else "wb") as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if job.cancelled.is_set():
+                        raise DownloadCancelled(f"Download of {job.model_name} cancelled")
+                    f.write(chunk)
+                    job.add_bytes(len(chunk))
+                    if job.prefetch and self.prefetch_limit:
+                        self.prefetch_limit.consume(len(chunk))
+
+
+# Singleton instance
+downloads = DownloadManager()
+
+
+class ModelCache:
+    """
+    Disk budget for MODEL_DIR. Before a download starts, the least recently
+    used models are deleted until it fits; models that are loaded (as
+    reported by the registered providers) or being downloaded are kept.
+    """
+
+    def __init__(self, max_bytes: int = MODEL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._in_use: List[Callable[[], Iterable[str]]] = []
+        self._lock = threading.Lock()
+
+    def register_in_use(self, provider: Callable[[], Iterable[str]]):
+        self._in_use.append(provider)
+
+    def protected(self) -> set:
+        names = {job.model_name for job in downloads.jobs() if job.active}
+        for provider in self._in_use:
+            names.update(provider())
+        return names
+
+    def lookup(self, model_name: str) -> bool:
+        """model_exists_locally() that also counts cache hits and misses."""
+        found = model_exists_locally(model_name)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def make_room(self, incoming_bytes: int = 0) -> List[str]:
+        """Evicts least recently used models until incoming_bytes more fit; returns their names."""
+        if not self.max_bytes:
+            return []
+        if incoming_bytes > self.max_bytes:
+            raise DownloadError(f"{incoming_bytes} bytes do not fit in the model cache ({self.max_bytes} bytes)")
+
+        evicted = []
+        with self._lock:
+            catalog = get_catalog()
+            used = catalog.disk_bytes()
+            if used + incoming_bytes <= self.max_bytes:
+                return evicted
+            protected = self.protected()
+            candidates = sorted(
+                (entry["last_used"], name) for name, entry in catalog.entries().items() if name not in protected
+            )
+            for _, name in candidates:
+                if used + incoming_bytes <= self.max_bytes:
+                    break
+                logger.info(f"Model cache over budget, deleting {name}")
+                delete_model(name)
+                freed = used - catalog.disk_bytes()
+                used -= freed
+                self.evictions += 1
+                self.evicted_bytes += freed
+                evicted.append(name)
+            if used + incoming_bytes > self.max_bytes:
+                logger.warning(f"Model cache stays over budget: {used} bytes used, the rest is in use")
+        return evicted
+
+    def stats(self) -> dict:
+        catalog = get_catalog()
+        protected = self.protected()
+        lookups = self.hits + self.misses
+        entries = sorted(catalog.entries().items(), key=lambda item: item[1]["last_used"], reverse=True)
+        return {
+            "max_bytes": self.max_bytes or None,
+            "used_bytes": catalog.disk_bytes(),
+            "free_disk_bytes": shutil.disk_usage(MODEL_DIR).free,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "models": [
+                {
+                    "model_name": name,
+                    "size_bytes": entry["size_bytes"],
+                    "last_used": entry["last_used"],
+                    "in_use": name in protected,
+                }
+                for name, entry in entries
+            ],
+        }
+
+
+# Singleton instance
+cache = ModelCache()
+
+
 def download_model_from_huggingface(hf_reference: str, model_name: str) -> Path:
+    """Blocking download; prefer downloads.submit() from async code."""
     path = MODEL_DIR / model_name
     if path.exists():
         return path
 
-    local_path = snapshot_download(
-        repo_id=hf_reference,
-        local_dir=path,
-        local_dir_use_symlinks=False
-    )
-
-    return Path(local_path)
+    job = downloads.submit(hf_reference, model_name)
+    job.wait()
+    if job.status != "completed":
+        raise DownloadError(job.error or f"Download of {model_name} {job.status}")
+    return path
 
 
 def delete_model(model_name: str) -> bool:
@@ -48,8 +598,14 @@ def delete_model(model_name: str) -> bool:
     Deletes a locally stored model directory.
     Returns True if deleted, False if not found.
     """
-    path = MODEL_DIR / model_name
+    catalog = get_catalog()
+    path = (MODEL_DIR / model_name).resolve()
+    if path.parent != MODEL_DIR.resolve():
+        logger.warning(f"Refusing to delete {path}: not a model directory in {MODEL_DIR}")
+        return False
+    indexed = catalog.remove(model_name) is not None
     if path.exists() and path.is_dir():
         shutil.rmtree(path)
+        catalog.collect_garbage()
         return True
-    return False
+    return indexed
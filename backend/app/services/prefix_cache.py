@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+
+from app.services.kv_cache import LegacyCache, nbytes, to_legacy
+
+logger = logging.getLogger(__name__)
+
+
+# Prefixes kept per model; raise it when more presets than this share a model.
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", 8))
+
+
+class CachedPrefix:
+    def __init__(self, key: str, input_ids: List[int], cache: LegacyCache):
+        self.key = key
+        self.input_ids = input_ids
+        self.cache = cache
+
+    @property
+    def nbytes(self) -> int:
+        return nbytes(self.cache)
+
+
+class PrefixCache:
+    """
+    Past key/values of preset prompt prefixes, keyed by a hash of the prefix text.
+
+    Cached tensors are never modified in place: the scheduler only appends to
+    them through DynamicCache.update, which concatenates into new tensors.
+    """
+
+    def __init__(self, model, tokenizer, max_entries: int = PREFIX_CACHE_SIZE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CachedPrefix]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[CachedPrefix]:
+        key = self.key(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    @torch.no_grad()
+    def warm(self, text: str, add_special_tokens: bool = True) -> CachedPrefix:
+        entry = self.get(text)
+        if entry is not None:
+            return entry
+
+        key = self.key(text)
+        input_ids = self.tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+        outputs = self.model(input_ids=torch.tensor([input_ids], device=self.model.device), use_cache=True)
+        entry = CachedPrefix(key, input_ids, to_legacy(outputs.past_key_values))
+        logger.info(f"Cached prompt prefix {key[:12]}: {len(input_ids)} tokens, {entry.nbytes} bytes")
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
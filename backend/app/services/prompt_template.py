@@ -0,0 +1,167 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Used when the model config does not say how many positions it supports.
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", 2048))
+# Share of the window (after the reply's reservation) the preset's system text may take.
+SYSTEM_PROMPT_SHARE = float(os.getenv("SYSTEM_PROMPT_SHARE", 0.5))
+# At most this share of the window is reserved for the reply.
+MAX_REPLY_SHARE = 0.5
+MAX_CACHED_PREFIXES = 64
+
+SYSTEM_MARK = "<<system-7f3a>>"
+USER_MARK = "<<user-7f3a>>"
+REPLY_MARK = "<<reply-7f3a>>"
+
+# The original format, for models without a chat template.
+PLAIN_PARTS = {
+    "head": "###",
+    "system_tail": "###\nUser Message:",
+    "message": " {}",
+    "after": "",
+    "between": "\nUser Message:",
+}
+
+
+class PromptTemplate:
+    """
+    Builds prompts from the tokenizer's chat template when it has one, else
+    in the plain "###...### User Message:" format. A prompt is laid out as
+
+        prefix (system text, up to the first user message)
+        message + after            first turn
+        reply + between + message + after       every later turn
+
+    so the prefix is static per preset and its KV cache can be reused.
+    Token budgets keep the prompt inside the context window: the reply gets
+    up to max_new_tokens (at most half the window), the system text up to
+    SYSTEM_PROMPT_SHARE of the rest, and messages and history the remainder.
+    Oversized parts are cut the same way every time.
+    """
+
+    def __init__(self, tokenizer, context_window: int = None):
+        self.tokenizer = tokenizer
+        self.context_window = context_window or DEFAULT_CONTEXT_WINDOW
+        parts = self._chat_parts()
+        self.chat = parts is not None
+        self.parts = parts or PLAIN_PARTS
+        self.after_ids = self._ids(self.parts["after"])
+        self.between_ids = self._ids(self.parts["between"])
+        # What the model would produce to start another user turn; a reply ends there.
+        if self.chat:
+            special = set(getattr(tokenizer, "all_special_ids", []))
+            self.stop_strings = []
+            self.stop_token_ids = self.between_ids[:1] if self.between_ids[:1] and self.between_ids[0] in special else []
+        else:
+            self.stop_strings = [self.parts["between"]]
+            self.stop_token_ids = []
+        self._prefixes: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _ids(self, text: str) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"] if text else []
+
+    def _render(self, messages: List[dict], add_generation_prompt: bool) -> str:
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    def _chat_parts(self) -> Optional[dict]:
+        if not getattr(self.tokenizer, "chat_template", None):
+            return None
+        system = {"role": "system", "content": SYSTEM_MARK}
+        user = {"role": "user", "content": USER_MARK}
+        try:
+            one = self._render([system, user], True)
+            two = self._render([system, user, {"role": "assistant", "content": REPLY_MARK}, user], True)
+        except Exception as e:
+            # e.g. templates that reject a system role
+            logger.warning(f"Chat template not usable, using the plain prompt format: {e}")
+            return None
+        if one.count(SYSTEM_MARK) != 1 or one.count(USER_MARK) != 1 or two.count(REPLY_MARK) != 1:
+            logger.warning("Chat template rewrites message contents, using the plain prompt format")
+            return None
+
+        head, rest = one.split(SYSTEM_MARK)
+        system_tail, after = rest.split(USER_MARK)
+        between = two.split(REPLY_MARK)[1].split(USER_MARK)[0]
+        return {"head": head, "system_tail": system_tail, "message": "{}", "after": after, "between": between}
+
+    @property
+    def prefix_special_tokens(self) -> bool:
+        # A rendered chat template already contains BOS and friends.
+        return not self.chat
+
+    def reply_reserve(self, max_new_tokens: int) -> int:
+        return min(max_new_tokens, int(self.context_window * MAX_REPLY_SHARE))
+
+    def prompt_budget(self, max_new_tokens: int) -> int:
+        """Tokens the prompt (prefix, history and message) may use."""
+        return self.context_window - self.reply_reserve(max_new_tokens)
+
+    def system_text(self, preset: dict, task: str = None, costraints: str = None) -> str:
+        task = (preset.get("task") or "") if task is None else task
+        costraints = (preset.get("costraints") or "") if costraints is None else costraints
+        return (
+            f"You are {preset['bot_name']}\n"
+            f"Your task is to: {task}\n"
+            f"Constraints for you to follow: {costraints}!!!"
+        )
+
+    def _assemble(self, preset: dict, task: str = None, costraints: str = None) -> str:
+        return self.parts["head"] + self.system_text(preset, task, costraints) + self.parts["system_tail"]
+
+    def prefix(self, preset: dict, max_new_tokens: int) -> str:
+        """Everything up to the user message, with task and constraints cut to the system budget."""
+        key = (preset["bot_name"], preset.get("task"), preset.get("costraints"), max_new_tokens)
+        with self._lock:
+            text = self._prefixes.get(key)
+            if text is not None:
+                self._prefixes.move_to_end(key)
+                return text
+        # Tokenizing a long preset is the expensive part; it happens once per preset.
+        text = self._fit_prefix(preset, int(self.prompt_budget(max_new_tokens) * SYSTEM_PROMPT_SHARE))
+        with self._lock:
+            self._prefixes[key] = text
+            while len(self._prefixes) > MAX_CACHED_PREFIXES:
+                self._prefixes.popitem(last=False)
+        return text
+
+    def _fit_prefix(self, preset: dict, budget: int) -> str:
+        text = self._assemble(preset)
+        if self._count(text) <= budget:
+            return text
+
+        task = self._ids(preset.get("task") or "")
+        costraints = self._ids(preset.get("costraints") or "")
+        allowance = max(0, budget - self._count(self._assemble(preset, "", "")))
+        # Each field keeps its head; one that is shorter than half the
+        # allowance leaves the remainder to the other.
+        keep_task = min(len(task), max(allowance // 2, allowance - len(costraints)))
+        keep_costraints = min(len(costraints), allowance - keep_task)
+        logger.warning(
+            f"Preset system text exceeds {budget} tokens; keeping {keep_task}/{len(task)} task "
+            f"and {keep_costraints}/{len(costraints)} constraint tokens"
+        )
+        return self._assemble(
+            preset,
+            self.tokenizer.decode(task[:keep_task]),
+            self.tokenizer.decode(costraints[:keep_costraints]),
+        )
+
+    def _count(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=self.prefix_special_tokens)["input_ids"])
+
+    def message_ids(self, message: str, budget: int) -> List[int]:
+        """The message's tokens followed by the template's text before the reply, within budget."""
+        ids = self._ids(self.parts["message"].format(message))
+        room = max(1, budget - len(self.after_ids))
+        if len(ids) > room:
+            # The end of a long message (usually the actual question) is kept.
+            logger.info(f"Truncating message from {len(ids)} to {room} tokens")
+            ids = ids[-room:]
+        return ids + self.after_ids
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Memory for cached replies; 0 turns the cache off.
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 ** 2))
+RESPONSE_CACHE_PATH = Path(os.getenv("RESPONSE_CACHE_PATH", "./response_cache.json"))
+# Changes are written back at most this often (and on shutdown).
+RESPONSE_CACHE_SAVE_INTERVAL = float(os.getenv("RESPONSE_CACHE_SAVE_INTERVAL", 30))
+
+# Only these decoding modes produce the same reply for the same input.
+DETERMINISTIC_DECODING = ("greedy", "seeded")
+# Preset fields that shape the reply: the persona and the sampling settings.
+KEY_FIELDS = (
+    "bot_name", "task", "costraints",
+    "temperature", "repetition_penalty", "top_p", "top_k", "decoding", "seed",
+    "max_new_tokens", "stop_strings", "stop_token_ids",
+)
+
+
+def normalize_message(message: str) -> str:
+    # Cacheable requests are also generated from the normalized text, so a hit
+    # is exactly what the model would have produced.
+    return " ".join(message.split())
+
+
+def cacheable(preset: Optional[dict]) -> bool:
+    return bool(preset) and preset.get("decoding") in DETERMINISTIC_DECODING
+
+
+class ResponseCache:
+    """
+    Replies of deterministic presets (greedy or fixed-seed decoding), keyed by
+    the model revision, the preset's content, the conversation so far and the
+    normalized message. Entries keep the streamed text chunks so a hit is
+    replayed like a generation. Least recently used entries are evicted past
+    max_bytes. The cache is persisted to disk as JSON by background threads:
+    requests only ever touch the in-memory entries.
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, path: Path = RESPONSE_CACHE_PATH):
+        self.max_bytes = max_bytes
+        self.path = path
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._load_started = False
+        self._loaded = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_ms = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(model_key: str, preset: dict, history: List[str], message: str) -> str:
+        material = {
+            "model": model_key,
+            "preset": {field: preset.get(field) for field in KEY_FIELDS},
+            "history": history,
+            "message": normalize_message(message),
+        }
+        return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _start_loading(self):
+        # Called under the lock; lookups miss until the stored entries are in.
+        if not self._load_started:
+            self._load_started = True
+            threading.Thread(target=self.load, name="response-cache-load", daemon=True).start()
+
+    def load(self):
+        """Reads the persisted entries. Entries added since take precedence."""
+        try:
+            stored = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            stored = {}
+        entries = OrderedDict(stored)
+        with self._lock:
+            self._loaded.set()
+            for key, entry in self._entries.items():
+                entries.pop(key, None)
+                entries[key] = entry
+            self._entries = entries
+            self._bytes = sum(entry["bytes"] for entry in entries.values())
+            self._evict()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            self._start_loading()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_tokens += entry["metadata"].get("completion_tokens") or 0
+            self.saved_ms += entry["metadata"].get("total_ms") or 0
+            return entry
+
+    def put(self, key: str, chunks: List[str], metadata: dict):
+        entry = {"chunks": chunks, "metadata": metadata}
+        entry["bytes"] = len(json.dumps(entry))
+        if entry["bytes"] > self.max_bytes:
+            return
+        with self._lock:
+            self._start_loading()
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous["bytes"]
+            self._entries[key] = entry
+            self._bytes += entry["bytes"]
+            self._evict()
+            self._dirty = True
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush, name="response-cache-flush", daemon=True)
+                self._flusher.start()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry["bytes"]
+
+    def _flush(self):
+        while True:
+            time.sleep(RESPONSE_CACHE_SAVE_INTERVAL)
+            self.save()
+
+    def save(self):
+        """Writes the entries to disk if they changed since the last save."""
+        if self._load_started:
+            # Saving before the stored entries are merged in would drop them.
+            self._loaded.wait()
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                # Entries are never modified once stored, so a shallow copy is a consistent snapshot.
+                snapshot = dict(self._entries)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix(".tmp")
+                tmp.write_text(json.dumps(snapshot))
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.warning(f"Could not persist response cache: {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def clear(self):
+        """Drops every entry, on disk too. Blocks on file IO; call it off the event loop."""
+        if self._load_started:
+            self._loaded.wait()
+        with self._lock:
+            # Nothing stored is left to load.
+            self._load_started = True
+            self._loaded.set()
+            self._entries = OrderedDict()
+            self._bytes = 0
+            self._dirty = True
+        self.save()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                # Compute a hit did not spend: the tokens and time of the original generation.
+                "saved_tokens": self.saved_tokens,
+                "saved_s": round(self.saved_ms / 1000, 3),
+            }
+
+
+# Singleton instance
+response_cache = ResponseCache()
@@ -0,0 +1,568 @@
+import logging
+import queue
+import threading
+import time
+from typing import List, Optional
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from app.services.kv_cache import (
+    LegacyCache,
+    concat_batch,
+    from_legacy,
+    select_batch,
+    slice_positions,
+    to_legacy,
+)
+from app.services.prefix_cache import CachedPrefix
+from app.services.speculative import SpeculativeState
+from app.services.stopping import StopCriteria
+
+logger = logging.getLogger(__name__)
+
+
+MAX_BATCH_SIZE = 16
+DEFAULT_MAX_NEW_TOKENS = 512
+
+
+class GenerationRequest:
+    def __init__(
+        self,
+        input_ids: List[int],
+        params: dict,
+        streamer,
+        prefix: Optional[CachedPrefix] = None,
+        keep_cache: bool = False,
+        speculation: Optional[SpeculativeState] = None,
+    ):
+        self.input_ids = list(input_ids)
+        self.params = params
+        self.prefix = prefix
+        self.keep_cache = keep_cache
+        self.streamer = streamer
+        self.tokens: List[int] = []
+        self.generated: List[int] = []
+        self.finish_reason: Optional[str] = None
+        # With keep_cache, the finished sequence's past key/values (covering
+        # tokens[:seq_length(cache)]) are handed back here.
+        self.cache: Optional[LegacyCache] = None
+        # Set when a draft model is available: the sequence is then decoded
+        # on its own with speculative rounds instead of joining the batch.
+        self.speculation = speculation
+        self.processors = build_logits_processors(params)
+        # Seeded requests sample from their own generator, created on the model's device.
+        self.seed: Optional[int] = params.get("seed")
+        self.generator: Optional[torch.Generator] = None
+        # Set by the scheduler when params carry stop strings or stop token ids.
+        self.stop: Optional[StopCriteria] = None
+        # Generated tokens at the end that are not part of the reply (EOS, a stop string).
+        self.trailing = 0
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.created_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def max_new_tokens(self) -> int:
+        return int(self.params.get("max_new_tokens") or DEFAULT_MAX_NEW_TOKENS)
+
+    def metadata(self) -> dict:
+        def elapsed_ms(moment):
+            return round((moment - self.created_at) * 1000, 1) if moment else None
+
+        prefix_length = len(self.prefix.input_ids) if self.prefix else 0
+        metadata = {
+            "finish_reason": self.finish_reason,
+            "prompt_tokens": prefix_length + len(self.input_ids),
+            "completion_tokens": len(self.generated),
+            "ttft_ms": elapsed_ms(self.first_token_at),
+            "total_ms": elapsed_ms(self.finished_at),
+        }
+        if self.stop is not None and self.stop.matched is not None:
+            metadata["stop_sequence"] = self.stop.matched
+            metadata["wasted_tokens"] = self.stop.discarded
+        if self.speculation is not None:
+            metadata["speculative"] = self.speculation.stats()
+        return metadata
+
+
+def build_logits_processors(params: dict) -> LogitsProcessorList:
+    processors = LogitsProcessorList()
+    repetition_penalty = params.get("repetition_penalty")
+    if repetition_penalty and repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+    temperature = params.get("temperature")
+    if temperature and temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    top_k = params.get("top_k")
+    if top_k:
+        processors.append(TopKLogitsWarper(top_k=int(top_k)))
+    top_p = params.get("top_p")
+    if top_p is not None and top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p=top_p))
+    return processors
+
+
+class BatchScheduler:
+    """
+    Continuous batching over a single loaded model.
+
+    New requests are prefilled on their own and then merged into the running
+    batch between decode steps; every step runs one forward pass for all
+    running sequences and finished sequences are dropped from the batch
+    (and their rows from the shared KV cache) right away.
+
+    Requests with a draft model keep their own caches and advance by one
+    speculative round per step instead, since rows of the batched cache
+    cannot accept different numbers of tokens.
+
+    Groups from submit_group() are prefilled together in one left-padded
+    forward pass and join the batch as a whole.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = MAX_BATCH_SIZE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+
+        self.pending: "queue.Queue" = queue.Queue()
+        # A group that did not fit the batch yet; it is admitted before anything newer.
+        self._held: Optional[List[GenerationRequest]] = None
+        self.running: List[GenerationRequest] = []
+        self.speculative: List[GenerationRequest] = []
+        self.cache = None
+        self.attention_mask: Optional[torch.Tensor] = None
+
+        self.eos_token_ids = self._collect_eos_token_ids()
+        config = getattr(model, "config", None)
+        self.max_positions = getattr(config, "max_position_embeddings", None)
+
+        self._shutdown = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        if self._shutdown.is_set():
+            raise RuntimeError("Scheduler is shut down")
+        self._add_stop_criteria(request)
+        self.pending.put(request)
+        return request
+
+    def _add_stop_criteria(self, request: GenerationRequest):
+        stop_strings = request.params.get("stop_strings") or ()
+        stop_token_ids = request.params.get("stop_token_ids") or ()
+        if stop_strings or stop_token_ids:
+            request.stop = StopCriteria(self.tokenizer, stop_strings, stop_token_ids)
+
+    def submit_group(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """
+        Queues requests to be prefilled in one padded forward pass. Prompts of
+        similar length waste the least compute on padding. Speculation is not
+        used for grouped requests.
+        """
+        if self._shutdown.is_set():
+            raise RuntimeError("Scheduler is shut down")
+        for request in requests:
+            self._add_stop_criteria(request)
+        self.pending.put(list(requests))
+        return requests
+
+    def shutdown(self):
+        self._shutdown.set()
+        self.pending.put(None)
+        self._thread.join(timeout=5)
+        for request in self.running + self.speculative + (self._held or []):
+            self._finish(request, "aborted")
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            for request in self._group(item):
+                self._finish(request, "aborted")
+        self._held = None
+        self.running = []
+        self.speculative = []
+        self.cache = None
+        self.attention_mask = None
+
+    @property
+    def active(self) -> int:
+        return len(self.running) + len(self.speculative)
+
+    def in_flight(self) -> int:
+        """Requests submitted and not finished yet, queued ones included."""
+        queued = sum(len(self._group(item)) for item in list(self.pending.queue))
+        return self.active + queued + len(self._held or [])
+
+    @staticmethod
+    def _group(item) -> List[GenerationRequest]:
+        if item is None:
+            return []
+        return item if isinstance(item, list) else [item]
+
+    def _collect_eos_token_ids(self) -> set:
+        eos = set()
+        generation_config = getattr(self.model, "generation_config", None)
+        config_eos = getattr(generation_config, "eos_token_id", None)
+        if isinstance(config_eos, int):
+            eos.add(config_eos)
+        elif config_eos:
+            eos.update(config_eos)
+        if self.tokenizer.eos_token_id is not None:
+            eos.add(self.tokenizer.eos_token_id)
+        return eos
+
+    def _next_pending(self, block: bool):
+        if self._held is not None:
+            item, self._held = self._held, None
+            return item
+        return self.pending.get() if block else self.pending.get_nowait()
+
+    def _loop(self):
+        while not self._shutdown.is_set():
+            if not self.active:
+                item = self._next_pending(block=True)
+                if item is None:
+                    continue
+                self._admit_item(item)
+
+            while self.active < self.max_batch_size:
+                try:
+                    item = self._next_pending(block=False)
+                except queue.Empty:
+                    break
+                if item is None:
+                    break
+                if isinstance(item, list) and self.active + len(item) > self.max_batch_size:
+                    self._held = item
+                    break
+                self._admit_item(item)
+
+            self._retire_finished()
+            if not self.active:
+                continue
+
+            if self.running:
+                try:
+                    self._decode_step()
+                except Exception:
+                    logger.exception("Decode step failed, aborting %d sequences", len(self.running))
+                    for request in self.running:
+                        request.finish_reason = "error"
+            for request in self.speculative:
+                try:
+                    self._speculative_step(request)
+                except Exception:
+                    logger.exception("Speculative step failed")
+                    request.finish_reason = "error"
+            self._retire_finished()
+
+    def _admit_item(self, item):
+        if isinstance(item, list):
+            self._admit_group(item)
+        else:
+            self._admit(item)
+
+    @torch.no_grad()
+    def _admit_group(self, requests: List[GenerationRequest]):
+        group = []
+        for request in requests:
+            if request.cancelled.is_set():
+                self._finish(request, "cancelled")
+            elif not request.input_ids:
+                self._finish(request, "error")
+            else:
+                group.append(request)
+        # One padded pass needs a common cached prefix.
+        if len(group) <= 1 or len({id(request.prefix) for request in group}) > 1:
+            for request in group:
+                self._admit(request)
+            return
+
+        try:
+            outputs, mask = self._prefill_group(group)
+        except Exception:
+            logger.exception("Group prefill failed")
+            for request in group:
+                self._finish(request, "error")
+            return
+
+        if self.running:
+            legacy = concat_batch(to_legacy(self.cache), to_legacy(outputs.past_key_values))
+            self.cache = from_legacy(legacy)
+            self.attention_mask = self._concat_masks(self.attention_mask, mask)
+        else:
+            self.cache = outputs.past_key_values
+            self.attention_mask = mask
+        self.running.extend(group)
+
+        logits = outputs.logits[:, -1, :]
+        for row, request in enumerate(group):
+            self._append_token(request, self._sample(request, logits[row:row + 1]))
+
+    def _prefill_group(self, group: List[GenerationRequest]):
+        # Rows are [prefix, padding, prompt]: the shared prefix cache is reused
+        # as is and the padding is masked out, so positions stay contiguous.
+        prefix = group[0].prefix
+        prefix_length = len(prefix.input_ids) if prefix else 0
+        length = max(len(request.input_ids) for request in group)
+        pad_id = self.tokenizer.pad_token_id
+        if pad_id is None:
+            pad_id = self.tokenizer.eos_token_id or 0
+
+        input_ids = torch.tensor(
+            [[pad_id] * (length - len(r.input_ids)) + r.input_ids for r in group], device=self.device
+        )
+        prompt_mask = torch.tensor(
+            [[0] * (length - len(r.input_ids)) + [1] * len(r.input_ids) for r in group], device=self.device
+        )
+        mask = torch.cat(
+            [torch.ones(len(group), prefix_length, dtype=torch.long, device=self.device), prompt_mask], dim=1
+        )
+        position_ids = (prompt_mask.cumsum(dim=1) - 1).clamp(min=0) + prefix_length
+
+        past = None
+        if prefix is not None:
+            past = from_legacy([(k.repeat(len(group), 1, 1, 1), v.repeat(len(group), 1, 1, 1)) for k, v in prefix.cache])
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        for request in group:
+            request.tokens = (prefix.input_ids if prefix else []) + request.input_ids
+        return outputs, mask
+
+    @torch.no_grad()
+    def _admit(self, request: GenerationRequest):
+        if request.cancelled.is_set():
+            self._finish(request, "cancelled")
+            return
+        if not request.input_ids:
+            self._finish(request, "error")
+            return
+        try:
+            outputs = self._prefill(request)
+        except Exception:
+            logger.exception("Prefill failed")
+            self._finish(request, "error")
+            return
+
+        if request.speculation is not None:
+            request.speculation.target_cache = outputs.past_key_values
+            self.speculative.append(request)
+            self._append_token(request, self._sample(request, outputs.logits[:, -1, :]))
+            return
+
+        mask = torch.ones(1, len(request.tokens), dtype=torch.long, device=self.device)
+
+        if self.running:
+            legacy = concat_batch(to_legacy(self.cache), to_legacy(outputs.past_key_values))
+            self.cache = from_legacy(legacy)
+            self.attention_mask = self._concat_masks(self.attention_mask, mask)
+        else:
+            self.cache = outputs.past_key_values
+            self.attention_mask = mask
+        self.running.append(request)
+
+        self._append_token(request, self._sample(request, outputs.logits[:, -1, :]))
+
+    def _prefill(self, request: GenerationRequest):
+        input_ids = torch.tensor([request.input_ids], device=self.device)
+        if request.prefix is None:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+            request.tokens = list(request.input_ids)
+            return outputs
+
+        # Only the part after the cached prefix goes through the model.
+        prefix_length = len(request.prefix.input_ids)
+        total_length = prefix_length + input_ids.shape[1]
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.ones(1, total_length, dtype=torch.long, device=self.device),
+            position_ids=torch.arange(prefix_length, total_length, device=self.device).unsqueeze(0),
+            past_key_values=from_legacy(request.prefix.cache),
+            use_cache=True,
+        )
+        request.tokens = request.prefix.input_ids + request.input_ids
+        return outputs
+
+    @staticmethod
+    def _concat_masks(first: torch.Tensor, second: torch.Tensor) -> torch.Tensor:
+        length = max(first.shape[1], second.shape[1])
+        first = torch.nn.functional.pad(first, (length - first.shape[1], 0))
+        second = torch.nn.functional.pad(second, (length - second.shape[1], 0))
+        return torch.cat([first, second], dim=0)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        batch_size = len(self.running)
+        input_ids = torch.tensor([[r.tokens[-1]] for r in self.running], device=self.device)
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, torch.ones(batch_size, 1, dtype=torch.long, device=self.device)],
+            dim=1,
+        )
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = outputs.past_key_values
+
+        logits = outputs.logits[:, -1, :]
+        for row, request in enumerate(self.running):
+            self._append_token(request, self._sample(request, logits[row:row + 1]))
+
+    @torch.no_grad()
+    def _speculative_step(self, request: GenerationRequest):
+        speculation = request.speculation
+        length = len(request.tokens)
+        # Never draft past the token budget or the context window.
+        count = min(speculation.num_draft_tokens, request.max_new_tokens - len(request.generated) - 1)
+        if self.max_positions:
+            count = min(count, self.max_positions - length - 1)
+        count = max(count, 0)
+
+        def distribution(history, logits):
+            return self._distribution(request, history, logits)
+
+        drafted, proposals = speculation.draft(request.tokens, count, distribution)
+        for token in speculation.verify(self.model, request.tokens, drafted, proposals, distribution):
+            self._append_token(request, token)
+            if request.finish_reason is not None:
+                break
+        speculation.trim(len(request.tokens) - 1)
+
+    @staticmethod
+    def _distribution(request: GenerationRequest, history: List[int], logits: torch.Tensor) -> torch.Tensor:
+        """Next-token probabilities after the request's processors; one-hot when greedy."""
+        scores = request.processors(torch.tensor([history], device=logits.device), logits.float())
+        if not request.params.get("do_sample", True):
+            return torch.nn.functional.one_hot(scores.argmax(dim=-1), scores.shape[-1]).float()
+        return torch.softmax(scores, dim=-1)
+
+    def _sample(self, request: GenerationRequest, logits: torch.Tensor) -> int:
+        history = torch.tensor([request.tokens], device=logits.device)
+        scores = request.processors(history, logits.float())
+        if not request.params.get("do_sample", True):
+            return int(scores.argmax(dim=-1))
+        probs = torch.softmax(scores, dim=-1)
+        if request.seed is not None:
+            if request.generator is None:
+                request.generator = torch.Generator(device=probs.device).manual_seed(request.seed)
+            return int(torch.multinomial(probs, num_samples=1, generator=request.generator))
+        return int(torch.multinomial(probs, num_samples=1))
+
+    def _append_token(self, request: GenerationRequest, token: int):
+        if request.first_token_at is None:
+            request.first_token_at = time.monotonic()
+        request.tokens.append(token)
+        request.generated.append(token)
+        stopped = False
+        if token in self.eos_token_ids:
+            release, stopped = (request.stop.flush() if request.stop else []), True
+            request.trailing = 1
+        elif request.stop is not None:
+            release, stopped = request.stop.push(token)
+            request.trailing = request.stop.discarded
+        else:
+            release = [token]
+
+        if len(request.generated) >= request.max_new_tokens:
+            request.finish_reason = "length"
+        elif self.max_positions and len(request.tokens) >= self.max_positions:
+            request.finish_reason = "length"
+        if stopped:
+            request.finish_reason = "stop"
+        elif request.finish_reason == "length" and request.stop is not None:
+            release += request.stop.flush()
+
+        try:
+            for released in release:
+                request.streamer.put(torch.tensor([released]))
+        except Exception:
+            # The consumer is gone (e.g. its event loop closed); only this sequence stops.
+            logger.exception("Streaming a token failed")
+            request.finish_reason = "cancelled"
+
+    def _retire_finished(self):
+        for request in self.running + self.speculative:
+            if request.finish_reason is None and request.cancelled.is_set():
+                request.finish_reason = "cancelled"
+
+        if any(r.finish_reason is not None for r in self.speculative):
+            self._retire_speculative()
+
+        keep = [i for i, r in enumerate(self.running) if r.finish_reason is None]
+        if len(keep) == len(self.running):
+            return
+
+        legacy = to_legacy(self.cache)
+        for row, request in enumerate(self.running):
+            if request.finish_reason is None:
+                continue
+            if request.keep_cache and request.finish_reason in ("stop", "length"):
+                start = int(self.attention_mask[row].nonzero()[0])
+                request.cache = [
+                    (k[row:row + 1, :, start:].clone(), v[row:row + 1, :, start:].clone())
+                    for k, v in legacy
+                ]
+            self._finish(request, request.finish_reason)
+
+        if not keep:
+            self.running = []
+            self.cache = None
+            self.attention_mask = None
+            return
+
+        indices = torch.tensor(keep, device=self.device)
+        legacy = select_batch(legacy, indices)
+        mask = self.attention_mask.index_select(0, indices)
+
+        # Columns that were padding for every remaining row can go.
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.cache = from_legacy(slice_positions(legacy, start))
+        self.attention_mask = mask[:, start:]
+        self.running = [self.running[i] for i in keep]
+
+    def _retire_speculative(self):
+        for request in self.speculative:
+            if request.finish_reason is None:
+                continue
+            if request.keep_cache and request.finish_reason in ("stop", "length"):
+                request.cache = [(k.clone(), v.clone()) for k, v in to_legacy(request.speculation.target_cache)]
+            request.speculation.target_cache = request.speculation.draft_cache = None
+            self._finish(request, request.finish_reason)
+        self.speculative = [r for r in self.speculative if r.finish_reason is None]
+
+    @staticmethod
+    def _finish(request: GenerationRequest, reason: str):
+        request.finish_reason = reason
+        request.finished_at = time.monotonic()
+        request.done.set()
+        try:
+            request.streamer.end()
+        except Exception:
+            logger.exception("Closing a token stream failed")
@@ -0,0 +1,151 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+from app.services.kv_cache import LegacyCache, nbytes, seq_length, slice_positions
+from app.services.prefix_cache import CachedPrefix
+
+logger = logging.getLogger(__name__)
+
+
+# Total memory that conversation KV caches may hold across all sessions.
+SESSION_CACHE_BUDGET = int(os.getenv("SESSION_CACHE_BUDGET", 1024 ** 3))
+
+
+class ChatSession:
+    def __init__(self, session_id: str = None):
+        self.id = session_id or uuid.uuid4().hex
+        self.context = None
+        # Token ids covered by `cache`; kept after eviction so the
+        # conversation can be re-prefilled.
+        self.tokens: List[int] = []
+        # Tokens produced last turn that are not in the cache yet.
+        self.pending: List[int] = []
+        self.cache: Optional[LegacyCache] = None
+        # Where each turn's user message starts in `tokens`, and where the one being generated will.
+        self.turns: List[int] = []
+        self.turn_start: Optional[int] = None
+
+    @property
+    def nbytes(self) -> int:
+        return nbytes(self.cache) if self.cache else 0
+
+    def reset(self, context=None):
+        self.context = context
+        self.tokens = []
+        self.pending = []
+        self.cache = None
+        self.turns = []
+        self.turn_start = None
+
+    def past(self) -> Optional[CachedPrefix]:
+        if self.cache is None:
+            return None
+        return CachedPrefix(self.id, self.tokens, self.cache)
+
+
+class SessionStore:
+    """
+    Keeps per-connection conversation caches within a shared memory budget.
+
+    When the budget is exceeded the least recently used sessions lose their
+    KV cache (but not their token history) and are re-prefilled next turn.
+    """
+
+    def __init__(self, budget_bytes: int = SESSION_CACHE_BUDGET):
+        self.budget_bytes = budget_bytes
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._close_listeners = []
+        self.evictions = 0
+
+    def add_close_listener(self, listener):
+        self._close_listeners.append(listener)
+
+    def create(self, session_id: str = None) -> ChatSession:
+        session = ChatSession(session_id)
+        with self._lock:
+            self._sessions[session.id] = session
+        return session
+
+    def close(self, session: ChatSession):
+        with self._lock:
+            self._sessions.pop(session.id, None)
+        session.reset()
+        for listener in self._close_listeners:
+            listener(session)
+
+    def save_turn(self, session: ChatSession, request):
+        if request.cache is None:
+            return
+
+        # An EOS or stop string that ended the turn is not part of the conversation.
+        end = len(request.tokens) - request.trailing
+        cache = request.cache
+        cached_length = seq_length(cache)
+        if cached_length > end:
+            cache = slice_positions(cache, 0, end)
+            cached_length = end
+        with self._lock:
+            session.tokens = request.tokens[:cached_length]
+            session.pending = request.tokens[cached_length:end]
+            session.cache = cache
+            if session.turn_start is not None:
+                session.turns.append(session.turn_start)
+                session.turn_start = None
+            if session.id in self._sessions:
+                self._sessions.move_to_end(session.id)
+            self._evict()
+
+    def record_turn(self, session: ChatSession, tokens: List[int], turn_start: int):
+        # The turn has no KV cache, so the whole conversation is re-prefilled next turn.
+        with self._lock:
+            session.tokens = session.tokens + session.pending + tokens
+            session.pending = []
+            session.cache = None
+            session.turns.append(turn_start)
+            session.turn_start = None
+
+    def drop_turns(self, session: ChatSession, excess: int, prefix_length: int) -> bool:
+        """
+        Removes the oldest whole turns (after the preset prefix) until at least
+        `excess` tokens are gone; False if that would leave no turn at all.
+        """
+        with self._lock:
+            tokens = session.tokens + session.pending
+            for index, start in enumerate(session.turns[1:], start=1):
+                if start - prefix_length >= excess:
+                    session.tokens = tokens[:prefix_length] + tokens[start:]
+                    session.pending = []
+                    session.cache = None
+                    session.turns = [turn - start + prefix_length for turn in session.turns[index:]]
+                    return True
+            return False
+
+    def _evict(self):
+        used = sum(s.nbytes for s in self._sessions.values())
+        for session_id, session in list(self._sessions.items()):
+            if used <= self.budget_bytes:
+                break
+            if session.cache is None:
+                continue
+            used -= session.nbytes
+            session.cache = None
+            self.evictions += 1
+            logger.info(f"Evicted KV cache of session {session_id[:8]}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "cached_sessions": sum(1 for s in self._sessions.values() if s.cache is not None),
+                "used_bytes": sum(s.nbytes for s in self._sessions.values()),
+                "budget_bytes": self.budget_bytes,
+                "evictions": self.evictions,
+            }
+
+
+sessions = SessionStore()
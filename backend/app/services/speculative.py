@@ -0,0 +1,124 @@
+import os
+from typing import Callable, List, Optional, Tuple
+
+import torch
+
+from app.services.kv_cache import from_legacy, seq_length, slice_positions, to_legacy
+
+# Tokens the draft model proposes per round; the target checks them all in one forward pass.
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", 4))
+
+# Maps (history, logits) to the next-token distribution the request samples from.
+Distribution = Callable[[List[int], torch.Tensor], torch.Tensor]
+
+
+def crop(cache, length: int):
+    legacy = to_legacy(cache)
+    if seq_length(legacy) <= length:
+        return cache
+    return from_legacy(slice_positions(legacy, 0, length))
+
+
+class SpeculativeState:
+    """
+    Per-sequence state for speculative decoding (Leviathan et al., 2023).
+
+    Both caches cover every token of the sequence except the last one, like
+    the batched cache does; the draft cache may lag further behind and is
+    caught up at the start of the next round.
+    """
+
+    def __init__(self, draft_model, vocab_size: Optional[int] = None, num_draft_tokens: int = SPECULATIVE_DRAFT_TOKENS):
+        self.draft_model = draft_model
+        # Logits are cut to the vocabulary both models share (their heads may be padded differently).
+        self.vocab_size = vocab_size
+        self.num_draft_tokens = num_draft_tokens
+        self.target_cache = None
+        self.draft_cache = None
+        self.rounds = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def stats(self) -> dict:
+        return {
+            "draft_tokens": self.drafted,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": round(self.accepted / self.drafted, 3) if self.drafted else None,
+            # Tokens produced per target forward pass; 1.0 is plain decoding.
+            "tokens_per_target_pass": round((self.accepted + self.rounds) / self.rounds, 2) if self.rounds else None,
+        }
+
+    def draft(self, tokens: List[int], count: int, distribution: Distribution) -> Tuple[List[int], List[torch.Tensor]]:
+        device = self.draft_model.device
+        drafted, proposals = [], []
+        position = seq_length(to_legacy(self.draft_cache))
+        feed = tokens[position:]
+        for _ in range(count):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([feed], device=device),
+                position_ids=torch.arange(position, position + len(feed), device=device).unsqueeze(0),
+                past_key_values=self.draft_cache,
+                use_cache=True,
+            )
+            self.draft_cache = outputs.past_key_values
+            position += len(feed)
+
+            q = distribution(tokens + drafted, outputs.logits[:, -1, :self.vocab_size])
+            token = int(torch.multinomial(q, num_samples=1))
+            drafted.append(token)
+            proposals.append(q)
+            feed = [token]
+        return drafted, proposals
+
+    def verify(
+        self,
+        model,
+        tokens: List[int],
+        drafted: List[int],
+        proposals: List[torch.Tensor],
+        distribution: Distribution,
+    ) -> List[int]:
+        """
+        Runs the target over the last token and the drafted ones, and returns
+        the accepted prefix of the draft followed by one token sampled from
+        the target. The result is distributed exactly as sampling the target
+        one token at a time.
+        """
+        device = model.device
+        position = len(tokens) - 1
+        feed = [tokens[-1]] + drafted
+        outputs = model(
+            input_ids=torch.tensor([feed], device=device),
+            position_ids=torch.arange(position, position + len(feed), device=device).unsqueeze(0),
+            past_key_values=self.target_cache,
+            use_cache=True,
+        )
+        self.target_cache = outputs.past_key_values
+        logits = outputs.logits[0, :, :self.vocab_size]
+
+        history = list(tokens)
+        result: Optional[List[int]] = None
+        for i, (token, q) in enumerate(zip(drafted, proposals)):
+            p = distribution(history, logits[i:i + 1])
+            if float(torch.rand(())) < float(p[0, token] / q[0, token]):
+                history.append(token)
+                continue
+            # Rejected: resample from the part of p the draft under-proposed.
+            residual = (p - q).clamp(min=0)
+            if float(residual.sum()) <= 0:
+                residual = p
+            result = drafted[:i] + [int(torch.multinomial(residual / residual.sum(), num_samples=1))]
+            break
+        if result is None:
+            bonus = distribution(history, logits[len(drafted):len(drafted) + 1])
+            result = drafted + [int(torch.multinomial(bonus, num_samples=1))]
+
+        self.rounds += 1
+        self.drafted += len(drafted)
+        self.accepted += len(result) - 1
+        return result
+
+    def trim(self, length: int):
+        """Drops cache entries past the first `length` tokens (rejected draft tokens)."""
+        self.target_cache = crop(self.target_cache, length)
+        self.draft_cache = crop(self.draft_cache, length)
@@ -0,0 +1,100 @@
+import threading
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+
+class StopCriteria:
+    """
+    Stop strings and stop token ids of one request, checked as each token is
+    decoded. Tokens whose text could still be the start of a stop string are
+    held back from the stream until that is ruled out, so the client never
+    sees any part of a stop string.
+    """
+
+    def __init__(self, tokenizer, stop_strings: Iterable[str] = (), stop_token_ids: Iterable[int] = ()):
+        self.tokenizer = tokenizer
+        self.stop_strings = [s for s in stop_strings if s]
+        self.stop_token_ids = set(stop_token_ids)
+        self.held: List[int] = []
+        self.matched: Optional[str] = None
+        # Generated tokens that end the reply without being part of it.
+        self.discarded = 0
+
+    def _text(self, tokens: List[int]) -> str:
+        return self.tokenizer.decode(tokens, skip_special_tokens=True)
+
+    def push(self, token: int) -> Tuple[List[int], bool]:
+        """Returns the tokens that can be streamed now and whether generation should stop."""
+        if token in self.stop_token_ids:
+            self.discarded = 1
+            return self.flush(), True
+        if not self.stop_strings:
+            return [token], False
+
+        self.held.append(token)
+        text = self._text(self.held)
+        found = [(text.find(s), s) for s in self.stop_strings if s in text]
+        if found:
+            start, self.matched = min(found)
+            # Release the tokens that lie entirely before the stop string.
+            release = []
+            while self.held and len(self._text(release + self.held[:1])) <= start:
+                release.append(self.held.pop(0))
+            self.discarded = len(self.held)
+            self.held = []
+            return release, True
+
+        overlap = self._overlap(text)
+        release = []
+        while self.held and len(self._text(self.held[1:])) >= overlap:
+            release.append(self.held.pop(0))
+        return release, False
+
+    def _overlap(self, text: str) -> int:
+        """Length of the longest end of text that begins some stop string."""
+        longest = 0
+        for stop in self.stop_strings:
+            for length in range(min(len(stop) - 1, len(text)), longest, -1):
+                if text.endswith(stop[:length]):
+                    longest = length
+                    break
+        return longest
+
+    def flush(self) -> List[int]:
+        release, self.held = self.held, []
+        return release
+
+
+class GenerationStats:
+    """How generations ended across all requests, and the tokens thrown away at stop strings."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.finish_reasons: Counter = Counter()
+        self.stop_sequences = 0
+        self.completion_tokens = 0
+        self.wasted_tokens = 0
+
+    def record(self, metadata: dict):
+        with self._lock:
+            self.finish_reasons[metadata.get("finish_reason")] += 1
+            self.completion_tokens += metadata.get("completion_tokens") or 0
+            self.wasted_tokens += metadata.get("wasted_tokens") or 0
+            if metadata.get("stop_sequence"):
+                self.stop_sequences += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = sum(self.finish_reasons.values())
+            return {
+                "requests": requests,
+                "finish_reasons": dict(self.finish_reasons),
+                "stopped_by_sequence": self.stop_sequences,
+                "completion_tokens": self.completion_tokens,
+                "wasted_tokens": self.wasted_tokens,
+                "wasted_share": round(self.wasted_tokens / self.completion_tokens, 3) if self.completion_tokens else None,
+            }
+
+
+# Singleton instance
+generation_stats = GenerationStats()
@@ -0,0 +1,522 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from transformers import TextStreamer
+
+from app.models.model import Model as DBModel
+from app.models.preset import Preset as DBPreset
+from app.services.load_profiles import DEFAULT_LOAD_PROFILE
+from app.services.mmap_loader import memory_report
+from app.services.model_runtime import ModelRuntime, preset_to_dict
+from app.services.sessions import ChatSession, sessions
+
+logger = logging.getLogger(__name__)
+
+
+# Number of inference worker processes; 0 keeps generation in the API process.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0))
+# Torch intra-op threads per worker; 0 means one per core in the worker's core set.
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 0))
+WORKER_CALL_TIMEOUT = 600
+
+
+def split_cores(worker_count: int) -> List[List[int]]:
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    chunk = max(1, len(cores) // worker_count)
+    return [cores[i * chunk:(i + 1) * chunk] or cores for i in range(worker_count)]
+
+
+class _ForwardingStreamer(TextStreamer):
+    def __init__(self, tokenizer, request_id: int, on_text, on_end):
+        super().__init__(tokenizer, skip_special_tokens=True)
+        self.request_id = request_id
+        self.on_text = on_text
+        self.on_end = on_end
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.on_text(self.request_id, text)
+        if stream_end:
+            self.on_end(self.request_id)
+
+
+class _Worker:
+    def __init__(self, index: int, results):
+        self.index = index
+        self.results = results
+        self.runtimes: Dict[int, ModelRuntime] = {}
+        self.requests = {}
+        self.ready = {}
+        self.sessions: Dict[str, ChatSession] = {}
+
+    def load(self, model: dict, preset: dict, model_path: str, draft_path: str = None) -> int:
+        runtime = self.runtimes.get(model["id"])
+        if runtime is None:
+            runtime = ModelRuntime()
+            runtime.load_model(SimpleNamespace(**model), SimpleNamespace(**preset), model_path, draft_path)
+            self.runtimes[model["id"]] = runtime
+        else:
+            runtime.update_preset(SimpleNamespace(**preset), draft_path)
+        return runtime.memory_footprint()
+
+    def load_timings(self, model_id: int) -> Optional[dict]:
+        return self.runtimes[model_id].active_model.get("load_timings")
+
+    def update_preset(self, model_id: int, preset: Optional[dict], draft_path: str = None) -> int:
+        runtime = self.runtimes[model_id]
+        runtime.update_preset(SimpleNamespace(**preset) if preset is not None else None, draft_path)
+        return runtime.memory_footprint()
+
+    def stop(self, model_id: int):
+        runtime = self.runtimes.pop(model_id, None)
+        if runtime is not None:
+            runtime.stop_model()
+
+    def generate(self, request_id: int, model_id: int, message: str, session_id: Optional[str], preset: dict = None):
+        runtime = self.runtimes.get(model_id)
+        if runtime is None:
+            self.results.put(("end", request_id, {"finish_reason": "error", "error": "Model not loaded."}))
+            return
+
+        session = None
+        if session_id is not None:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = sessions.create(session_id)
+
+        self.ready[request_id] = threading.Event()
+        streamer = _ForwardingStreamer(runtime.tokenizer, request_id, self._send_text, self._send_end)
+        try:
+            self.requests[request_id] = (runtime.submit(message, streamer, session, preset), session)
+        except RuntimeError as e:
+            self.ready.pop(request_id)
+            self.results.put(("end", request_id, {"finish_reason": "error", "error": str(e)}))
+            return
+        self.ready[request_id].set()
+
+    def generate_batch(self, request_id: int, model_id: int, messages: List[str], preset: dict = None):
+        runtime = self.runtimes.get(model_id)
+        if runtime is None:
+            self.results.put(("end", request_id, {"error": "Model not loaded."}))
+            return
+        try:
+            requests = runtime.submit_batch(messages, preset)
+        except RuntimeError as e:
+            self.results.put(("end", request_id, {"error": str(e)}))
+            return
+
+        # Wait off the command loop so the worker keeps taking interactive requests.
+        def collect():
+            for request in requests:
+                request.done.wait()
+            self.results.put(("end", request_id, {"results": [runtime.batch_result(r) for r in requests]}))
+
+        threading.Thread(target=collect, name=f"batch-{request_id}", daemon=True).start()
+
+    def record_turn(self, model_id: int, session_id: str, message: str, reply: str, preset: dict = None):
+        runtime = self.runtimes.get(model_id)
+        if runtime is None:
+            return
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = sessions.create(session_id)
+        runtime.record_turn(session, message, reply, preset)
+
+    def cancel(self, request_id: int):
+        entry = self.requests.get(request_id)
+        if entry is not None:
+            entry[0].cancel()
+
+    def memory_report(self) -> dict:
+        return {"worker": self.index, "pid": os.getpid(), **memory_report()}
+
+    def close_session(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            sessions.close(session)
+
+    def _send_text(self, request_id: int, text: str):
+        self.results.put(("token", request_id, text))
+
+    def _send_end(self, request_id: int):
+        # Runs on the scheduler thread, possibly before generate() stored the request.
+        self.ready[request_id].wait()
+        request, session = self.requests.pop(request_id)
+        self.ready.pop(request_id, None)
+        if session is not None:
+            sessions.save_turn(session, request)
+        self.results.put(("end", request_id, request.metadata()))
+
+
+# Commands that can take minutes; they run off the command loop so the
+# worker keeps serving its other models meanwhile.
+BACKGROUND_COMMANDS = ("load", "update_preset")
+
+
+def _run_command(worker: _Worker, op_id: Optional[int], name: str, args: tuple):
+    try:
+        reply = getattr(worker, name)(*args)
+    except Exception as e:
+        logger.exception(f"Worker {worker.index} failed on {name}")
+        if op_id is not None:
+            worker.results.put(("error", op_id, f"{type(e).__name__}: {e}"))
+        return
+    if op_id is not None:
+        worker.results.put(("reply", op_id, reply))
+
+
+def _worker_main(index: int, cores: List[int], threads: int, commands, results):
+    import torch
+
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads or len(cores) or 1)
+    logger.info(f"Inference worker {index} on cores {cores} with {torch.get_num_threads()} threads")
+
+    worker = _Worker(index, results)
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        op_id, name, args = command
+        if name in BACKGROUND_COMMANDS:
+            threading.Thread(
+                target=_run_command, args=(worker, op_id, name, args), name=f"worker-{index}-{name}", daemon=True
+            ).start()
+            continue
+        _run_command(worker, op_id, name, args)
+
+    for model_id in list(worker.runtimes):
+        worker.stop(model_id)
+
+
+class WorkerPool:
+    """
+    Inference worker processes, each pinned to its own core set.
+
+    Every resident model is loaded in each worker; requests go to the worker
+    with the fewest in-flight generations, and a chat session sticks to the
+    worker that holds its KV cache. Tokens come back over a shared result
+    queue read by a dispatcher thread.
+    """
+
+    def __init__(self, worker_count: int, threads: int = WORKER_THREADS):
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.commands = []
+        self.processes = []
+        for index, cores in enumerate(split_cores(worker_count)):
+            commands = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                args=(index, cores, threads, commands, self.results),
+                name=f"inference-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self.commands.append(commands)
+            self.processes.append(process)
+
+        self._ids = itertools.count(1)
+        self._replies: Dict[int, queue.Queue] = {}
+        self._streams: Dict[int, "RemoteTokenStream"] = {}
+        self._in_flight = [0] * worker_count
+        self._session_workers: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name="worker-dispatcher", daemon=True)
+        self._dispatcher.start()
+        sessions.add_close_listener(self.close_session)
+
+    @property
+    def size(self) -> int:
+        return len(self.processes)
+
+    def call(self, worker: int, name: str, *args):
+        return self._wait(worker, self._request(worker, name, args))
+
+    def broadcast(self, name: str, *args) -> list:
+        # Send to every worker first so they work in parallel, then collect.
+        op_ids = [self._request(worker, name, args) for worker in range(self.size)]
+        return [self._wait(worker, op_id) for worker, op_id in enumerate(op_ids)]
+
+    def send(self, worker: int, name: str, *args):
+        self.commands[worker].put((None, name, args))
+
+    def pick_worker(self, session: Optional[ChatSession]) -> int:
+        with self._lock:
+            if session is not None and session.id in self._session_workers:
+                return self._session_workers[session.id]
+            worker = min(range(self.size), key=lambda i: self._in_flight[i])
+            if session is not None:
+                self._session_workers[session.id] = worker
+            return worker
+
+    def open_stream(self, model_id: int, message: str, session: Optional[ChatSession], preset: dict = None) -> "RemoteTokenStream":
+        worker = self.pick_worker(session)
+        request_id = next(self._ids)
+        stream = RemoteTokenStream(self, worker, request_id, model_id)
+        with self._lock:
+            self._streams[request_id] = stream
+            self._in_flight[worker] += 1
+        self.send(worker, "generate", request_id, model_id, message, session.id if session else None, preset)
+        return stream
+
+    def generate_batch(self, model_id: int, messages: List[str], preset: dict = None) -> List[dict]:
+        worker = self.pick_worker(None)
+        request_id = next(self._ids)
+        reply = _BatchReply(model_id)
+        with self._lock:
+            self._streams[request_id] = reply
+            self._in_flight[worker] += len(messages)
+        try:
+            self.send(worker, "generate_batch", request_id, model_id, messages, preset)
+            while True:
+                try:
+                    payload = reply.queue.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not self.processes[worker].is_alive():
+                        raise RuntimeError(f"Inference worker {worker} exited")
+        finally:
+            with self._lock:
+                if self._streams.pop(request_id, None) is not None:
+                    self._in_flight[worker] -= len(messages)
+        if "error" in payload:
+            raise RuntimeError(payload["error"])
+        return payload["results"]
+
+    def streams_for(self, model_id: int) -> int:
+        with self._lock:
+            return sum(1 for stream in self._streams.values() if stream.model_id == model_id)
+
+    def forget(self, stream: "RemoteTokenStream"):
+        with self._lock:
+            if self._streams.pop(stream.request_id, None) is not None:
+                self._in_flight[stream.worker] -= 1
+
+    def close_session(self, session: ChatSession):
+        with self._lock:
+            worker = self._session_workers.pop(session.id, None)
+        if worker is not None:
+            self.send(worker, "close_session", session.id)
+
+    def _request(self, worker: int, name: str, args: tuple) -> int:
+        op_id = next(self._ids)
+        self._replies[op_id] = queue.Queue()
+        self.commands[worker].put((op_id, name, args))
+        return op_id
+
+    def _wait(self, worker: int, op_id: int):
+        deadline = time.monotonic() + WORKER_CALL_TIMEOUT
+        try:
+            while True:
+                try:
+                    kind, payload = self._replies[op_id].get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not self.processes[worker].is_alive():
+                        raise RuntimeError(f"Inference worker {worker} exited")
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"Inference worker {worker} did not answer")
+        finally:
+            self._replies.pop(op_id, None)
+        if kind == "error":
+            raise RuntimeError(f"Inference worker {worker}: {payload}")
+        return payload
+
+    def shutdown(self):
+        for commands in self.commands:
+            commands.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.results.put(None)
+        self._dispatcher.join(timeout=5)
+
+    def _dispatch(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            kind, key, payload = message
+            if kind in ("reply", "error"):
+                replies = self._replies.get(key)
+                if replies is not None:
+                    replies.put((kind, payload))
+                continue
+            stream = self._streams.get(key)
+            if stream is not None:
+                stream.push(kind, payload)
+
+
+class _BatchReply:
+    def __init__(self, model_id: int):
+        self.model_id = model_id
+        self.queue: queue.Queue = queue.Queue()
+
+    def push(self, kind: str, payload):
+        if kind == "end":
+            self.queue.put(payload)
+
+
+class RemoteTokenStream:
+    def __init__(self, pool: WorkerPool, worker: int, request_id: int, model_id: int = None):
+        self.pool = pool
+        self.worker = worker
+        self.request_id = request_id
+        self.model_id = model_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._metadata = {}
+        self._finished = False
+
+    def push(self, kind: str, payload):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (kind, payload))
+        except RuntimeError:
+            # The connection's event loop is gone.
+            self.cancel()
+
+    def cancel(self):
+        if not self._finished:
+            self.pool.send(self.worker, "cancel", self.request_id)
+
+    def metadata(self) -> dict:
+        return self._metadata
+
+    async def __aiter__(self):
+        try:
+            while True:
+                kind, payload = await self.queue.get()
+                if kind == "token":
+                    yield payload
+                    continue
+                self._metadata = payload
+                self._finished = True
+                break
+        finally:
+            self.cancel()
+            self.pool.forget(self)
+
+        yield "__END__"
+
+
+class RemoteRuntime:
+    """Stands in for ModelRuntime when the model lives in worker processes."""
+
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+        self.active_model = None
+        self.preset = None
+        self.footprints = []
+
+    def load_model(self, model: DBModel, preset: DBPreset, model_path: str, draft_path: str = None):
+        model_info = {
+            "id": model.id,
+            "model_name": model.model_name,
+            "huggin_face_refference": model.huggin_face_refference,
+            "size": model.size,
+            "load_profile": getattr(model, "load_profile", None) or DEFAULT_LOAD_PROFILE,
+        }
+        self.preset = preset_to_dict(preset)
+        self.footprints = self.pool.broadcast("load", model_info, self.preset, model_path, draft_path)
+        self.active_model = {
+            "id": model.id,
+            "model_name": model.model_name,
+            "reference": model.huggin_face_refference,
+            "size": model.size,
+            "path": model_path,
+            "load_profile": model_info["load_profile"],
+            "draft_model": draft_path,
+            "workers": self.pool.size,
+            # One entry per worker; they load in parallel.
+            "load_timings": self.pool.broadcast("load_timings", model.id),
+        }
+        return {
+            "status": "loaded",
+            "model": self.active_model,
+            "preset": self.preset
+        }
+
+    def update_preset(self, preset: Optional[DBPreset], draft_path: str = None):
+        if preset is not None:
+            self.preset = preset_to_dict(preset)
+        self.footprints = self.pool.broadcast(
+            "update_preset", self.active_model["id"], self.preset if preset is not None else None, draft_path
+        )
+        self.active_model["draft_model"] = draft_path
+
+    def warm_prefix(self, preset: dict = None):
+        # Workers prefill on their own side; nothing blocks the caller.
+        pass
+
+    def get_current_model_info(self):
+        if not self.active_model:
+            return None
+        return {
+            "id": self.active_model.get("id"),
+            "model_name": self.active_model.get("model_name"),
+            "load_timings": self.active_model.get("load_timings"),
+        }
+
+    def in_flight(self) -> int:
+        return self.pool.streams_for(self.active_model["id"]) if self.active_model else 0
+
+    def memory_footprint(self) -> int:
+        return sum(self.footprints)
+
+    def stop_model(self):
+        if self.active_model:
+            self.pool.broadcast("stop", self.active_model["id"])
+        self.active_model = None
+        self.preset = None
+        self.footprints = []
+        return {"status": "stopped"}
+
+    def open_stream(self, message: str, session: ChatSession = None, preset: dict = None) -> RemoteTokenStream:
+        if not self.active_model:
+            raise RuntimeError("Model not loaded.")
+        return self.pool.open_stream(self.active_model["id"], message, session, preset)
+
+    def record_turn(self, session: ChatSession, message: str, reply: str, preset: dict = None):
+        if self.active_model:
+            worker = self.pool.pick_worker(session)
+            self.pool.send(worker, "record_turn", self.active_model["id"], session.id, message, reply, preset)
+
+    def generate_batch(self, messages: List[str], preset: dict = None) -> List[dict]:
+        if not self.active_model:
+            raise RuntimeError("Model not loaded.")
+        return self.pool.generate_batch(self.active_model["id"], messages, preset)
+
+
+_worker_pool: Optional[WorkerPool] = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool() -> WorkerPool:
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = WorkerPool(INFERENCE_WORKERS)
+        return _worker_pool
+
+
+def shutdown_worker_pool():
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is not None:
+            _worker_pool.shutdown()
+            _worker_pool = None
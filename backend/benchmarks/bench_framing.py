@@ -0,0 +1,81 @@
+"""
+Compares WebSocket framing modes of /inference/ws on a synthetic token stream.
+
+    cd backend
+    python -m benchmarks.bench_framing --tokens 20000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from fastapi import FastAPI, WebSocket
+from fastapi.testclient import TestClient
+
+from app.services.framing import StreamFramer, framed, negotiate_protocol, send_frame
+
+
+def build_app(token_count: int, token_interval: float) -> FastAPI:
+    app = FastAPI()
+
+    async def tokens():
+        for i in range(token_count):
+            if token_interval:
+                await asyncio.sleep(token_interval)
+            yield f" tok{i % 100}"
+
+    @app.websocket("/ws")
+    async def ws(websocket: WebSocket):
+        protocol, subprotocol = negotiate_protocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        framer = StreamFramer(protocol)
+        await websocket.receive_text()
+        framer.start(1)
+        async for frame in framed(tokens(), framer):
+            await send_frame(websocket, frame)
+        await send_frame(websocket, framer.end({"finish_reason": "length"}))
+
+    return app
+
+
+def run(protocol: str, token_count: int, token_interval: float) -> dict:
+    client = TestClient(build_app(token_count, token_interval))
+    frames = 0
+    wall, cpu = time.perf_counter(), time.process_time()
+    with client.websocket_connect(f"/ws?protocol={protocol}") as ws:
+        ws.send_text("go")
+        while True:
+            message = ws.receive()
+            frames += 1
+            if protocol == "text" and message.get("text") == "__END__":
+                break
+            if protocol == "json" and '"done":true' in message.get("text", ""):
+                break
+            if protocol == "binary" and message.get("bytes", b"\0\0")[1] == 2:
+                break
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return {
+        "protocol": protocol,
+        "frames": frames,
+        "frames_per_sec": round(frames / wall),
+        "tokens_per_sec": round(token_count / wall),
+        "cpu_s": round(cpu, 3),
+        "cpu_us_per_token": round(cpu / token_count * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between synthetic tokens")
+    args = parser.parse_args()
+
+    results = [run(protocol, args.tokens, args.interval) for protocol in ("text", "json", "binary")]
+    baseline = results[0]["cpu_s"]
+    for result in results:
+        result["cpu_saved"] = f"{(1 - result['cpu_s'] / baseline) * 100:.0f}%"
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares the fp32, bf16 and int8 load profiles of a local model on CPU:
+load time (cold and from the int8 cache), weight memory, RSS growth,
+greedy decode throughput and output drift against fp32.
+
+    cd backend
+    python -m benchmarks.bench_load_profiles local_models/<model> --tokens 64
+"""
+import argparse
+import gc
+import time
+
+import torch
+from transformers import AutoTokenizer
+
+from app.services.load_profiles import LOAD_PROFILES, artifact_path, load_with_profile, model_nbytes
+from app.services.mmap_loader import memory_report
+
+
+def rss_kb() -> int:
+    return memory_report().get("rss_kb", 0)
+
+
+def decode(model, input_ids: torch.Tensor, tokens: int) -> tuple:
+    """Greedy decode; returns (generated ids, tokens/sec)."""
+    start = time.perf_counter()
+    with torch.no_grad():
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=tokens,
+            min_new_tokens=tokens,
+            do_sample=False,
+        )
+    elapsed = time.perf_counter() - start
+    generated = output[0, input_ids.shape[1]:]
+    return generated, len(generated) / elapsed
+
+
+def teacher_forced_logits(model, ids: torch.Tensor) -> torch.Tensor:
+    with torch.no_grad():
+        return model(ids.unsqueeze(0)).logits[0].float()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path")
+    parser.add_argument("--prompt", default="You are a helpful assistant. Explain what a hash table is.")
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--profiles", nargs="+", default=list(LOAD_PROFILES), choices=LOAD_PROFILES)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    input_ids = tokenizer(args.prompt, return_tensors="pt")["input_ids"]
+
+    reference_ids = reference_logits = None
+    print(f"{'profile':<8} {'load s':>8} {'cached s':>9} {'weights MB':>11} {'rss +MB':>8} "
+          f"{'tok/s':>8} {'max |dlogit|':>13} {'top1 agree':>11}")
+    for profile in args.profiles:
+        if profile == "int8":
+            artifact_path(args.model_path, profile).unlink(missing_ok=True)
+
+        gc.collect()
+        rss_before = rss_kb()
+        start = time.perf_counter()
+        model = load_with_profile(args.model_path, profile).eval()
+        load_s = time.perf_counter() - start
+        rss_mb = (rss_kb() - rss_before) / 1024
+
+        cached_s = None
+        if profile == "int8":
+            start = time.perf_counter()
+            load_with_profile(args.model_path, profile)
+            cached_s = time.perf_counter() - start
+
+        decode(model, input_ids, 4)  # warm up kernels
+        generated, tokens_per_s = decode(model, input_ids, args.tokens)
+
+        # Drift is measured on the fp32 continuation so every profile sees the same inputs.
+        if reference_ids is None:
+            reference_ids = torch.cat([input_ids[0], generated])
+        logits = teacher_forced_logits(model, reference_ids)
+        if reference_logits is None:
+            reference_logits = logits
+        max_drift = (logits - reference_logits).abs().max().item()
+        agree = (logits.argmax(-1) == reference_logits.argmax(-1)).float().mean().item()
+
+        cached = f"{cached_s:.2f}" if cached_s is not None else "-"
+        print(f"{profile:<8} {load_s:>8.2f} {cached:>9} {model_nbytes(model) / 1024 ** 2:>11.1f} "
+              f"{rss_mb:>8.1f} {tokens_per_s:>8.1f} {max_drift:>13.4f} {agree:>11.1%}")
+
+        del model
+        gc.collect()
+
+
+if __name__ == "__main__":
+    main()
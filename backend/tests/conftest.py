@@ -1,9 +1,14 @@
+from types import SimpleNamespace
+
+import pytest
 import pytest_asyncio
+import torch
 from httpx import AsyncClient, ASGITransport
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from app.db.database import Base, get_db
 from app.main import app
+from app.services.model_runtime import ModelRuntime
 
 
 DATABASE_URL = "sqlite+aiosqlite:///./test.db"
@@ -31,3 +36,143 @@ async def client(setup_test_db):
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as ac:
         yield ac
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    path = tmp_path_factory.mktemp("tiny-model")
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(["You are bot, your task is to answer the user message"] * 10, trainer)
+    fast_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>")
+    fast_tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(fast_tokenizer),
+        n_positions=512,
+        n_embd=32,
+        n_layer=2,
+        n_head=2,
+        bos_token_id=fast_tokenizer.eos_token_id,
+        eos_token_id=fast_tokenizer.eos_token_id,
+    )
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture
+def tiny_model():
+    return SimpleNamespace(id=1, model_name="tiny", huggin_face_refference="tiny", size="tiny")
+
+
+@pytest.fixture
+def tiny_preset():
+    return SimpleNamespace(
+        id=1, bot_name="Bot", task="answer", costraints="",
+        temperature=1.0, repetition_penalty=1.0, top_p=1.0, top_k=0,
+    )
+
+
+@pytest.fixture
+def tiny_runtime(tiny_model_path, tiny_model, tiny_preset):
+    """A ModelRuntime with the tiny model loaded, stopped after the test."""
+    runtime = ModelRuntime()
+    runtime.load_model(tiny_model, tiny_preset, str(tiny_model_path))
+    yield runtime
+    runtime.stop_model()
+
+
+class _HubStandIn:
+    """Local stand-in for the Hugging Face model API and file endpoints."""
+
+    def __init__(self):
+        self.repos = {}  # repo id -> {filename: bytes}
+        self.requests = []  # (path, Range header)
+        self.truncate_once = set()  # filenames whose first response is cut short
+        self.lfs_hashes = {}  # filename -> sha256 to advertise instead of the real one
+
+    def add_repo(self, repo: str, files: dict):
+        self.repos[repo] = files
+
+
+@pytest.fixture
+def hf_server():
+    import hashlib
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    hub = _HubStandIn()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            hub.requests.append((path, self.headers.get("Range")))
+            if path.startswith("/api/models/"):
+                repo = path[len("/api/models/"):].split("/revision/")[0]
+                files = hub.repos.get(repo)
+                if files is None:
+                    return self._send(404, b"{}")
+                siblings = []
+                for name, data in files.items():
+                    sibling = {"rfilename": name, "size": len(data or b"")}
+                    if data and name.endswith((".safetensors", ".bin")):
+                        sibling["lfs"] = {"sha256": hub.lfs_hashes.get(name) or hashlib.sha256(data).hexdigest()}
+                    siblings.append(sibling)
+                body = {
+                    "id": repo,
+                    "sha": "abc123",
+                    "siblings": siblings,
+                    "usedStorage": sum(len(data or b"") for data in files.values()),
+                }
+                return self._send(200, json.dumps(body).encode())
+
+            repo, _, rest = path[1:].partition("/resolve/")
+            filename = rest.partition("/")[2]
+            data = hub.repos.get(repo, {}).get(filename)
+            if data is None:
+                return self._send(404, b"not found")
+
+            start = 0
+            if self.headers.get("Range"):
+                start = int(self.headers["Range"].split("=")[1].split("-")[0])
+                if start >= len(data):
+                    return self._send(416, b"")
+            self.send_response(206 if start else 200)
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+            if filename in hub.truncate_once:
+                hub.truncate_once.discard(filename)
+                self.wfile.write(data[start:start + (len(data) - start) // 2])
+                self.wfile.flush()
+                self.connection.shutdown(2)
+                return
+            self.wfile.write(data[start:])
+
+        def _send(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    hub.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield hub
+    server.shutdown()
+    server.server_close()
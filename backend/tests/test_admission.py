@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from app.services.admission import AdmissionController, AdmissionRejected
+
+
+def _serve_all(admission, running, tickets):
+    """Releases one slot at a time and returns the tickets in the order they were admitted."""
+    order = []
+    while len(order) < len(tickets):
+        admission.release(running)
+        running = next(t for t in tickets if t.admitted and t not in order)
+        order.append(running)
+    admission.release(running)
+    return order
+
+
+@pytest.mark.asyncio
+async def test_waiting_requests_are_served_fairly_across_clients():
+    admission = AdmissionController(max_active=1, max_queued=10, max_queued_per_client=5)
+    running = admission.enqueue("a", "hi")
+    assert running.admitted
+
+    # Client a floods the queue before b shows up; b still gets the next slot.
+    waiting = [admission.enqueue("a", f"a{i}") for i in range(3)] + [admission.enqueue("b", "b0")]
+    assert [admission.position(t) for t in waiting] == [1, 3, 4, 2]
+
+    order = _serve_all(admission, running, waiting)
+    assert [t.client_id for t in order] == ["a", "b", "a", "a"]
+    assert admission.active == 0
+
+
+@pytest.mark.asyncio
+async def test_long_prompts_are_not_starved_by_short_ones():
+    admission = AdmissionController(max_active=1, max_queued=20, short_prompt_chars=10)
+    running = admission.enqueue("x", "hi")
+    tickets = [admission.enqueue(f"c{i}", "long prompt " * 5) for i in range(2)]
+    tickets += [admission.enqueue(f"s{i}", "short") for i in range(6)]
+
+    lanes = [t.lane for t in _serve_all(admission, running, tickets)]
+    assert lanes == ["short", "short", "short", "long", "short", "short", "short", "long"]
+
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_and_waiters_get_position_updates():
+    admission = AdmissionController(max_active=1, max_queued=2, max_queued_per_client=2)
+    running = admission.enqueue("a", "hi")
+    first = admission.enqueue("b", "hi")
+    second = admission.enqueue("c", "hi")
+    with pytest.raises(AdmissionRejected):
+        admission.enqueue("d", "hi")
+    assert admission.stats()["rejected"] == 1
+
+    positions = []
+
+    async def on_position(position):
+        positions.append(position)
+
+    waiter = asyncio.create_task(admission.wait(second, on_position))
+    await asyncio.sleep(0)
+    admission.release(running)  # first is admitted, second moves up
+    admission.release(first)
+    assert await asyncio.wait_for(waiter, 5)
+    assert positions[0] == 2
+    admission.release(second)
+
+    third = admission.enqueue("e", "hi")
+    assert third.admitted
+    admission.release(third)
+    admission.withdraw(third)
+    assert admission.active == 0
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from app.services.batch_jobs import BatchInputError, BatchJobManager, make_buckets
+
+
+def test_batch_job_writes_a_result_per_prompt(tiny_runtime, tmp_path):
+    manager = BatchJobManager(root=tmp_path, bucket_size=2)
+    job = manager.create(1, tiny_runtime.preset)
+    prompts = ["answer the user message please", "task", {"id": "q3", "prompt": "you are bot"}, "bot"]
+    job.input_path.write_text("\n".join(json.dumps(p) for p in prompts) + "\n\n")
+    manager.check_input(job)
+    # The prompts were parsed once, up front; the run does not read the file again.
+    job.input_path.unlink()
+    manager.start(job, lambda: tiny_runtime)
+    assert job.done.wait(timeout=60)
+
+    assert job.status == "completed" and job.total == 4
+    assert job.completed + job.failed == 4
+    lines = [json.loads(line) for line in job.output_path.read_text().splitlines()]
+    assert sorted(str(line["id"]) for line in lines) == ["0", "1", "3", "q3"]
+    for line in lines:
+        assert line["finish_reason"] in ("stop", "length")
+        assert {"text", "queue_ms", "ttft_ms", "total_ms", "completion_tokens"} <= set(line)
+
+    # Shortest prompts are batched together.
+    buckets = make_buckets([{"prompt": "a" * n} for n in (5, 1, 4, 2)], 2)
+    assert [[len(item["prompt"]) for item in bucket] for bucket in buckets] == [[1, 2], [4, 5]]
+
+
+def test_bad_input_fails_the_job_and_drops_the_file(tmp_path):
+    manager = BatchJobManager(root=tmp_path)
+    job = manager.create(1, {"id": 1})
+    job.input_path.write_text('{"prompt": "fine"}\nnot json\n')
+
+    with pytest.raises(BatchInputError, match="Line 2"):
+        manager.check_input(job)
+    assert job.status == "failed" and not job.input_path.exists()
@@ -0,0 +1,55 @@
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.db.database import Base, add_missing_columns, get_db
+from app.main import app
+
+
+# The tables as the first release created them.
+BASELINE_SCHEMA = [
+    "CREATE TABLE models (id INTEGER PRIMARY KEY, model_name VARCHAR NOT NULL, "
+    "huggin_face_refference VARCHAR NOT NULL, size VARCHAR)",
+    "CREATE TABLE presets (id INTEGER PRIMARY KEY, public_name VARCHAR NOT NULL, bot_name VARCHAR, "
+    "task VARCHAR(32000), costraints VARCHAR(32000), model_id INTEGER REFERENCES models (id), "
+    "temperature FLOAT, repetition_penalty FLOAT, top_p FLOAT, top_k FLOAT)",
+]
+
+
+@pytest.mark.asyncio
+async def test_presets_and_models_list_after_migrating_a_baseline_database(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'baseline.db'}")
+    async with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            await conn.execute(text(statement))
+        await conn.execute(text("INSERT INTO models VALUES (1, 'old-model', 'org/old-model', 'tiny')"))
+        await conn.execute(text("INSERT INTO presets VALUES (1, 'Old', 'bot', 'task', '', 1, 1.2, 1.0, 0.9, 20.0)"))
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+
+    session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def override_get_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            presets = await client.get("/presets/")
+            preset = await client.get("/presets/1")
+            models = await client.get("/models/")
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        await engine.dispose()
+
+    assert presets.status_code == 200
+    assert presets.json()[0]["decoding"] == "sample"
+    assert preset.status_code == 200
+    assert preset.json()["max_new_tokens"] is None
+    assert models.status_code == 200
+    assert models.json()[0]["load_profile"] == "fp32"
@@ -0,0 +1,119 @@
+import pytest
+
+from app.services import model_storage
+from app.services.model_storage import DownloadManager, model_exists_locally
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch, hf_server):
+    monkeypatch.setattr(model_storage, "MODEL_DIR", tmp_path / "models")
+    monkeypatch.setattr(model_storage, "HF_ENDPOINT", hf_server.url)
+    return tmp_path / "models"
+
+
+FILES = {
+    "config.json": b'{"model_type": "gpt2"}',
+    "model-00001-of-00002.safetensors": bytes(range(256)) * 4096,
+    "model-00002-of-00002.safetensors": bytes(range(255, -1, -1)) * 2048,
+    "tokenizer.json": b"{}",
+}
+
+
+def test_job_downloads_in_background_and_promotes_atomically(storage, hf_server):
+    hf_server.add_repo("org/tiny", FILES)
+    manager = DownloadManager()
+
+    job = manager.submit("org/tiny", "tiny")
+    assert manager.submit("org/tiny", "tiny") is job
+    assert job.wait(timeout=30)
+
+    progress = job.progress()
+    assert progress["status"] == "completed"
+    assert progress["files_done"] == progress["files_total"] == len(FILES)
+    assert progress["downloaded_bytes"] == progress["total_bytes"] == sum(map(len, FILES.values()))
+    for name, data in FILES.items():
+        assert (storage / "tiny" / name).read_bytes() == data
+    assert not any((storage / ".staging").iterdir())
+    assert model_storage.list_local_models() == ["tiny"]
+
+
+def test_interrupted_file_is_resumed_with_a_range_request(storage, hf_server):
+    hf_server.add_repo("org/tiny", FILES)
+    shard = "model-00001-of-00002.safetensors"
+    hf_server.truncate_once.add(shard)
+
+    job = DownloadManager().submit("org/tiny", "tiny")
+    assert job.wait(timeout=30)
+
+    assert job.status == "completed"
+    assert (storage / "tiny" / shard).read_bytes() == FILES[shard]
+    ranges = [header for path, header in hf_server.requests if path.endswith(shard)]
+    assert ranges[0] is None
+    # Whatever arrived before the cut is kept; only the rest is fetched again.
+    offset = int(ranges[1].split("=")[1].rstrip("-"))
+    assert 0 < offset <= len(FILES[shard]) // 2
+
+
+def test_failed_download_is_not_treated_as_complete(storage, hf_server):
+    # Listed by the API, but the file itself 404s.
+    hf_server.add_repo("org/broken", {"config.json": None})
+
+    job = DownloadManager().submit("org/broken", "broken")
+    assert job.wait(timeout=30)
+
+    assert job.status == "failed"
+    assert "404" in job.error
+    assert not model_exists_locally("broken")
+
+
+def test_only_one_weight_format_is_selected():
+    listing = {
+        "config.json": 1, "generation_config.json": 1, "tokenizer.json": 10, "tokenizer_config.json": 1,
+        "special_tokens_map.json": 1, "README.md": 5, ".gitattributes": 1,
+        "model-00001-of-00002.safetensors": 100, "model-00002-of-00002.safetensors": 50,
+        "model.safetensors.index.json": 2, "consolidated.safetensors": 150,
+        "pytorch_model.bin": 150, "pytorch_model.bin.index.json": 2,
+        "tf_model.h5": 150, "flax_model.msgpack": 150, "onnx/model.onnx": 150, "original/consolidated.00.pth": 150,
+    }
+    assert set(model_storage.select_files(listing)) == {
+        "config.json", "generation_config.json", "tokenizer.json", "tokenizer_config.json",
+        "special_tokens_map.json", "model.safetensors.index.json",
+        "model-00001-of-00002.safetensors", "model-00002-of-00002.safetensors",
+    }
+
+    legacy = {"config.json": 1, "vocab.json": 1, "merges.txt": 1, "pytorch_model.bin": 100, "tf_model.h5": 100}
+    assert set(model_storage.select_files(legacy)) == {"config.json", "vocab.json", "merges.txt", "pytorch_model.bin"}
+
+
+def test_job_reports_bytes_saved(storage, hf_server):
+    hf_server.add_repo("org/tiny", {**FILES, "pytorch_model.bin": b"x" * 1000, "onnx/model.onnx": b"y" * 500})
+
+    job = DownloadManager().submit("org/tiny", "tiny")
+    assert job.wait(timeout=30)
+
+    progress = job.progress()
+    assert progress["status"] == "completed"
+    assert progress["skipped_files"] == 2
+    assert progress["skipped_bytes"] == 1500
+    assert not (storage / "tiny" / "pytorch_model.bin").exists()
+
+
+def test_prefetch_is_throttled_until_a_load_waits_for_it(storage, hf_server):
+    hf_server.add_repo("org/tiny", FILES)
+    hf_server.add_repo("org/other", {"config.json": b"{}", "model.safetensors": b"x" * 4096})
+    total = sum(map(len, FILES.values()))
+    # Two chunks per second: the prefetch alone would take about ten seconds.
+    manager = DownloadManager(file_workers=1, prefetch_bandwidth=2 * model_storage.DOWNLOAD_CHUNK_SIZE)
+
+    prefetch = manager.submit("org/tiny", "tiny", prefetch=True)
+    # The prefetch worker is busy; downloads someone waits for still run right away.
+    other = manager.submit("org/other", "other")
+    assert other.wait(timeout=5) and other.status == "completed"
+    assert prefetch.active and prefetch.downloaded_bytes < total
+
+    assert manager.submit("org/tiny", "tiny") is prefetch
+    assert not prefetch.prefetch
+    assert prefetch.wait(timeout=5)
+    assert prefetch.status == "completed"
+    shard_requests = [path for path, _ in hf_server.requests if path.endswith("00001-of-00002.safetensors")]
+    assert len(shard_requests) == 1
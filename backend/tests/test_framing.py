@@ -0,0 +1,72 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.framing import (
+    BINARY_HEADER,
+    DEFAULT_FLUSH_MS,
+    DEFAULT_FLUSH_TOKENS,
+    FRAME_DATA,
+    FRAME_END,
+    MAX_FLUSH_MS,
+    StreamFramer,
+    flush_settings,
+    framed,
+)
+
+
+async def _tokens(items):
+    for item in items:
+        yield item
+
+
+@pytest.mark.asyncio
+async def test_json_frames_coalesce_tokens():
+    framer = StreamFramer("json", flush_ms=10_000, flush_tokens=4)
+    framer.start(7)
+    frames = [json.loads(f) async for f in framed(_tokens(["a", "b", "c", "d", "e", "__END__"]), framer)]
+
+    assert frames == [{"id": 7, "t": "abcd", "n": 4}, {"id": 7, "t": "e", "n": 1}]
+    assert json.loads(framer.end({"finish_reason": "stop"})) == {"id": 7, "done": True, "finish_reason": "stop"}
+
+
+@pytest.mark.asyncio
+async def test_binary_frames_carry_header():
+    framer = StreamFramer("binary", flush_ms=10_000, flush_tokens=2)
+    framer.start(3)
+    frames = [f async for f in framed(_tokens(["hé", "llo"]), framer)]
+
+    version, kind, request_id, count = BINARY_HEADER.unpack(frames[0][:BINARY_HEADER.size])
+    assert (kind, request_id, count) == (FRAME_DATA, 3, 2)
+    assert frames[0][BINARY_HEADER.size:].decode("utf-8") == "héllo"
+    assert BINARY_HEADER.unpack(framer.end({})[:BINARY_HEADER.size])[1] == FRAME_END
+
+
+@pytest.mark.asyncio
+async def test_text_protocol_is_unchanged():
+    framer = StreamFramer("text")
+    frames = [f async for f in framed(_tokens(["a", "b", "__END__"]), framer)]
+    assert frames == ["a", "b"]
+    assert framer.end({}) == "__END__"
+
+
+@pytest.mark.parametrize("query, expected", [
+    ({}, (DEFAULT_FLUSH_MS, DEFAULT_FLUSH_TOKENS)),
+    ({"flush_ms": "5", "flush_tokens": "4"}, (5.0, 4)),
+    ({"flush_ms": "soon", "flush_tokens": "many"}, (DEFAULT_FLUSH_MS, DEFAULT_FLUSH_TOKENS)),
+    ({"flush_ms": "nan", "flush_tokens": "2.5"}, (DEFAULT_FLUSH_MS, DEFAULT_FLUSH_TOKENS)),
+    ({"flush_ms": "-1", "flush_tokens": "0"}, (0.0, 1)),
+    ({"flush_ms": "1e9", "flush_tokens": "100000"}, (MAX_FLUSH_MS, 65535)),
+])
+def test_flush_settings_are_validated_and_clamped(query, expected):
+    assert flush_settings(SimpleNamespace(query_params=query)) == expected
+
+
+def test_binary_token_count_fits_the_header():
+    framer = StreamFramer("binary", flush_ms=10_000, flush_tokens=10 ** 6)
+    framer.start(1)
+    for _ in range(framer.flush_tokens - 1):
+        assert framer.add("a") is None
+    frame = framer.add("a")
+    assert BINARY_HEADER.unpack(frame[:BINARY_HEADER.size])[3] == 65535
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from app.services import hf_utils, model_storage
+from app.services.hf_utils import HuggingFaceAPIError, HuggingFaceClient, HuggingFaceModelNotFound
+
+
+@pytest.mark.asyncio
+async def test_metadata_is_cached_and_persisted(tmp_path, hf_server):
+    hf_server.add_repo("org/tiny", {"model.safetensors": b"x" * 2048})
+    cache_path = tmp_path / "hf_cache.json"
+
+    client = HuggingFaceClient(hf_server.url, cache_path=cache_path)
+    sizes = await asyncio.gather(*(client.get_model_size("org/tiny") for _ in range(5)))
+    assert sizes == ["0.0 GB"] * 5
+    assert (await client.model_info("org/tiny"))["usedStorage"] == 2048
+    assert client.requests == 1
+    await client.close()
+
+    restarted = HuggingFaceClient(hf_server.url, cache_path=cache_path)
+    assert (await restarted.model_info("org/tiny"))["sha"] == "abc123"
+    assert restarted.requests == 0
+
+    expired = HuggingFaceClient(hf_server.url, ttl=0, cache_path=cache_path)
+    await expired.model_info("org/tiny")
+    assert expired.requests == 1
+    await expired.close()
+
+    with pytest.raises(HuggingFaceModelNotFound):
+        await restarted.model_info("org/missing")
+    await restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_unreachable_hub_falls_back_to_local_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_storage, "MODEL_DIR", tmp_path / "models")
+    (tmp_path / "models" / "tiny").mkdir(parents=True)
+    (tmp_path / "models" / "tiny" / "model.safetensors").write_bytes(b"x" * 3 * 1024 ** 2)
+
+    client = HuggingFaceClient("http://127.0.0.1:9", cache_path=tmp_path / "hf_cache.json")
+    assert await client.get_model_size("org/tiny", "tiny") == hf_utils.format_size(3 * 1024 ** 2)
+    with pytest.raises(HuggingFaceAPIError):
+        await client.get_model_size("org/tiny", "not-downloaded")
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_update_model_skips_refetch_when_reference_is_unchanged(client, tmp_path, monkeypatch, hf_server):
+    hf_server.add_repo("org/sized", {"model.safetensors": b"x" * 10})
+    monkeypatch.setattr(hf_utils, "hf_client", HuggingFaceClient(hf_server.url, cache_path=tmp_path / "hf_cache.json"))
+
+    created = await client.post("/models/", json={"model_name": "sized", "huggin_face_refference": "org/sized"})
+    assert created.status_code == 200
+    model_id = created.json()["id"]
+
+    hf_utils.hf_client.ttl = 0  # any lookup would now hit the stand-in again
+    updated = await client.put(f"/models/{model_id}", json={"model_name": "renamed", "huggin_face_refference": "org/sized"})
+    assert updated.status_code == 200
+    assert hf_utils.hf_client.requests == 1
+    await hf_utils.hf_client.close()
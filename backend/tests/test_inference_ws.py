@@ -0,0 +1,154 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.api import inference
+from app.db.database import Base, get_db
+from app.main import app
+from app.models.model import Model
+from app.models.preset import Preset
+from app.services import model_storage
+from app.services.admission import AdmissionController
+from app.services.model_pool import ModelPool
+from app.services.response_cache import ResponseCache
+
+
+@pytest.fixture
+def ws_client(tiny_runtime, tiny_model, tmp_path, monkeypatch):
+    """A TestClient whose pool serves tiny_runtime as the default model, with its own cache and queue."""
+    tiny_runtime.preset["max_new_tokens"] = 8
+    pool = ModelPool()
+    pool._runtimes[tiny_model.id] = tiny_runtime
+    pool.default_model_id = tiny_model.id
+    monkeypatch.setattr(inference, "pool", pool)
+    monkeypatch.setattr(inference, "response_cache", ResponseCache(path=tmp_path / "response_cache.json"))
+    monkeypatch.setattr(inference, "admission", AdmissionController(max_active=1, max_queued=4))
+    monkeypatch.setattr(model_storage, "MODEL_DIR", tmp_path / "models")
+    yield TestClient(app)
+    app.dependency_overrides.pop(get_db, None)
+
+
+def _receive_reply(ws) -> tuple:
+    """Data frames and the closing frame (end or error) of one request."""
+    frames = []
+    while True:
+        frame = json.loads(ws.receive_text())
+        if "t" not in frame and "queued" not in frame:
+            return frames, frame
+        frames.append(frame)
+
+
+def test_json_frames_carry_request_id_text_and_token_count(ws_client):
+    with ws_client.websocket_connect("/inference/ws?protocol=json&flush_tokens=1") as ws:
+        for request_id in (1, 2):
+            ws.send_text("hello")
+            frames, end = _receive_reply(ws)
+
+            assert frames
+            assert all(frame["id"] == request_id and frame["n"] == 1 for frame in frames)
+            assert all(isinstance(frame["t"], str) for frame in frames)
+            assert end["id"] == request_id and end["done"] is True
+            assert end["finish_reason"] in ("stop", "length")
+            assert "cached" not in end
+
+
+def test_second_identical_request_is_served_from_the_cache(ws_client, tiny_runtime):
+    tiny_runtime.preset["decoding"] = "greedy"
+
+    replies = []
+    for _ in range(2):
+        # A fresh connection has no history, so both requests share a cache key.
+        with ws_client.websocket_connect("/inference/ws?protocol=json") as ws:
+            ws.send_text("hello")
+            replies.append(_receive_reply(ws))
+
+    (first_frames, first_end), (second_frames, second_end) = replies
+    assert "cached" not in first_end
+    assert second_end["cached"] is True
+    assert second_end["finish_reason"] == first_end["finish_reason"]
+    assert "".join(f["t"] for f in second_frames) == "".join(f["t"] for f in first_frames)
+    assert inference.response_cache.stats()["hits"] == 1
+
+
+def test_full_queue_rejects_with_a_busy_error(ws_client, monkeypatch):
+    admission = AdmissionController(max_active=0, max_queued=0)
+    monkeypatch.setattr(inference, "admission", admission)
+
+    with ws_client.websocket_connect("/inference/ws?protocol=json") as ws:
+        ws.send_text("hello")
+        frames, error = _receive_reply(ws)
+
+    assert frames == []
+    assert error == {"id": 1, "error": "Server busy, try again later.", "busy": True}
+    assert admission.rejected == 1
+
+
+def test_stop_withdraws_a_queued_request(ws_client, monkeypatch):
+    admission = AdmissionController(max_active=0, max_queued=4)
+    monkeypatch.setattr(inference, "admission", admission)
+
+    with ws_client.websocket_connect("/inference/ws?protocol=json") as ws:
+        ws.send_text("hello")
+        assert json.loads(ws.receive_text()) == {"id": 1, "queued": 1}
+        ws.send_text(inference.STOP_MESSAGE)
+        end = json.loads(ws.receive_text())
+
+    assert end == {"id": 1, "done": True, "finish_reason": "cancelled"}
+    assert admission.queued == 0
+
+
+@pytest.mark.parametrize("query, frames_per_token", [("flush_tokens=1", 1), ("flush_tokens=64&flush_ms=10000", None)])
+def test_flush_settings_control_frame_size(ws_client, query, frames_per_token):
+    with ws_client.websocket_connect(f"/inference/ws?protocol=json&{query}") as ws:
+        ws.send_text("hello")
+        frames, end = _receive_reply(ws)
+
+    tokens = sum(frame["n"] for frame in frames)
+    if frames_per_token:
+        assert len(frames) == tokens
+    else:
+        # Nothing reaches the token or time threshold, so the reply arrives in one frame.
+        assert len(frames) == 1
+
+
+def test_bound_preset_is_used_without_changing_the_shared_one(ws_client, tiny_runtime, tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+    Session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def setup() -> int:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with Session() as session:
+            session.add(Model(id=1, model_name="tiny", huggin_face_refference="tiny"))
+            preset = Preset(
+                public_name="greedy", model_id=1, bot_name="Other", task="answer", costraints="",
+                temperature=1.0, repetition_penalty=1.0, top_p=1.0, top_k=0,
+                decoding="greedy", max_new_tokens=4,
+            )
+            session.add(preset)
+            await session.commit()
+            return preset.id
+
+    async def override_get_db():
+        async with Session() as session:
+            yield session
+
+    preset_id = asyncio.run(setup())
+    app.dependency_overrides[get_db] = override_get_db
+    shared_preset = dict(tiny_runtime.preset)
+
+    with ws_client.websocket_connect(f"/inference/ws?protocol=json&preset_id={preset_id}") as ws:
+        ws.send_text("hello")
+        _, end = _receive_reply(ws)
+
+    # The bound preset's token limit applies, not the shared preset's.
+    assert end["finish_reason"] == "length" and end["completion_tokens"] == 4
+    # Only the bound preset is greedy, so only its reply was cached.
+    assert inference.response_cache.stats()["entries"] == 1
+    assert tiny_runtime.preset == shared_preset
+    assert inference.pool.default() is tiny_runtime
+    asyncio.run(engine.dispose())
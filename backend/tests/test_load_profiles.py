@@ -0,0 +1,44 @@
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from app.services import load_profiles
+from app.services.load_profiles import load_with_profile, model_nbytes
+
+
+def _tiny_llama(path):
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=300, hidden_size=64, intermediate_size=128,
+        num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4,
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    return str(path)
+
+
+def test_bf16_profile_halves_weights(tiny_model_path):
+    fp32 = load_with_profile(str(tiny_model_path), "fp32")
+    bf16 = load_with_profile(str(tiny_model_path), "bf16")
+    assert bf16.dtype == torch.bfloat16
+    assert model_nbytes(bf16) * 2 == model_nbytes(fp32)
+
+
+def test_int8_profile_is_quantized_once_and_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(load_profiles, "QUANTIZED_CACHE_DIR", tmp_path / "cache")
+    model_path = _tiny_llama(tmp_path / "llama")
+    fp32 = load_with_profile(model_path, "fp32").eval()
+
+    int8 = load_with_profile(model_path, "int8")
+    assert model_nbytes(int8) < model_nbytes(fp32)
+    assert list((tmp_path / "cache" / "llama").glob("int8-*.pt"))
+
+    def fail(model):
+        raise AssertionError("cached int8 model was quantized again")
+
+    monkeypatch.setattr(load_profiles, "quantize_int8", fail)
+    cached = load_with_profile(model_path, "int8")
+
+    input_ids = torch.tensor([[1, 5, 17, 42]])
+    with torch.no_grad():
+        expected = fp32(input_ids).logits
+        assert torch.equal(cached(input_ids).logits, int8(input_ids).logits)
+        assert torch.allclose(int8(input_ids).logits, expected, atol=0.1)
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM
+
+from app.services.mmap_loader import MmapLoadError, load_mmap_model, memory_report, parameters_on_meta
+
+
+def test_mmap_model_matches_regular_load(tiny_model_path):
+    expected = AutoModelForCausalLM.from_pretrained(tiny_model_path).eval()
+    model = load_mmap_model(str(tiny_model_path))
+
+    input_ids = torch.tensor([[5, 17, 42, 99]])
+    with torch.no_grad():
+        assert torch.allclose(model(input_ids).logits, expected(input_ids).logits, atol=1e-5)
+
+    # Tied embeddings point at the same mapped weights instead of a copy.
+    assert model.get_output_embeddings().weight.data_ptr() == model.get_input_embeddings().weight.data_ptr()
+    assert memory_report()["rss_kb"] > 0
+
+
+def test_half_precision_checkpoint_is_not_mapped_as_fp32(tiny_model_path, tmp_path):
+    AutoModelForCausalLM.from_pretrained(tiny_model_path).half().save_pretrained(tmp_path)
+
+    with pytest.raises(MmapLoadError, match="float16"):
+        load_mmap_model(str(tmp_path), torch.float32)
+    assert next(load_mmap_model(str(tmp_path), torch.float16).parameters()).dtype == torch.float16
+
+
+def test_meta_construction_only_affects_its_own_thread():
+    inside = threading.Event()
+    release = threading.Event()
+    built = {}
+
+    def load(name):
+        with parameters_on_meta():
+            inside.set()
+            release.wait(5)
+            built[name] = torch.nn.Linear(2, 2)
+
+    first = threading.Thread(target=load, args=("first",))
+    second = threading.Thread(target=load, args=("second",))
+    first.start()
+    inside.wait(5)
+    second.start()
+    # Built by another thread while both loads are in progress.
+    outside = torch.nn.Linear(2, 2)
+    release.set()
+    first.join()
+    second.join()
+
+    assert outside.weight.device.type == "cpu"
+    assert built["first"].weight.is_meta and built["second"].weight.is_meta
+    assert torch.nn.Linear(2, 2).weight.device.type == "cpu"
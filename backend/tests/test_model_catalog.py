@@ -0,0 +1,115 @@
+import pytest
+from pydantic import ValidationError
+
+from app.schemas.model import ModelCreate
+from app.services import model_storage
+from app.services.model_storage import DownloadManager, delete_model, get_catalog, list_local_models
+
+
+SHARD = bytes(range(256)) * 4096
+FILES = {"config.json": b'{"model_type": "gpt2"}', "model.safetensors": SHARD}
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch, hf_server):
+    monkeypatch.setattr(model_storage, "MODEL_DIR", tmp_path / "models")
+    monkeypatch.setattr(model_storage, "HF_ENDPOINT", hf_server.url)
+    return tmp_path / "models"
+
+
+def _download(name, reference="org/tiny"):
+    job = DownloadManager().submit(reference, name)
+    assert job.wait(timeout=30)
+    assert job.status == "completed", job.error
+    return job
+
+
+def test_same_weights_under_two_names_are_stored_once(storage, hf_server):
+    hf_server.add_repo("org/tiny", FILES)
+
+    _download("first")
+    second = _download("second")
+
+    shard_requests = [path for path, _ in hf_server.requests if path.endswith("model.safetensors")]
+    assert len(shard_requests) == 1
+    assert second.progress()["deduplicated_bytes"] == len(SHARD)
+    assert (storage / "first" / "model.safetensors").stat().st_ino == (storage / "second" / "model.safetensors").stat().st_ino
+
+    catalog = get_catalog()
+    assert sorted(list_local_models()) == ["first", "second"]
+    entry = catalog.get("second")
+    assert entry["hf_reference"] == "org/tiny"
+    assert entry["revision"] == "abc123"
+    assert entry["files"]["model.safetensors"]["size"] == len(SHARD)
+    assert catalog.stats()["deduplicated_bytes"] == sum(map(len, FILES.values()))
+    assert catalog.verify("second") == []
+
+    assert delete_model("first")
+    assert list(catalog.blobs_dir.iterdir())
+    assert (storage / "second" / "model.safetensors").read_bytes() == SHARD
+    assert delete_model("second")
+    assert list(catalog.blobs_dir.iterdir()) == []
+    assert list_local_models() == []
+
+
+def test_shard_with_wrong_hash_fails_the_download(storage, hf_server):
+    hf_server.add_repo("org/tiny", FILES)
+    hf_server.lfs_hashes["model.safetensors"] = "0" * 64
+
+    job = DownloadManager().submit("org/tiny", "tiny")
+    assert job.wait(timeout=30)
+
+    assert job.status == "failed"
+    assert "sha256 mismatch" in job.error
+    assert "tiny" not in list_local_models()
+
+
+def test_directories_copied_in_by_hand_are_indexed(storage):
+    (storage / "manual").mkdir(parents=True)
+    (storage / "manual" / "config.json").write_text("{}")
+
+    assert model_storage.model_exists_locally("manual")
+    assert get_catalog().get("manual")["size_bytes"] == 2
+    assert list_local_models() == ["manual"]
+
+
+def test_quota_evicts_least_recently_used_models_that_are_not_in_use(storage, hf_server, monkeypatch):
+    cache = model_storage.cache
+    for repo in ("a", "b", "c", "d"):
+        hf_server.add_repo(f"org/{repo}", {"config.json": b"{}", "model.safetensors": repo.encode() * len(SHARD)})
+    monkeypatch.setattr(cache, "max_bytes", 2 * len(SHARD) + 100)
+    monkeypatch.setattr(cache, "_in_use", [lambda: {"a"}])
+    for counter in ("hits", "misses", "evictions", "evicted_bytes"):
+        monkeypatch.setattr(cache, counter, 0)
+
+    _download("a", "org/a")
+    _download("b", "org/b")
+    _download("c", "org/c")  # b and a are older; a is in use, so b goes
+    assert sorted(list_local_models()) == ["a", "c"]
+    assert cache.evictions == 1
+
+    assert cache.lookup("c") and not cache.lookup("b")
+    stats = cache.stats()
+    assert stats["used_bytes"] <= cache.max_bytes
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+    assert {m["model_name"]: m["in_use"] for m in stats["models"]} == {"a": True, "c": False}
+
+    monkeypatch.setattr(cache, "max_bytes", len(SHARD))
+    job = DownloadManager().submit("org/d", "d")
+    assert job.wait(timeout=30)
+    assert job.status == "failed" and "do not fit" in job.error
+
+
+def test_delete_refuses_paths_outside_the_model_directory(storage):
+    (storage / "kept").mkdir(parents=True)
+    (storage.parent / "neighbour.txt").write_text("keep me")
+
+    for name in (".", "..", "../" + storage.parent.name, "kept/.."):
+        assert delete_model(name) is False
+    assert (storage / "kept").is_dir() and (storage.parent / "neighbour.txt").exists()
+    assert delete_model("kept") is True and not (storage / "kept").exists()
+
+    for name in (".", "..", "a/b", "a\\b", ".staging", ""):
+        with pytest.raises(ValidationError):
+            ModelCreate(model_name=name, huggin_face_refference="org/tiny")
+    assert ModelCreate(model_name="gpt2.v1", huggin_face_refference="org/tiny").model_name == "gpt2.v1"
@@ -0,0 +1,224 @@
+import shutil
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.api import inference
+from app.services import model_pool
+from app.services.model_pool import ModelPool
+
+
+def _model(model_id):
+    return SimpleNamespace(id=model_id, model_name=f"pool-{model_id}", huggin_face_refference="tiny", size="tiny")
+
+
+def _preset(preset_id):
+    return SimpleNamespace(
+        id=preset_id, bot_name="Bot", task="", costraints="",
+        temperature=1.0, repetition_penalty=1.0, top_p=0.9, top_k=20.0,
+    )
+
+
+def test_pool_keeps_models_resident_within_budget(tiny_model_path):
+    pool = ModelPool(budget_bytes=10 ** 9)
+    assert pool.load(_model(1), _preset(1), str(tiny_model_path))["status"] == "loaded"
+    assert pool.load(_model(2), _preset(2), str(tiny_model_path))["status"] == "loaded"
+
+    assert pool.load(_model(1), _preset(3))["status"] == "preset updated"
+    info = pool.info()
+    assert {m["id"] for m in info["models"]} == {1, 2}
+    assert all(m["footprint_bytes"] > 0 for m in info["models"])
+    assert pool.default_model_id == 1
+
+    pool.stop()
+    assert pool.info()["models"] == []
+
+
+def test_load_can_leave_the_default_model_alone(tiny_model_path):
+    pool = ModelPool(budget_bytes=10 ** 9)
+    pool.load(_model(1), _preset(1), str(tiny_model_path))
+    pool.load(_model(2), _preset(2), str(tiny_model_path), make_default=False)
+    pool.load(_model(2), _preset(3), make_default=False)
+
+    assert 2 in pool and pool.default_model_id == 1
+    # Nor does it replace a resident model's default preset; a draft is still attached.
+    pool.load(_model(2), _preset(4), draft_path=str(tiny_model_path), make_default=False)
+    assert pool.get(2).preset["id"] == 2
+    assert pool.get(2).active_model["draft_model"] == str(tiny_model_path)
+    pool.stop()
+
+
+def test_pool_evicts_least_recently_used(tiny_model_path):
+    pool = ModelPool(budget_bytes=10 ** 9)
+    pool.load(_model(1), _preset(1), str(tiny_model_path))
+    single = pool.used_bytes()
+    pool.budget_bytes = 2 * single + single // 2
+
+    pool.load(_model(2), _preset(2), str(tiny_model_path))
+    pool.get(1)
+    pool.load(_model(3), _preset(3), str(tiny_model_path))
+
+    assert 2 not in pool
+    assert 1 in pool and 3 in pool
+    assert pool.evictions == 1
+    pool.stop()
+
+
+def test_swap_keeps_serving_and_drains_the_replaced_model(tiny_model_path, monkeypatch):
+    pool = ModelPool(budget_bytes=10 ** 9)
+    pool.load(_model(1), _preset(1), str(tiny_model_path))
+    pool.budget_bytes = pool.used_bytes()  # room for one model only
+    old = pool.get(1)
+    finish_request = threading.Event()
+    monkeypatch.setattr(old, "in_flight", lambda: 0 if finish_request.is_set() else 1)
+
+    release_load = threading.Event()
+    create_runtime = model_pool.create_runtime
+
+    def slow_runtime():
+        runtime = create_runtime()
+        load_model = runtime.load_model
+        runtime.load_model = lambda *args: release_load.wait() and load_model(*args)
+        return runtime
+
+    monkeypatch.setattr(model_pool, "create_runtime", slow_runtime)
+    loader = threading.Thread(target=pool.load, args=(_model(2), _preset(2), str(tiny_model_path)))
+    loader.start()
+
+    # While model 2 loads, model 1 is still the default and lookups do not block.
+    time.sleep(0.1)
+    assert pool.default() is old
+    assert pool.info()["loading"] == [2]
+
+    release_load.set()
+    loader.join(timeout=30)
+    assert pool.default_model_id == 2 and 1 not in pool
+    # The old model is out of the pool but finishes its request before being stopped.
+    time.sleep(0.5)
+    assert old.active_model is not None and pool.info()["retiring"] == 1
+
+    finish_request.set()
+    deadline = time.monotonic() + 5
+    while pool.info()["retiring"] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert old.active_model is None
+    pool.stop()
+
+
+def test_idle_model_is_unloaded_and_woken_on_demand(tiny_model_path):
+    pool = ModelPool(budget_bytes=10 ** 9)
+    model = _model(1)
+    model.idle_timeout = 0.2
+    pool.load(model, _preset(1), str(tiny_model_path))
+    pool.load(_model(2), _preset(2), str(tiny_model_path))  # no timeout
+    pool.get(1)
+    pool.default_model_id = 1
+
+    assert pool.unload_idle() == []
+    time.sleep(0.3)
+    assert pool.unload_idle() == [1]
+    assert 1 not in pool and 2 in pool
+    assert pool.default() is None and pool.info()["asleep"] == [1]
+
+    runtime = pool.wake()
+    assert runtime is pool.get(1)
+    assert runtime.preset["id"] == 1
+    assert pool.info()["asleep"] == []
+    pool.stop()
+
+
+def test_slow_preset_update_and_unload_do_not_hold_the_pool_lock(tiny_model_path, monkeypatch):
+    pool = ModelPool(budget_bytes=10 ** 9)
+    model = _model(1)
+    model.idle_timeout = 0.1
+    pool.load(model, _preset(1), str(tiny_model_path))
+    runtime = pool.get(1)
+
+    release = threading.Event()
+    update_preset = runtime.update_preset
+    monkeypatch.setattr(runtime, "update_preset", lambda *args: release.wait() and update_preset(*args))
+    updater = threading.Thread(target=pool.load, args=(model, _preset(2)), daemon=True)
+    updater.start()
+    time.sleep(0.1)
+    # Lookups from the event loop go through while the update runs.
+    acquired = pool._lock.acquire(timeout=1)
+    if acquired:
+        pool._lock.release()
+    preset_during_update = runtime.preset["id"]
+    release.set()
+    updater.join(timeout=30)
+    assert acquired and preset_during_update == 1
+    assert runtime.preset["id"] == 2
+
+    stop_model = runtime.stop_model
+    lookups = []
+
+    def slow_stop():
+        # Stopping happens after the lock is released, so another thread gets it.
+        lookup = threading.Thread(target=lambda: lookups.append(pool.get(1)))
+        lookup.start()
+        lookup.join(timeout=1)
+        assert not lookup.is_alive()
+        return stop_model()
+
+    monkeypatch.setattr(runtime, "stop_model", slow_stop)
+    time.sleep(0.2)
+    assert pool.unload_idle() == [1]
+    assert lookups == [None]
+
+
+def test_models_being_loaded_or_asleep_are_in_use(tiny_model_path, monkeypatch):
+    pool = ModelPool(budget_bytes=10 ** 9)
+    model = _model(1)
+    model.idle_timeout = 0.1
+    pool.load(model, _preset(1), str(tiny_model_path))
+    time.sleep(0.2)
+    assert pool.unload_idle() == [1]
+    assert pool.model_names() == {"pool-1"}
+
+    release = threading.Event()
+    create_runtime = model_pool.create_runtime
+
+    def slow_runtime():
+        runtime = create_runtime()
+        load_model = runtime.load_model
+        runtime.load_model = lambda *args: release.wait() and load_model(*args)
+        return runtime
+
+    monkeypatch.setattr(model_pool, "create_runtime", slow_runtime)
+    loader = threading.Thread(target=pool.load, args=(_model(2), _preset(2), str(tiny_model_path)))
+    loader.start()
+    time.sleep(0.1)
+    assert pool.model_names() == {"pool-1", "pool-2"}
+    release.set()
+    loader.join(timeout=30)
+    pool.stop()
+    assert pool.model_names() == set()
+
+
+@pytest.mark.asyncio
+async def test_idle_default_whose_weights_were_evicted_is_downloaded_again(tiny_model_path, tmp_path, monkeypatch):
+    model_path = tmp_path / "pool-1"
+    shutil.copytree(tiny_model_path, model_path)
+    pool = ModelPool(budget_bytes=10 ** 9)
+    model, preset = _model(1), _preset(1)
+    model.idle_timeout = 0.1
+    pool.load(model, preset, str(model_path))
+    time.sleep(0.2)
+    assert pool.unload_idle() == [1]
+    shutil.rmtree(model_path)
+
+    assert pool.wake() is None
+    assert pool.asleep() == (model, preset)
+
+    async def download_and_load(model, preset, draft=None):
+        shutil.copytree(tiny_model_path, model_path)
+        return pool.load(model, preset, str(model_path))
+
+    monkeypatch.setattr(inference, "pool", pool)
+    monkeypatch.setattr(inference, "_load_into_pool", download_and_load)
+    runtime = await inference._wake_default(None)
+    assert runtime is pool.get(1) and pool.asleep() is None
+    pool.stop()
@@ -0,0 +1,58 @@
+from transformers import AutoTokenizer
+
+from app.services.prompt_template import PromptTemplate
+from app.services.sessions import SessionStore
+
+CHATML = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+PRESET = {"bot_name": "Bot", "task": "answer", "costraints": "be brief"}
+
+
+def test_chat_template_splits_into_prefix_and_turns(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    tokenizer.chat_template = CHATML
+    prompts = PromptTemplate(tokenizer, context_window=512)
+
+    assert prompts.chat and not prompts.prefix_special_tokens
+    prefix = prompts.prefix(PRESET, 64)
+    assert prefix.startswith("<|im_start|>system\nYou are Bot\nYour task is to: answer")
+    assert prefix.endswith("<|im_end|>\n<|im_start|>user\n")
+    assert prompts.parts["after"] == "<|im_end|>\n<|im_start|>assistant\n"
+    assert prompts.parts["between"] == "<|im_end|>\n<|im_start|>user\n"
+
+    plain = PromptTemplate(AutoTokenizer.from_pretrained(tiny_model_path), context_window=512)
+    assert not plain.chat
+    assert plain.prefix(PRESET, 64) == "###You are Bot\nYour task is to: answer\nConstraints for you to follow: be brief!!!###\nUser Message:"
+
+
+def test_oversized_preset_and_message_are_cut_to_budget(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    prompts = PromptTemplate(tokenizer, context_window=1024)
+    preset = {"bot_name": "Bot", "task": "answer the user message " * 500, "costraints": "be brief"}
+
+    prefix = prompts.prefix(preset, 512)
+    assert prefix == PromptTemplate(tokenizer, context_window=1024).prefix(preset, 512)
+    assert "be brief" in prefix  # the short field keeps all of it
+    prefix_length = len(tokenizer(prefix)["input_ids"])
+    assert prefix_length <= prompts.prompt_budget(512) // 2 + 2
+
+    message = "your task " * 300 + "final question"
+    ids = prompts.message_ids(message, prompts.prompt_budget(512) - prefix_length)
+    assert prefix_length + len(ids) <= prompts.prompt_budget(512)
+    assert tokenizer.decode(ids).endswith("final question")
+
+
+def test_drop_turns_removes_whole_oldest_turns():
+    store = SessionStore()
+    session = store.create()
+    # prefix [0, 1], then turns starting at 2, 5 and 9
+    session.tokens = [0, 1, 10, 11, 12, 20, 21, 22, 23, 30, 31]
+    session.pending = [32]
+    session.turns = [2, 5, 9]
+
+    assert store.drop_turns(session, 4, prefix_length=2)
+    assert session.tokens == [0, 1, 30, 31, 32]
+    assert session.turns == [2] and session.cache is None
+    assert not store.drop_turns(session, 1, prefix_length=2)
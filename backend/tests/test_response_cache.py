@@ -0,0 +1,63 @@
+import json
+
+from app.services.response_cache import ResponseCache, cacheable
+from app.services.sessions import sessions
+
+
+PRESET = {"bot_name": "Bot", "task": "answer", "costraints": "", "decoding": "greedy"}
+
+
+def test_cache_evicts_lru_persists_and_counts_hits(tmp_path):
+    path = tmp_path / "responses.json"
+    cache = ResponseCache(max_bytes=400, path=path)
+    first = cache.key("tiny@abc", PRESET, [], "What  is\nthis?")
+    assert first == cache.key("tiny@abc", PRESET, [], " What is this? ")
+    assert first != cache.key("tiny@abc", {**PRESET, "seed": 1}, [], "What is this?")
+
+    cache.put(first, ["It ", "is ", "a test."], {"finish_reason": "stop", "completion_tokens": 3, "total_ms": 20.0})
+    assert cache.get(first)["chunks"] == ["It ", "is ", "a test."]
+    assert cache.get("missing") is None
+    for i in range(5):
+        cache.put(f"other-{i}", ["x" * 50], {"finish_reason": "stop", "completion_tokens": 1})
+    assert cache.get(first) is None  # least recently used, evicted
+    cache.save()
+
+    stats = cache.stats()
+    assert stats["bytes"] <= 400
+    assert stats["hits"] == 1 and stats["misses"] == 2 and stats["saved_tokens"] == 3
+    reloaded = ResponseCache(max_bytes=400, path=path)
+    reloaded.load()
+    assert reloaded.get("other-4") is not None
+    assert not cacheable({**PRESET, "decoding": "sample"})
+
+
+def test_stored_entries_load_in_the_background_and_survive_a_save(tmp_path):
+    path = tmp_path / "responses.json"
+    stored = ResponseCache(path=path)
+    stored.put("old", ["a"], {"finish_reason": "stop"})
+    stored.save()
+
+    cache = ResponseCache(path=path)
+    cache.put("new", ["b"], {"finish_reason": "stop"})
+    cache.save()  # waits for the stored entries before writing
+    assert set(json.loads(path.read_text())) == {"old", "new"}
+    assert cache.get("old") is not None
+
+    cache.clear()
+    assert json.loads(path.read_text()) == {} and cache.get("new") is None
+
+
+def test_seeded_preset_repeats_its_reply(tiny_runtime):
+    seeded = {**tiny_runtime.preset, "decoding": "seeded", "seed": 7}
+    first, second = tiny_runtime.generate_batch(["hello", "hello"], seeded)
+    other_seed = tiny_runtime.generate_batch(["hello"], {**seeded, "seed": 8})[0]
+
+    session = sessions.create()
+    tiny_runtime.record_turn(session, "hello", first["text"], seeded)
+    prompt_length = len(tiny_runtime.prefix_cache.warm(tiny_runtime.build_prompt_prefix(seeded)).input_ids)
+
+    assert first["text"] == second["text"]
+    assert first["completion_tokens"] == second["completion_tokens"]
+    assert other_seed["text"] != first["text"] or other_seed["completion_tokens"] != first["completion_tokens"]
+    assert len(session.tokens) > prompt_length and session.cache is None
+    sessions.close(session)
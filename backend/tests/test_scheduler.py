@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+
+from app.services.prefix_cache import PrefixCache
+from app.services.scheduler import BatchScheduler, GenerationRequest
+
+
+GREEDY = {"do_sample": False, "max_new_tokens": 12}
+
+
+def _reference(model, tokenizer, input_ids):
+    output = model.generate(
+        torch.tensor([input_ids]),
+        attention_mask=torch.ones(1, len(input_ids), dtype=torch.long),
+        max_new_tokens=GREEDY["max_new_tokens"],
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    return output[0, len(input_ids):].tolist()
+
+
+def test_concurrent_requests_share_one_batch(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+
+    prompts = ["You are bot", "answer the user message", "task", "your task is to answer the user"]
+    batch_sizes = []
+    original_step = scheduler._decode_step
+
+    def recording_step():
+        batch_sizes.append(len(scheduler.running))
+        original_step()
+
+    scheduler._decode_step = recording_step
+
+    requests = []
+    start = threading.Barrier(len(prompts))
+
+    def submit(prompt):
+        streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+        request = GenerationRequest(tokenizer(prompt)["input_ids"], GREEDY, streamer)
+        requests.append(request)
+        start.wait()
+        scheduler.submit(request)
+        "".join(streamer)
+
+    threads = [threading.Thread(target=submit, args=(p,)) for p in prompts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    scheduler.shutdown()
+
+    assert max(batch_sizes) > 1
+    for request in requests:
+        assert request.done.is_set()
+        assert request.finish_reason in ("stop", "length")
+        generated = [t for t in request.generated if t != tokenizer.eos_token_id]
+        expected = _reference(model, tokenizer, request.input_ids)
+        assert generated == expected[:len(generated)]
+
+
+def test_submit_after_shutdown_fails(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+    scheduler.shutdown()
+
+    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+    request = GenerationRequest(tokenizer("task")["input_ids"], GREEDY, streamer)
+    with pytest.raises(RuntimeError):
+        scheduler.submit(request)
+
+
+def test_cached_prefix_matches_full_prefill(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+    prefix_cache = PrefixCache(model, tokenizer)
+
+    prefix = prefix_cache.warm("You are bot, your task is to")
+    assert prefix_cache.warm("You are bot, your task is to") is prefix
+
+    message_ids = tokenizer(" answer the user", add_special_tokens=False)["input_ids"]
+    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+    request = scheduler.submit(GenerationRequest(message_ids, GREEDY, streamer, prefix=prefix))
+    request.done.wait(timeout=30)
+    scheduler.shutdown()
+
+    expected = _reference(model, tokenizer, prefix.input_ids + message_ids)
+    assert request.tokens[:len(prefix.input_ids)] == prefix.input_ids
+    assert request.generated == expected[:len(request.generated)]
+
+
+def test_padded_group_matches_separate_prefill(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+    prefix = PrefixCache(model, tokenizer).warm("You are bot, your task is to")
+
+    prompts = [" answer", " answer the user message", " your task is to answer the user"]
+    requests = [
+        GenerationRequest(tokenizer(p, add_special_tokens=False)["input_ids"], GREEDY, TextIteratorStreamer(tokenizer), prefix=prefix)
+        for p in prompts
+    ]
+    scheduler.submit_group(requests)
+    for request in requests:
+        request.done.wait(timeout=30)
+    scheduler.shutdown()
+
+    for request in requests:
+        expected = _reference(model, tokenizer, prefix.input_ids + request.input_ids)
+        assert request.tokens[:len(prefix.input_ids) + len(request.input_ids)] == prefix.input_ids + request.input_ids
+        assert request.generated == expected[:len(request.generated)]
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+
+from app.services.kv_cache import seq_length
+from app.services.scheduler import BatchScheduler, GenerationRequest
+from app.services.sessions import SessionStore
+
+
+GREEDY = {"do_sample": False, "max_new_tokens": 6}
+
+
+def _finished_turn(tokens, cached_length):
+    cache = [(torch.zeros(1, 2, cached_length, 4), torch.zeros(1, 2, cached_length, 4))]
+    return SimpleNamespace(tokens=tokens, cache=cache, finish_reason="length", trailing=0)
+
+
+def test_least_recently_used_session_loses_cache_first():
+    turn_bytes = 2 * 2 * 8 * 4 * 4
+    store = SessionStore(budget_bytes=2 * turn_bytes)
+    first, second, third = store.create(), store.create(), store.create()
+
+    store.save_turn(first, _finished_turn(list(range(9)), 8))
+    store.save_turn(second, _finished_turn(list(range(9)), 8))
+    store.save_turn(third, _finished_turn(list(range(9)), 8))
+
+    assert first.cache is None
+    assert first.tokens == list(range(8))
+    assert first.pending == [8]
+    assert second.cache is not None and third.cache is not None
+    assert store.stats()["evictions"] == 1
+
+    store.close(third)
+    assert store.stats()["sessions"] == 2
+
+
+def test_cached_turn_matches_reprefill(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+    store = SessionStore()
+    session = store.create()
+
+    def run(input_ids, prefix=None):
+        streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+        request = scheduler.submit(GenerationRequest(input_ids, GREEDY, streamer, prefix=prefix, keep_cache=True))
+        request.done.wait(timeout=30)
+        return request
+
+    first = run(tokenizer("You are bot")["input_ids"])
+    store.save_turn(session, first)
+    assert seq_length(session.cache) == len(session.tokens)
+
+    turn_ids = session.pending + tokenizer(" answer the user", add_special_tokens=False)["input_ids"]
+    cached = run(turn_ids, prefix=session.past())
+    reprefilled = run(session.tokens + turn_ids)
+    scheduler.shutdown()
+
+    assert cached.tokens == reprefilled.tokens
@@ -0,0 +1,63 @@
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, GPT2Config, GPT2LMHeadModel, TextIteratorStreamer
+
+from app.services.prefix_cache import PrefixCache
+from app.services.scheduler import BatchScheduler, GenerationRequest
+from app.services.speculative import SpeculativeState
+
+
+GREEDY = {"do_sample": False, "max_new_tokens": 20}
+
+
+def _generate(scheduler, tokenizer, input_ids, speculation=None, prefix=None, keep_cache=False):
+    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+    request = GenerationRequest(
+        input_ids, GREEDY, streamer, prefix=prefix, keep_cache=keep_cache, speculation=speculation
+    )
+    scheduler.submit(request)
+    "".join(streamer)
+    return request
+
+
+def _draft_model(target):
+    torch.manual_seed(1)
+    config = GPT2Config(**{**target.config.to_dict(), "n_layer": 1})
+    return GPT2LMHeadModel(config).eval()
+
+
+def test_greedy_speculative_decoding_matches_plain_decoding(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+    prefix = PrefixCache(model, tokenizer).warm("You are bot, your task is")
+    input_ids = tokenizer(" to answer the user message", add_special_tokens=False)["input_ids"]
+
+    plain = _generate(scheduler, tokenizer, input_ids, prefix=prefix)
+    # The target as its own draft accepts every proposal.
+    self_drafted = _generate(scheduler, tokenizer, input_ids, SpeculativeState(model), prefix=prefix)
+    drafted = _generate(scheduler, tokenizer, input_ids, SpeculativeState(_draft_model(model)), prefix=prefix)
+    scheduler.shutdown()
+
+    assert self_drafted.generated == plain.generated
+    assert drafted.generated == plain.generated
+    stats = self_drafted.metadata()["speculative"]
+    assert stats["acceptance_rate"] == 1.0
+    assert stats["tokens_per_target_pass"] > 1
+    assert "speculative" not in plain.metadata()
+
+
+def test_speculative_request_keeps_its_cache(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+    input_ids = tokenizer("You are bot")["input_ids"]
+
+    request = _generate(scheduler, tokenizer, input_ids, SpeculativeState(model), keep_cache=True)
+    scheduler.shutdown()
+
+    length = request.cache[0][0].shape[2]
+    assert length == len(request.tokens) - 1
+    with torch.no_grad():
+        expected = model(torch.tensor([request.tokens[:length]]), use_cache=True).past_key_values
+    key = expected.layers[0].keys if hasattr(expected, "layers") else expected[0][0]
+    assert torch.allclose(request.cache[0][0], key, atol=1e-5)
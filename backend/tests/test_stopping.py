@@ -0,0 +1,54 @@
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+
+from app.services.scheduler import BatchScheduler, GenerationRequest
+from app.services.stopping import StopCriteria
+
+
+def test_stop_string_is_never_streamed(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    stop = StopCriteria(tokenizer, ["\nUser Message:"])
+
+    streamed = []
+    stopped = False
+    for token in tokenizer("the answer\nUser Message: more", add_special_tokens=False)["input_ids"]:
+        release, stopped = stop.push(token)
+        streamed += release
+        if stopped:
+            break
+
+    assert stopped and stop.matched == "\nUser Message:"
+    assert tokenizer.decode(streamed) == "the answer"
+    assert stop.discarded > 0
+
+    # Text that only looked like the start of a stop string is released in the end.
+    stop = StopCriteria(tokenizer, ["\nUser Message:"])
+    streamed = []
+    for token in tokenizer("the answer\nUser", add_special_tokens=False)["input_ids"]:
+        streamed += stop.push(token)[0]
+    assert tokenizer.decode(streamed) == "the answer"
+    assert tokenizer.decode(streamed + stop.flush()) == "the answer\nUser"
+
+
+def test_scheduler_ends_reply_at_stop_string(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_path)
+    scheduler = BatchScheduler(model, tokenizer)
+    input_ids = tokenizer("You are bot", add_special_tokens=False)["input_ids"]
+
+    def run(params):
+        streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+        request = scheduler.submit(GenerationRequest(input_ids, params, streamer))
+        return request, "".join(streamer)
+
+    full_request, full_text = run({"do_sample": False, "max_new_tokens": 24})
+    stop_string = full_text[len(full_text) // 2:][:3]
+    request, text = run({"do_sample": False, "max_new_tokens": 24, "stop_strings": [stop_string]})
+    limited, _ = run({"do_sample": False, "max_new_tokens": 5})
+    scheduler.shutdown()
+
+    assert request.finish_reason == "stop"
+    assert text == full_text[:full_text.index(stop_string)]
+    metadata = request.metadata()
+    assert metadata["stop_sequence"] == stop_string and metadata["wasted_tokens"] == request.trailing > 0
+    assert len(request.generated) < len(full_request.generated)
+    assert limited.finish_reason == "length" and len(limited.generated) == 5
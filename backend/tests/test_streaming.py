@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_stream_does_not_block_event_loop(tiny_runtime):
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    task = asyncio.create_task(ticker())
+    tokens = [token async for token in tiny_runtime.open_stream("hello")]
+    task.cancel()
+
+    assert tokens[-1] == "__END__"
+    assert ticks > 1
+
+
+@pytest.mark.asyncio
+async def test_cancel_stops_generation(tiny_runtime):
+    stream = tiny_runtime.open_stream("hello")
+
+    async for _ in stream:
+        stream.cancel()
+        break
+    await asyncio.to_thread(stream.request.done.wait, 5)
+
+    assert stream.request.finish_reason == "cancelled"
+    assert len(stream.request.generated) < stream.request.max_new_tokens
+
+
+def test_load_reports_phase_timings_after_warmup(tiny_runtime):
+    timings = tiny_runtime.active_model["load_timings"]
+
+    assert set(timings) == {"read_s", "materialize_s", "warmup_s", "first_token_s", "total_s"}
+    assert timings["warmup_s"] > 0
+    assert timings["read_s"] + timings["materialize_s"] <= timings["first_token_s"] <= timings["total_s"]
+
+
+@pytest.mark.asyncio
+async def test_streams_bind_their_own_preset(tiny_runtime):
+    default = dict(tiny_runtime.preset)
+    pirate = {**default, "id": 2, "bot_name": "Pirate", "temperature": 0.5, "top_k": 5}
+
+    streams = [tiny_runtime.open_stream("hello"), tiny_runtime.open_stream("hello", preset=pirate)]
+    await asyncio.gather(*[asyncio.create_task(_drain(stream)) for stream in streams])
+    assert tiny_runtime.preset == default
+
+    plain, bound = (stream.request for stream in streams)
+    assert plain.params["top_k"] == default["top_k"] and bound.params["top_k"] == 5
+    assert bound.params["temperature"] == 0.5
+    assert plain.prefix.key != bound.prefix.key
+
+
+def test_warm_prefix_prefills_a_bound_preset(tiny_runtime):
+    pirate = {**tiny_runtime.preset, "id": 2, "bot_name": "Pirate"}
+    text = tiny_runtime.build_prompt_prefix(pirate)
+    assert tiny_runtime.prefix_cache.get(text) is None
+
+    tiny_runtime.warm_prefix(pirate)
+    cached = tiny_runtime.prefix_cache.get(text)
+    request = tiny_runtime.submit("hello", None, preset=pirate)
+    request.done.wait(5)
+
+    assert cached is not None and request.prefix is cached
+
+
+async def _drain(stream):
+    return [token async for token in stream]
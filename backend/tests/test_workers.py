@@ -0,0 +1,31 @@
+import pytest
+
+from app.services.sessions import SessionStore
+from app.services.workers import RemoteRuntime, WorkerPool
+
+
+@pytest.fixture(scope="module")
+def worker_pool():
+    pool = WorkerPool(2, threads=1)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_remote_runtime_streams_from_workers(worker_pool, tiny_model_path, tiny_model, tiny_preset):
+    runtime = RemoteRuntime(worker_pool)
+    assert runtime.load_model(tiny_model, tiny_preset, str(tiny_model_path))["status"] == "loaded"
+    assert len(runtime.footprints) == 2 and runtime.memory_footprint() > 0
+
+    session = SessionStore().create()
+    first = runtime.open_stream("hello", session=session)
+    tokens = [token async for token in first]
+    second = runtime.open_stream("again", session=session)
+    [token async for token in second]
+
+    assert tokens[-1] == "__END__"
+    assert first.metadata()["completion_tokens"] > 0
+    assert first.worker == second.worker
+    assert worker_pool._in_flight == [0, 0]
+
+    runtime.stop_model()
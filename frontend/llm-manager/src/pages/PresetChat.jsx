@@ -21,6 +21,7 @@ const PresetChat = () => {
   const timeoutRef = useRef(null);
 
   useEffect(() => {
+    let active = true;
     const loadPreset = async () => {
       try {
         const presetInfo = await fetch(`${API_URL}/presets/${presetId}`);
@@ -31,11 +32,21 @@ const PresetChat = () => {
           setPresetName('Unknown Preset');
         }
 
-        await fetch(`${API_URL}/inference/load/${presetId}`, {
+        // The load call returns a job handle right away; poll it until the
+        // weights are downloaded and loaded.
+        const started = await fetch(`${API_URL}/inference/load/${presetId}`, {
           method: 'POST',
-        });
+        }).then((res) => res.json());
+        if (started.error) throw new Error(started.error);
+        let job = started.job;
+        while (active && job.status !== 'completed' && job.status !== 'failed') {
+          await new Promise((resolve) => setTimeout(resolve, 1000));
+          job = await fetch(`${API_URL}/inference/load_jobs/${job.id}`).then((res) => res.json());
+        }
+        if (!active) return;
+        if (job.status === 'failed') throw new Error(job.error);
 
-        wsRef.current = new WebSocket(WS_URL);
+        wsRef.current = new WebSocket(`${WS_URL}?preset_id=${presetId}&protocol=json`);
         wsRef.current.onopen = () => setLoading(false);
         wsRef.current.onerror = () => alert('WebSocket connection failed');
       } catch (err) {
@@ -47,6 +58,7 @@ const PresetChat = () => {
     loadPreset();
 
     return () => {
+      active = false;
       wsRef.current?.close();
       clearTimeout(timeoutRef.current);
     };
@@ -69,14 +81,23 @@ const PresetChat = () => {
     }, 10000);
 
     wsRef.current.onmessage = (event) => {
-      const token = event.data;
+      // Frames carry coalesced tokens: {id, t, n}, then {id, done, ...} or {id, error};
+      // {id, queued} reports the place in line while the server is saturated.
+      const frame = JSON.parse(event.data);
 
-      if (token === '__END__') {
+      if (frame.queued !== undefined) {
         clearTimeout(timeoutRef.current);
-        setSending(false);
         return;
       }
 
+      if (frame.done || frame.error) {
+        clearTimeout(timeoutRef.current);
+        setSending(false);
+        if (!frame.error) return;
+      }
+
+      const token = frame.error ?? frame.t;
+
       setMessages((prev) => {
         const updated = [...prev];
         const last = updated[updated.length - 1];